@@ -0,0 +1,339 @@
+#!/usr/bin/env python3
+"""
+LZ4 decompression benchmark for utils.erofs.
+
+Builds a synthetic LZ4-compressed EROFS image (one compressed regular file,
+either in the legacy full-index layout with 4 KiB physical clusters or in the
+compacted layout with optional big pclusters and an inlined tail pcluster) and
+reads the file back through Inode.get_data, once with the native lz4 decoder
+and once with the pure-Python pp_decompress_lz4 fallback, and reports MiB/s.
+Both outputs are checked against the original data.
+
+Usage:
+    PYTHONPATH=`pwd` python3 bench/erofs_lz4.py --size 8
+    PYTHONPATH=`pwd` python3 bench/erofs_lz4.py --size 64 --skip-python
+    PYTHONPATH=`pwd` python3 bench/erofs_lz4.py --compact --big-pcluster 4 --ztailpacking
+"""
+import argparse
+import math
+import os
+import random
+import struct
+import tempfile
+import time
+
+import lz4.block
+
+from utils import erofs
+
+BLOCK_SIZE = 4096
+EROFS_FEATURE_INCOMPAT_LZ4_0PADDING = 0x1
+S_IFDIR = 0o040755
+S_IFREG = 0o100644
+
+
+def make_data(size: int, seed: int = 0) -> bytes:
+    """Compressible, but not trivially so: random runs of a small random vocabulary."""
+    rnd = random.Random(seed)
+    words = [bytes(rnd.choice(b"abcdefghijklmnopqrstuvwxyz_") for _ in range(rnd.randint(3, 12))) for _ in range(64)]
+    out = bytearray()
+    while len(out) < size:
+        out += b" ".join(rnd.choice(words) for _ in range(64))
+    return bytes(out[:size])
+
+
+def inode_v1(mode: int, layout: int, size: int, i_u: int, ino: int) -> bytes:
+    # i_advise, i_xattr_icount, i_mode, i_nlink, i_size, i_reserved, i_u, i_ino, i_uid, i_gid, checksum
+    return struct.pack("<HHHHIIIIHHI", layout << 1, 0, mode, 1, size, 0, i_u, ino, 0, 0, 0)
+
+
+def make_root_dir(file_nid: int) -> bytes:
+    """Root directory, EROFS_INODE_FLAT_INLINE, at nid 0, holding data.bin."""
+    names = [b".", b"..", b"data.bin"]
+    dirents = b""
+    nameoff = 12 * len(names)
+    for name, nid, file_type in zip(names, [0, 0, file_nid], [2, 2, 1]):
+        dirents += struct.pack("<QHBB", nid, nameoff, file_type, 0)
+        nameoff += len(name)
+    dir_data = dirents + b"".join(names)
+    root = inode_v1(S_IFDIR, erofs.DataMappingMode.EROFS_INODE_FLAT_INLINE.value, len(dir_data), 0, 1) + dir_data
+    assert len(root) <= 32 * file_nid
+    return root.ljust(32 * file_nid, b"\0")
+
+
+def make_super_block(total_blocks: int, meta_blkaddr: int, feature_incompat: int) -> bytes:
+    reserved2 = struct.pack("<I", feature_incompat).ljust(48, b"\0")
+    # magic, checksum, features, blkszbits, reserved, root_nid, inos, build_time, build_time_nsec, blocks, meta_blkaddr, xattr_blkaddr, uuid, volume_name
+    super_block = struct.pack("<IIIBBHQQIIII16s16s", 0xE0F5E1E2, 0, 0, 12, 0, 0, 2, 0, 0, total_blocks, meta_blkaddr, 0, bytes(16), bytes(16)) + reserved2
+    head = bytearray(BLOCK_SIZE)
+    head[0x400:0x400 + len(super_block)] = super_block
+    return bytes(head)
+
+
+def make_image(data: bytes, zero_padding: bool = True) -> bytes:
+    """Builds an EROFS image holding `data` at /data.bin, LZ4-compressed in
+    EROFS_INODE_FLAT_COMPRESSION_LEGACY layout."""
+    meta_blkaddr = 1
+
+    file_nid = 3
+    # Greedily pack as many whole logical clusters into each 4 KiB physical
+    # cluster as compress into it; clusters that do not compress are PLAIN
+    num_lclusters = math.ceil(len(data) / BLOCK_SIZE)
+    meta_size = 32 * file_nid + 48 + 8 * num_lclusters
+    blkaddr = meta_blkaddr + math.ceil(meta_size / BLOCK_SIZE)
+    index_types = erofs.DecompressIndexType
+    indexes = []
+    blocks = []
+    lcn = 0
+    while lcn < num_lclusters:
+        count = 0
+        compressed = None
+        while lcn + count < num_lclusters:
+            chunk = data[lcn * BLOCK_SIZE:(lcn + count + 1) * BLOCK_SIZE]
+            candidate = lz4.block.compress(chunk, store_size=False)
+            if len(candidate) > BLOCK_SIZE:
+                break
+            compressed = candidate
+            count += 1
+        if compressed is None or count == 1 and len(compressed) == BLOCK_SIZE:
+            chunk = data[lcn * BLOCK_SIZE:(lcn + 1) * BLOCK_SIZE]
+            blocks.append(chunk.ljust(BLOCK_SIZE, b"\0"))
+            indexes.append(struct.pack("<HHI", index_types.Z_EROFS_VLE_CLUSTER_TYPE_PLAIN.value, 0, blkaddr + len(blocks) - 1))
+            lcn += 1
+            continue
+        padding = bytes(BLOCK_SIZE - len(compressed))
+        blocks.append(padding + compressed if zero_padding else compressed + padding)
+        indexes.append(struct.pack("<HHI", index_types.Z_EROFS_VLE_CLUSTER_TYPE_HEAD.value, 0, blkaddr + len(blocks) - 1))
+        for delta in range(1, count):
+            # delta[0]: distance back to the HEAD, delta[1]: distance to the next HEAD
+            indexes.append(struct.pack("<HHHH", index_types.Z_EROFS_VLE_CLUSTER_TYPE_NONHEAD.value, 0, delta, count - delta))
+        lcn += count
+    indexes = b"".join(indexes)
+
+    layout = erofs.DataMappingMode.EROFS_INODE_FLAT_COMPRESSION_LEGACY.value
+    meta = make_root_dir(file_nid)
+    meta += inode_v1(S_IFREG, layout, len(data), len(blocks), 2)
+    meta += bytes(8)  # struct z_erofs_map_header (lz4, 4 KiB clusters)
+    meta += bytes(8)  # Z_EROFS_VLE_LEGACY_HEADER_PADDING
+    meta += indexes
+    meta = meta.ljust((blkaddr - meta_blkaddr) * BLOCK_SIZE, b"\0")
+
+    feature_incompat = EROFS_FEATURE_INCOMPAT_LZ4_0PADDING if zero_padding else 0
+    return make_super_block(blkaddr + len(blocks), meta_blkaddr, feature_incompat) + meta + b"".join(blocks)
+
+
+def compress_extents(data: bytes, max_blocks: int, interlaced: bool):
+    """Greedily cuts `data` into byte-granular extents that each compress into
+    at most `max_blocks` blocks. Every extent ends in a later logical cluster
+    than it starts, since a logical cluster holds at most one HEAD. Extents
+    that do not compress are stored PLAIN, one block each.
+    :return: list of (start, end, compressed payload or None, raw block for PLAIN)
+    """
+    extents = []
+    pos = 0
+    while pos < len(data):
+        lo, hi = 0, len(data) - pos
+        while lo < hi:
+            mid = (lo + hi + 1) // 2
+            if len(lz4.block.compress(data[pos:pos + mid], store_size=False)) <= max_blocks * BLOCK_SIZE:
+                lo = mid
+            else:
+                hi = mid - 1
+        end = pos + lo
+        compressed = lz4.block.compress(data[pos:end], store_size=False) if lo else None
+        if end == len(data) or end // BLOCK_SIZE > pos // BLOCK_SIZE:
+            if compressed is not None and len(compressed) < end - pos:
+                extents.append((pos, end, compressed, None))
+                pos = end
+                continue
+        end = min(pos + BLOCK_SIZE, len(data))
+        chunk = data[pos:end]
+        if interlaced:
+            shift = pos % BLOCK_SIZE
+            chunk = chunk.ljust(BLOCK_SIZE, b"\0")
+            block = chunk[BLOCK_SIZE - shift:] + chunk[:BLOCK_SIZE - shift]
+        else:
+            block = chunk.ljust(BLOCK_SIZE, b"\0")
+        extents.append((pos, end, None, block))
+        pos = end
+    return extents
+
+
+def write_compacted_indexes(lclusters, ebase: int, big_pcluster: bool, compacted_2b: bool) -> bytes:
+    """Encodes (type, lo, pblk) lclusters in the compacted 2B/4B format, the
+    inverse of unpack_compacted_index() in fs/erofs/zmap.c. `lo` is delta[0]
+    (or CBLKCNT) for NONHEAD lclusters and delta[1] for the last NONHEAD of a
+    pack; the pack base is chosen so that every HEAD resolves to its pblk."""
+    nonhead = erofs.DecompressIndexType.Z_EROFS_VLE_CLUSTER_TYPE_NONHEAD.value
+    totalidx = len(lclusters)
+    compacted_4b_initial = (32 - ebase % 32) // 4
+    if compacted_4b_initial == 8:
+        compacted_4b_initial = 0
+    num_2b = (totalidx - compacted_4b_initial) // 16 * 16 if compacted_2b and compacted_4b_initial < totalidx else 0
+
+    out = b""
+    lcn = 0
+    while lcn < totalidx:
+        vcnt, packsize = (16, 32) if compacted_4b_initial <= lcn < compacted_4b_initial + num_2b else (2, 8)
+        encodebits = (packsize - 4) * 8 // vcnt
+        pack = lclusters[lcn:lcn + vcnt]
+        pack += [(nonhead, 0, None)] * (vcnt - len(pack))
+        last_type, last_lo, _ = pack[-1]
+        if last_type == nonhead and not last_lo & erofs.Z_EROFS_LI_D0_CBLKCNT:
+            delta1 = 1
+            while lcn + vcnt - 1 + delta1 < totalidx and lclusters[lcn + vcnt - 1 + delta1][0] == nonhead:
+                delta1 += 1
+            pack[-1] = (nonhead, min(delta1, erofs.Z_EROFS_LI_D0_CBLKCNT - 1), None)
+        bits = 0
+        for i, (cluster_type, lo, _) in enumerate(pack):
+            bits |= (lo | cluster_type << 12) << (encodebits * i)
+        base = None
+        for i, (cluster_type, _, pblk) in enumerate(pack):
+            if cluster_type == nonhead or pblk is None:
+                continue
+            # Same walk as the reader: count the blocks of the pclusters before i
+            j = i
+            nblk = 0 if big_pcluster else 1
+            while j > 0:
+                j -= 1
+                prev_type, prev_lo, _ = pack[j]
+                if big_pcluster:
+                    if prev_type == nonhead:
+                        if prev_lo & erofs.Z_EROFS_LI_D0_CBLKCNT:
+                            j -= 1
+                            nblk += prev_lo & ~erofs.Z_EROFS_LI_D0_CBLKCNT
+                        else:
+                            j -= prev_lo - 2
+                        continue
+                    nblk += 1
+                else:
+                    if prev_type == nonhead:
+                        j -= prev_lo
+                    if j >= 0:
+                        nblk += 1
+            assert base is None or base == pblk - nblk, "pclusters of a pack are not contiguous"
+            base = pblk - nblk
+        out += (bits.to_bytes(packsize - 4, "little") + struct.pack("<I", base or 0))
+        lcn += vcnt
+    return out
+
+
+def make_compacted_image(data: bytes, max_blocks: int = 1, ztailpacking: bool = False, interlaced: bool = False, compacted_2b: bool = True) -> bytes:
+    """Builds an EROFS image holding `data` at /data.bin, LZ4-compressed in
+    EROFS_INODE_FLAT_COMPRESSION layout with compacted indexes. `max_blocks`
+    above 1 enables big pclusters, `ztailpacking` inlines a small tail
+    pcluster right after the indexes."""
+    meta_blkaddr = 1
+    file_nid = 3
+    index_types = erofs.DecompressIndexType
+    extents = compress_extents(data, max_blocks, interlaced)
+
+    inline = b""
+    if ztailpacking and extents[-1][2] is not None and len(extents[-1][2]) <= BLOCK_SIZE // 2:
+        inline = extents[-1][2]
+
+    advise = erofs.Z_EROFS_ADVISE_COMPACTED_2B if compacted_2b else 0
+    if max_blocks > 1:
+        advise |= erofs.Z_EROFS_ADVISE_BIG_PCLUSTER_1
+    if inline:
+        advise |= erofs.Z_EROFS_ADVISE_INLINE_PCLUSTER
+    if interlaced:
+        advise |= erofs.Z_EROFS_ADVISE_INTERLACED_PCLUSTER
+
+    # Indexes are laid out after the inode and the map header, so blocks start after the worst case meta size
+    ebase = 32 * file_nid + 32 + 8
+    num_lclusters = math.ceil(len(data) / BLOCK_SIZE)
+    blkaddr = meta_blkaddr + math.ceil((ebase + 4 * num_lclusters + 64 + len(inline)) / BLOCK_SIZE)
+
+    lclusters = [None] * num_lclusters
+    blocks = []
+    heads = [start // BLOCK_SIZE for start, _, _, _ in extents]
+    for k, (start, end, compressed, block) in enumerate(extents):
+        head_lcn = start // BLOCK_SIZE
+        next_head_lcn = heads[k + 1] if k + 1 < len(heads) else num_lclusters
+        pblk = blkaddr + sum(len(block) for block in blocks) // BLOCK_SIZE
+        if compressed is None:
+            lclusters[head_lcn] = (index_types.Z_EROFS_VLE_CLUSTER_TYPE_PLAIN.value, start % BLOCK_SIZE, pblk)
+            blocks.append(block)
+            cblks = 1
+        elif k == len(extents) - 1 and inline:
+            lclusters[head_lcn] = (index_types.Z_EROFS_VLE_CLUSTER_TYPE_HEAD.value, start % BLOCK_SIZE, None)
+            cblks = 0
+        else:
+            cblks = math.ceil(len(compressed) / BLOCK_SIZE)
+            lclusters[head_lcn] = (index_types.Z_EROFS_VLE_CLUSTER_TYPE_HEAD.value, start % BLOCK_SIZE, pblk)
+            blocks.append(bytes(cblks * BLOCK_SIZE - len(compressed)) + compressed)
+        for lcn in range(head_lcn + 1, next_head_lcn):
+            if max_blocks > 1 and lcn == head_lcn + 1 and cblks:
+                lo = erofs.Z_EROFS_LI_D0_CBLKCNT | cblks
+            else:
+                lo = lcn - head_lcn
+            lclusters[lcn] = (index_types.Z_EROFS_VLE_CLUSTER_TYPE_NONHEAD.value, lo, None)
+        assert cblks <= 1 or next_head_lcn > head_lcn + 1, "multi-block pcluster without a CBLKCNT lcluster"
+    compacted = write_compacted_indexes(lclusters, ebase, max_blocks > 1, compacted_2b)
+
+    layout = erofs.DataMappingMode.EROFS_INODE_FLAT_COMPRESSION.value
+    meta = make_root_dir(file_nid)
+    total_blocks = sum(len(block) for block in blocks) // BLOCK_SIZE
+    meta += inode_v1(S_IFREG, layout, len(data), total_blocks, 2)
+    # h_reserved1, h_idata_size, h_advise, h_algorithmtype (lz4), h_clusterbits (4 KiB)
+    meta += struct.pack("<HHHBB", 0, len(inline), advise, 0, 0)
+    meta += compacted + inline
+    assert len(meta) <= (blkaddr - meta_blkaddr) * BLOCK_SIZE
+    meta = meta.ljust((blkaddr - meta_blkaddr) * BLOCK_SIZE, b"\0")
+
+    # big pclusters and ztailpacking both require 0padding (EROFS_FEATURE_INCOMPAT_LZ4_0PADDING)
+    return make_super_block(blkaddr + total_blocks, meta_blkaddr, EROFS_FEATURE_INCOMPAT_LZ4_0PADDING) + meta + b"".join(blocks)
+
+
+def bench(img_path: str, data: bytes, native: bool, rounds: int):
+    lz4_module = erofs.lz4
+    if not native:
+        erofs.lz4 = None
+    try:
+        fs = erofs.Erofs(img_path)
+        inode = fs.get_file(b"/data.bin")
+        best = None
+        for _ in range(rounds):
+            start = time.perf_counter()
+            out = inode.get_data()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+            assert out == data, "decompressed data mismatch"
+    finally:
+        erofs.lz4 = lz4_module
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=8, help="size of the compressed file in MiB")
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--no-zero-padding", action="store_true", help="pad compressed clusters at the end (pre-0padding images)")
+    parser.add_argument("--skip-python", action="store_true", help="only time the native decoder")
+    parser.add_argument("--compact", action="store_true", help="use the compacted index layout (EROFS_INODE_FLAT_COMPRESSION)")
+    parser.add_argument("--big-pcluster", type=int, default=1, metavar="BLOCKS", help="with --compact, maximum blocks per physical cluster")
+    parser.add_argument("--ztailpacking", action="store_true", help="with --compact, inline the tail pcluster")
+    parser.add_argument("--interlaced", action="store_true", help="with --compact, store uncompressed extents interlaced")
+    args = parser.parse_args()
+
+    data = make_data(args.size << 20)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        img_path = os.path.join(tmp_dir, "bench.erofs")
+        with open(img_path, "wb") as f:
+            if args.compact:
+                f.write(make_compacted_image(data, args.big_pcluster, args.ztailpacking, args.interlaced))
+            else:
+                f.write(make_image(data, zero_padding=not args.no_zero_padding))
+        print(f"image: {os.path.getsize(img_path)} bytes for {len(data)} bytes of data")
+
+        mib = len(data) / (1 << 20)
+        elapsed = bench(img_path, data, True, args.rounds)
+        print(f"native lz4:        {elapsed:8.3f}s  {mib / elapsed:8.1f} MiB/s")
+        if not args.skip_python:
+            elapsed = bench(img_path, data, False, 1)
+            print(f"pp_decompress_lz4: {elapsed:8.3f}s  {mib / elapsed:8.1f} MiB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Throughput benchmark for utils.ext4.BlockReader.
+
+Reads a large file (e.g. a TA or an APK) from an ext4 image, once in a single
+read() and once in fixed-size chunks, and reports MiB/s.
+
+Usage:
+    PYTHONPATH=`pwd` python3 bench/ext4_read.py -i vendor.img -p app/Foo/Foo.apk
+    PYTHONPATH=`pwd` python3 bench/ext4_read.py --synthetic 256   # needs mke2fs
+"""
+import argparse
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+from utils import ext4
+
+
+def make_synthetic_image(size_mib: int, tmp_dir: str) -> str:
+    """Builds an ext4 image holding one `size_mib` MiB file at big/app.apk."""
+    root = os.path.join(tmp_dir, "root")
+    os.makedirs(os.path.join(root, "big"))
+    with open(os.path.join(root, "big", "app.apk"), "wb") as f:
+        for _ in range(size_mib):
+            f.write(os.urandom(1 << 20))
+    img = os.path.join(tmp_dir, "bench.img")
+    subprocess.check_call(["mke2fs", "-q", "-t", "ext4", "-b", "4096", "-d", root, img, f"{size_mib * 2 + 16}M"])
+    return img
+
+
+def bench(img_path: str, path: str, chunk_size: int, rounds: int):
+    with open(img_path, "rb") as img:
+        volume = ext4.Volume(img)
+        inode = volume.root.get_inode(*path.strip("/").split("/"))
+        size = len(inode)
+        print(f"{path}: {size} bytes, {len(inode.open_read().block_map)} extents")
+
+        for name, chunk in [("single read", -1), (f"{chunk_size} B chunks", chunk_size)]:
+            best = None
+            for _ in range(rounds):
+                reader = inode.open_read()
+                start = time.perf_counter()
+                if chunk == -1:
+                    reader.read()
+                else:
+                    while reader.read(chunk):
+                        pass
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            print(f"  {name:>20}: {size / best / (1 << 20):10.1f} MiB/s ({best * 1000:.1f} ms)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ext4 BlockReader throughput benchmark")
+    parser.add_argument("-i", "--image", help="ext4 image")
+    parser.add_argument("-p", "--path", default="big/app.apk", help="File within the image")
+    parser.add_argument("--synthetic", type=int, metavar="MIB", help="Build a synthetic image with a MIB sized file")
+    parser.add_argument("--chunk-size", type=int, default=64 * 1024)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    tmp_dir = None
+    if args.synthetic:
+        tmp_dir = tempfile.mkdtemp()
+        args.image = make_synthetic_image(args.synthetic, tmp_dir)
+    elif not args.image:
+        parser.error("either --image or --synthetic is required")
+
+    try:
+        bench(args.image, args.path, args.chunk_size, args.rounds)
+    finally:
+        if tmp_dir:
+            shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
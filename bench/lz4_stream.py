@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""
+Memory/latency benchmark for utils.lz4frame.LZ4FrameFile.
+
+Compares lz4.frame.decompress of a whole .lz4 file (what unlz4 used to do)
+with LZ4FrameFile: time to the first read at the end of the image, time for
+random 4 KiB reads afterwards, and the peak RSS of each.
+
+Usage:
+    PYTHONPATH=`pwd` python3 bench/lz4_stream.py -i super.img.lz4
+    PYTHONPATH=`pwd` python3 bench/lz4_stream.py --synthetic 512
+"""
+import argparse
+import os
+import random
+import resource
+import tempfile
+import time
+
+import lz4.frame
+
+from utils.lz4frame import LZ4FrameFile
+
+
+def make_synthetic_file(size_mib: int, tmp_dir: str) -> str:
+    """Writes `size_mib` MiB of half-compressible data as independent 4 MiB blocks, like the lz4 tool."""
+    path = os.path.join(tmp_dir, "bench.img.lz4")
+    with lz4.frame.open(path, "wb", block_size=lz4.frame.BLOCKSIZE_MAX4MB, block_linked=False) as f:
+        for _ in range(size_mib):
+            f.write(os.urandom(1 << 19) + bytes(1 << 19))
+    return path
+
+
+def peak_rss_mib() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("-i", "--input", help=".lz4 file")
+    parser.add_argument("--synthetic", type=int, metavar="MIB", help="generate an input of MIB MiB instead")
+    parser.add_argument("--reads", type=int, default=1000, help="random 4 KiB reads")
+    parser.add_argument("--whole", action="store_true", help="also time lz4.frame.decompress (run last, raises peak RSS)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = make_synthetic_file(args.synthetic, tmp_dir) if args.synthetic else args.input
+        print(f"{path}: {os.path.getsize(path)} bytes compressed, peak RSS {peak_rss_mib():.0f} MiB")
+
+        with open(path, "rb") as fi:
+            start = time.perf_counter()
+            f = LZ4FrameFile(fi, tmp_dir=tmp_dir)
+            size = f.seek(0, os.SEEK_END)
+            f.seek(size - 4096)
+            f.read(4096)
+            indexed = time.perf_counter() - start
+            start = time.perf_counter()
+            for _ in range(args.reads):
+                f.seek(random.randrange(max(1, size - 4096)))
+                f.read(4096)
+            reads = time.perf_counter() - start
+            mode = "spool" if f.spool is not None else "index"
+            print(f"LZ4FrameFile ({mode}, {len(f.blocks)} blocks): {size} bytes, index {indexed:.2f}s, "
+                  f"{args.reads / reads:,.0f} random reads/s, peak RSS {peak_rss_mib():.0f} MiB")
+
+        if args.whole:
+            with open(path, "rb") as fi:
+                start = time.perf_counter()
+                data = lz4.frame.decompress(fi.read())
+                print(f"lz4.frame.decompress: {len(data)} bytes in {time.perf_counter() - start:.2f}s, "
+                      f"peak RSS {peak_rss_mib():.0f} MiB")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,24 @@
 fw_path = "/fw"
 
+# Persistent cache of decoded firmware images (decompressed, decrypted, super
+# partitions) shared by all extractor runs, see utils/image_cache.py. Set it to
+# e.g. f"{fw_path}/.image_cache" to enable it; the budget is in bytes.
+image_cache_dir = None
+image_cache_budget = 64 << 30
+
+# Disk directory for the temporary files of extraction jobs that don't fit in
+# /dev/shm, see utils/workspace.py. None uses the system temporary directory.
+scratch_dir = None
+
+# SQLite ledger of the stages every firmware went through (status, timings,
+# bytes, errors), see utils/ledger.py. None disables it.
+ledger_path = f"{fw_path}/fw_db.db"
+
+# SQLite catalogue of the parsed TAs and firmware dates behind utils/fw_repo.py,
+# see utils/catalogue.py. None makes fw_repo scan the reports every time. Kept
+# apart from the ledger so analysis runs don't wait on extraction jobs' locks.
+catalogue_path = f"{fw_path}/fw_catalogue.db"
+
 samsung_mtk = ["SM-A225F", "SM-A326B"]
 
 
@@ -1,60 +1,98 @@
 #!/usr/bin/python3
 import os
 import argparse
-import tempfile
+import logging
+from typing import List
+
+from utils import extract_cache, jobs, ledger, utils, workspace
+from utils.archive import open_members
+from utils.filesystem import FsType, open_filesystem
 
 """
 extract tas from a firmware downloaded from https://firmwarefile.com/category/oppo
 """
 
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+EXTRACTOR = "transsien/mtk_bp"
+# Bump whenever a change to this script changes its output, so cached extractions are redone
+EXTRACTOR_VERSION = 1
+
+# beanpod keeps its TAs in /vendor/thh/ta, next to the rest of /vendor/thh
+TA_SEARCH_DIRS = ["thh"]
+
+
+def dump_thh(image, image_name: str, out_dir: str) -> List[str]:
+    """Copies /vendor/thh of an ext4/EROFS image (sparse or not) to `out_dir`, without mounting it."""
+    img_fs = open_filesystem(image)
+    if img_fs.fstype not in (FsType.EXT4, FsType.EROFS):
+        log.error(f"Skipping {image_name}, unsupported image {img_fs}")
+        return []
+    ta_paths = img_fs.dump_files(out_dir, file_regex=[".*"], search_dirs=TA_SEARCH_DIRS, flat=True, fallback=False)
+    if ta_paths:
+        utils.update_ta_manifest(out_dir, ta_paths)
+    else:
+        log.error(f"Could not find thh in {image_name}")
+    return ta_paths
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-f", "--firmware", action='store', dest='firmware',
                        help='Specify firmware file')
     parser.add_argument("-t", "--tas", action="store_true", help="Get trusted applications from image.")
     parser.add_argument("-o", "--out", required=True, action="store", help="Directory to store outputs.")
+    parser.add_argument("--force", action="store_true",
+                        help="Extract again even if the outputs are up to date with the firmware.")
+    parser.add_argument("--full-digest", action="store_true",
+                        help="Also compare the sha256 of the whole firmware to decide if the outputs are up to date.")
     args = parser.parse_args()
 
-    tmpdir = tempfile.mktemp()
+    options = {"tas": args.tas}
+    if not args.force and extract_cache.is_cached(
+            args.out, args.firmware, EXTRACTOR, EXTRACTOR_VERSION, options, args.full_digest):
+        log.info(f"{args.out} is up to date with {args.firmware}, skipping it")
+        exit(0)
+    if args.force or extract_cache.load_manifest(args.out) is not None:
+        # The outputs are those of another, complete run: redo every stage
+        ledger.reset(args.firmware)
 
     if not os.path.exists(args.out):
         os.makedirs(args.out)
 
-    fw_path = os.path.dirname(args.firmware)
-    os.system(f"unzip -o '{args.firmware}' -d {tmpdir}")
-    vendor_img = None
-    super_img = None
-    for root, dirs, files in os.walk(tmpdir):
-        for f in files:
-            if f == "vendor.img":
-                vendor_img = os.path.join(root, f)
-            if f == "super.img":
-                super_img = os.path.join(root, f)
-    if not vendor_img and not super_img:
-        print("vendor.img or super.img not found at: ", tmpdir)
-        exit(-1)
-    if vendor_img:
-        vendor_raw = os.path.join(tmpdir, "vendor.raw")
-        vendor_out = os.path.join(tmpdir, "vendor_out")
-        os.system(f"simg2img '{vendor_img}' {vendor_raw}")
-        os.system(f"mkdir {vendor_out}")
-        os.system(f"sudo mount -t auto -o ro {vendor_raw} {vendor_out}")
-        os.system(f"cp {vendor_out}/thh/* {args.out}")
-        os.system(f"cp {vendor_out}/thh/ta/* {args.out}")
-        os.system(f"sudo umount {vendor_out}")
-    if super_img:
-        super_raw = os.path.join(tmpdir, "super.raw")
-        super_out = os.path.join(tmpdir, "super_out")
-        os.system(f"simg2img '{super_img}' {super_raw}")
-        os.system(f"lpunpack {super_raw} {super_out}")
-        os.system(f"mkdir {tmpdir}/vendor")
-        if os.path.exists(f"{super_out}/vendor.img"):
-            v_name = os.path.join(super_out, "vendor.img")
-        else:
-            v_name = os.path.join(super_out, "vendor_a.img")
-        os.system(f"sudo mount -t auto -o ro {v_name} {tmpdir}/vendor")
-        os.system(f"cp {tmpdir}/vendor/thh/* {args.out}")
-        os.system(f"cp {tmpdir}/vendor/thh/ta/* {args.out}")
-        os.system(f"sudo umount {tmpdir}/vendor")
-    
-    os.system(f"rm -r {tmpdir}")
+    # Private per-job workspace, on tmpfs if the compressed images extracted from the archive fit
+    footprint = jobs.members_size(args.firmware, lambda f: f in ("vendor.img", "super.img"))
+    with workspace.job_workspace(footprint) as tmpdir:
+        with ledger.track(args.firmware, EXTRACTOR, "unpack", args.out) as stage:
+            # Images stored uncompressed are read in place, the others are extracted to tmpdir
+            members = dict(open_members(args.firmware, tmpdir, lambda f: f in ("vendor.img", "super.img")))
+            if not members:
+                stage.fail(f"vendor.img or super.img not found in {args.firmware}")
+            stage.bytes = sum(ledger.stream_size(member) for member in members.values())
+        if stage.error:
+            log.error(stage.error)
+            exit(-1)
+        with ledger.track(args.firmware, EXTRACTOR, "fs-walk", args.out) as stage:
+            ta_paths = []
+            if "vendor.img" in members:
+                ta_paths += dump_thh(members["vendor.img"], "vendor.img", args.out)
+            if "super.img" in members:
+                super_fs = open_filesystem(members["super.img"])
+                if super_fs.fstype != FsType.SUPER:
+                    log.error(f"super.img isn't a super image: {super_fs}")
+                else:
+                    super_image = super_fs.open_super()
+                    if "vendor" in super_image:
+                        ta_paths += dump_thh(super_image.open("vendor"), "super/vendor", args.out)
+                    else:
+                        log.error("vendor partition not found in super.img")
+            if not ta_paths:
+                stage.fail(f"No TAs found in {args.firmware}")
+            stage.bytes = ledger.tree_size(args.out)
+        if stage.error:
+            # Nothing to cache: the next run extracts again
+            log.error(f"failed to extract TAs from {args.firmware}")
+            exit(-1)
+        extract_cache.record_extraction(args.out, args.firmware, EXTRACTOR, EXTRACTOR_VERSION, options, args.full_digest)
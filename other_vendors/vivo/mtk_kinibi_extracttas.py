@@ -1,87 +1,128 @@
 #!/usr/bin/python3
 import os
+import sys
 import argparse
-import tempfile
+import logging
+import subprocess
+from typing import BinaryIO, List, Tuple
+
+from utils import extract_cache, image_cache, jobs, ledger, utils, workspace
+from utils.archive import extract_members, open_members
+from utils.filesystem import FsType, open_filesystem
+from utils.simg2img import open_sparse_images
 
 """
 extract tas from a firmware downloaded from https://firmwarefile.com/category/oppo
 """
 
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+EXTRACTOR = "vivo/mtk_kinibi"
+# Bump whenever a change to this script changes its output, so cached extractions are redone
+EXTRACTOR_VERSION = 1
+
+OFP_DECRYPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "oppo", "oppo_decrypt", "ofp_mtk_decrypt.py")
+# mcRegistry at the root of vendor images
+VENDOR_MCREGISTRY_DIRS = ["app/mcRegistry"]
+
+
+def is_super_image(filename: str) -> bool:
+    return filename.startswith("super") and filename.endswith("img")
+
+
+def dump_mcregistry(image, image_name: str, search_dirs: List[str], out_dir: str) -> List[str]:
+    """Copies the mcRegistry of an ext4/EROFS image (sparse or not) to `out_dir`, without mounting it."""
+    img_fs = open_filesystem(image)
+    if img_fs.fstype not in (FsType.EXT4, FsType.EROFS):
+        log.error(f"Skipping {image_name}, unsupported image {img_fs}")
+        return []
+    ta_paths = img_fs.dump_files(out_dir, file_regex=[".*"], search_dirs=search_dirs, flat=True, fallback=False)
+    if ta_paths:
+        utils.update_ta_manifest(out_dir, ta_paths)
+    else:
+        log.error(f"Could not find mcRegistry in {image_name}")
+    return ta_paths
+
+
+def dump_super_mcregistry(super_images: List[Tuple[str, BinaryIO]], out_dir: str) -> List[str]:
+    """Reads the vendor partition out of a (possibly split and sparse) super image given as (name, file object)."""
+    super_images = sorted(super_images, key=lambda image: image[0])
+    super_names = [name for name, _ in super_images]
+    super_fs = open_filesystem(open_sparse_images([fd for _, fd in super_images]))
+    if super_fs.fstype != FsType.SUPER:
+        log.error(f"{super_names} isn't a super image: {super_fs}")
+        return []
+    super_image = super_fs.open_super()
+    if "vendor" not in super_image:
+        log.error(f"vendor partition not found in {super_names}")
+        return []
+    return dump_mcregistry(super_image.open("vendor"), "super/vendor", VENDOR_MCREGISTRY_DIRS, out_dir)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("-f", "--firmware", action='store', dest='firmware',
                        help='Specify firmware file')
     parser.add_argument("-t", "--tas", action="store_true", help="Get trusted applications from image.")
     parser.add_argument("-o", "--out", required=True, action="store", help="Directory to store outputs.")
+    parser.add_argument("--force", action="store_true",
+                        help="Extract again even if the outputs are up to date with the firmware.")
+    parser.add_argument("--full-digest", action="store_true",
+                        help="Also compare the sha256 of the whole firmware to decide if the outputs are up to date.")
     args = parser.parse_args()
 
-    tmpdir = tempfile.mktemp()
+    options = {"tas": args.tas}
+    if not args.force and extract_cache.is_cached(
+            args.out, args.firmware, EXTRACTOR, EXTRACTOR_VERSION, options, args.full_digest):
+        log.info(f"{args.out} is up to date with {args.firmware}, skipping it")
+        exit(0)
+    if args.force or extract_cache.load_manifest(args.out) is not None:
+        # The outputs are those of another, complete run: redo every stage
+        ledger.reset(args.firmware)
 
     if not os.path.exists(args.out):
         os.makedirs(args.out)
 
-    fw_path = os.path.dirname(args.firmware)
-    if args.firmware.endswith(".zip"):
-        print(f"unzip -o '{args.firmware}' -d {tmpdir}")
-        os.system(f"unzip -o '{args.firmware}' -d {tmpdir}")
-    if args.firmware.endswith(".rar"):
-        print(f"unrar e '{args.firmware}' {tmpdir}")
-        os.system(f"unrar e -op{tmpdir} '{args.firmware}' ")
-    if args.firmware.endswith(".gz"):
-        print(f"tar xvf '{args.firmware}' --directory {tmpdir}")
-        os.system(f"tar xvf '{args.firmware}' --directory {tmpdir}")
-    ofp_filename = None
-    super_files = []
-    for root, dirs, files in os.walk(tmpdir):
-        for f in files:
-            if f.endswith(".ofp"):
-                ofp_filename = os.path.join(root, f)
-                break
-            if f.startswith("super") and f.endswith("img"):
-                super_files.append(os.path.join(root, f))
-    if not ofp_filename:
-        if len(super_files) == 0:
-            print(".ofp file or super.img not found, please check manually at: ", tmpdir)
+    # Private per-job workspace, on tmpfs if the .ofp and the images decrypted out of it fit
+    footprint = 2 * jobs.members_size(args.firmware, lambda f: f.endswith(".ofp") or is_super_image(f))
+    with workspace.job_workspace(footprint) as tmpdir:
+
+        def decode_images() -> List[Tuple[str, BinaryIO]]:
+            # The decryptor needs the .ofp as a file, super images stored uncompressed are read in place
+            ofp_files = extract_members(args.firmware, tmpdir, lambda f: f.endswith(".ofp"))
+            if not ofp_files:
+                return open_members(args.firmware, tmpdir, is_super_image)
+            decrypted_dir = os.path.join(tmpdir, "decrypted")
+            log.info(f"Decrypting {ofp_files[0]}")
+            subprocess.run([sys.executable, OFP_DECRYPT, ofp_files[0], decrypted_dir], check=True)
+            os.remove(ofp_files[0])
+            if os.path.exists(os.path.join(decrypted_dir, "vendor.img")):
+                return [("vendor.img", open(os.path.join(decrypted_dir, "vendor.img"), "rb"))]
+            return [(f, open(os.path.join(decrypted_dir, f), "rb")) for f in sorted(os.listdir(decrypted_dir))
+                    if is_super_image(f)]
+
+        with ledger.track(args.firmware, EXTRACTOR, "unpack", args.out) as stage:
+            # The decrypted images are kept across runs if the image cache is enabled
+            images = image_cache.cached_images(args.firmware, f"{EXTRACTOR}:ofp_mtk_decrypt", decode_images)
+            if not images:
+                stage.fail(f".ofp file or super.img not found in {args.firmware}")
+            stage.bytes = sum(ledger.stream_size(image) for _, image in images)
+        if stage.error:
+            log.error(stage.error)
             exit(-1)
-        super_raw = os.path.join(tmpdir, "super.raw")
-        super_out = os.path.join(tmpdir, "super_out")
-        print(f"simg2img '{' '.join(super_files)}' {super_raw}")
-        os.system(f"simg2img '{' '.join(super_files)}' {super_raw}")
-        os.system(f"lpunpack {super_raw} {super_out}")
-        os.system(f"mkdir {os.path.join(tmpdir, 'vendor')}")
-        os.system(f"sudo mount -t auto -o ro {os.path.join(super_out, 'vendor.img')} {os.path.join(tmpdir, 'vendor')}")
-        os.system(f"cp -r {os.path.join(tmpdir, 'vendor', 'app', 'mcRegistry', '*')} {args.out}")
-        os.system(f"sudo umount {os.path.join(tmpdir, 'vendor')}")
-        os.system(f"rm -rf {tmpdir}")
-    else:
-        tmpdir2 = tempfile.mktemp()
-        print(f"python3 oppo_decrypt/ofp_mtk_decrypt.py '{os.path.join(fw_path, ofp_filename)}' {tmpdir2}")
-        os.system(f"python3 oppo_decrypt/ofp_mtk_decrypt.py '{os.path.join(fw_path, ofp_filename)}' {tmpdir2}")
-        vendor = os.path.join(tmpdir2, "vendor.img")
-        vendor_raw = os.path.join(tmpdir2, "vendor.raw")
-        super = []
-        for f in os.listdir(tmpdir2):
-            if f.startswith("super") and f.endswith("img"):
-                super.append(os.path.join(tmpdir2, f))
-        super_raw = os.path.join(tmpdir2, "super.raw")
-        super_out = os.path.join(tmpdir2, "super_out")
-        if os.path.exists(os.path.join(vendor)):
-            os.system(f"mkdir {os.path.join(tmpdir2, 'vendor')}")
-            os.system(f"simg2img {vendor} {vendor_raw}")
-            os.system(f"sudo mount -t auto -o ro {vendor_raw} {os.path.join(tmpdir2, 'vendor')}")
-            os.system(f"cp -r {os.path.join(tmpdir2, 'vendor', 'app', 'mcRegistry', '*')} {args.out}")
-            os.system(f"sudo umount {os.path.join(tmpdir2, 'vendor')}")
-            os.system(f"rm -r {tmpdir}")
-            os.system(f"rm -r {tmpdir2}")
-        
-        elif len(super) > 0:
-            os.system(f"simg2img {' '.join(super)} {super_raw}")
-            os.system(f"lpunpack {super_raw} {super_out}")
-            os.system(f"mkdir {os.path.join(tmpdir2, 'vendor')}")
-            os.system(f"sudo mount -t auto -o ro {os.path.join(super_out, 'vendor.img')} {os.path.join(tmpdir2, 'vendor')}")
-            os.system(f"cp -r {os.path.join(tmpdir2, 'vendor', 'app', 'mcRegistry', '*')} {args.out}")
-            os.system(f"sudo umount {os.path.join(tmpdir2, 'vendor')}")
-            os.system(f"rm -r {tmpdir}")
-            os.system(f"rm -r {tmpdir2}")
-        else:
-            print("failed to extract, check at", tmpdir2)
+        with ledger.track(args.firmware, EXTRACTOR, "fs-walk", args.out) as stage:
+            ta_paths = []
+            if images[0][0] == "vendor.img":
+                ta_paths += dump_mcregistry(images[0][1], "vendor.img", VENDOR_MCREGISTRY_DIRS, args.out)
+            else:
+                ta_paths += dump_super_mcregistry(images, args.out)
+            if not ta_paths:
+                stage.fail(f"No TAs found in {args.firmware}")
+            stage.bytes = ledger.tree_size(args.out)
+        if stage.error:
+            # Nothing to cache: the next run extracts again
+            log.error(f"failed to extract TAs from {args.firmware}")
+            exit(-1)
+        extract_cache.record_extraction(args.out, args.firmware, EXTRACTOR, EXTRACTOR_VERSION, options, args.full_digest)
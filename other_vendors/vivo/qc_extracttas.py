@@ -1,23 +1,31 @@
 #!/usr/bin/python3
 import os
 import argparse
-import tempfile
 import logging
-import tempfile
+import shutil
 import pexpect
 import struct
+from typing import BinaryIO, List
 
+from utils import extract_cache, jobs, ledger, workspace
+from utils.archive import open_members
+from utils.filesystem import FsType, open_filesystem
 
 
 logging.basicConfig()
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
-def unify_tas(file_chunk_dir: str, fw_out_dir: str):
+EXTRACTOR = "vivo/qc"
+# Bump whenever a change to this script changes its output, so cached extractions are redone
+EXTRACTOR_VERSION = 1
+
+def unify_tas(file_chunk_dir: str, fw_out_dir: str) -> List[str]:
 
     # unify .mdt and .bXX to ELF
     # https://github.com/pandasauce/unify_trustlet/blob/master/unify_trustlet.py
 
+    ta_paths = []
     for filename in os.listdir(file_chunk_dir):
         if filename.endswith(".mdt"):
             chunk_path = os.path.join(file_chunk_dir, filename)
@@ -50,7 +58,7 @@ def unify_tas(file_chunk_dir: str, fw_out_dir: str):
                 P_OFFSET_OFFSET = 0x8
             else:
                 log.debug("bitness of %s is %s" % (filename, bitness))
-                return
+                return ta_paths
 
             # Reading the ELF header from the ".mdt" file
             mdt = open(os.path.join(chunk_path), "rb")
@@ -97,6 +105,7 @@ def unify_tas(file_chunk_dir: str, fw_out_dir: str):
             with open(mdt_file_path, "wb") as f:
                 f.write(mdt.read())
             mdt.close()
+            ta_paths.append(mdt_file_path)
         if filename.endswith(".mbn"):
             chunk_path = os.path.join(file_chunk_dir, filename)
             filetype = pexpect.run(f"file -b {chunk_path}").decode()
@@ -114,7 +123,44 @@ def unify_tas(file_chunk_dir: str, fw_out_dir: str):
             with open(mdn_file_path, "wb") as f:
                 f.write(mdn.read())
             mdn.close()
+            ta_paths.append(mdn_file_path)
+
+    return ta_paths
+
+
+def dump_non_hlos(non_hlos: BinaryIO, chunk_dir: str) -> List[str]:
+    """Copies the files in /image of the NON-HLOS.bin FAT image to `chunk_dir`, without mounting it. Names are
+    lowercased as the vfat driver shows 8.3 names, which unify_tas relies on."""
+    img_fs = open_filesystem(non_hlos)
+    if img_fs.fstype != FsType.FAT:
+        log.error(f"NON-HLOS.bin isn't a FAT image: {img_fs}")
+        return []
+    chunks = []
+    with img_fs.open_fat() as fat_img:
+        if not fat_img.isdir("image"):
+            log.error("/image not found in NON-HLOS.bin")
+            return []
+        for filename in fat_img.listdir("image"):
+            path = f"image/{filename}"
+            if not fat_img.isfile(path):
+                continue
+            with fat_img.openbin(path) as fi, open(os.path.join(chunk_dir, filename.lower()), "wb") as fo:
+                shutil.copyfileobj(fi, fo)
+            chunks.append(path)
+    return chunks
+
 
+def clear_out_dir(out_dir: str):
+    for f in os.listdir(out_dir):
+        if f.endswith("zip") or f.endswith("rar") or f.endswith("gz"):
+            print("ta dir also has firmware, please check!")
+            exit(0)
+    for f in os.listdir(out_dir):
+        path = os.path.join(out_dir, f)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
 
 
 if __name__ == "__main__":
@@ -123,43 +169,48 @@ if __name__ == "__main__":
                        help='Specify firmware file')
     parser.add_argument("-t", "--tas", action="store_true", help="Get trusted applications from image.")
     parser.add_argument("-o", "--out", required=True, action="store", help="Directory to store outputs.")
+    parser.add_argument("--force", action="store_true",
+                        help="Extract again even if the outputs are up to date with the firmware.")
+    parser.add_argument("--full-digest", action="store_true",
+                        help="Also compare the sha256 of the whole firmware to decide if the outputs are up to date.")
     args = parser.parse_args()
 
-    tmpdir = tempfile.mktemp()
+    options = {"tas": args.tas}
+    if not args.force and extract_cache.is_cached(
+            args.out, args.firmware, EXTRACTOR, EXTRACTOR_VERSION, options, args.full_digest):
+        log.info(f"{args.out} is up to date with {args.firmware}, skipping it")
+        exit(0)
+    if args.force or extract_cache.load_manifest(args.out) is not None:
+        # The outputs are those of another, complete run: redo every stage
+        ledger.reset(args.firmware)
 
     if not os.path.exists(args.out):
         os.makedirs(args.out)
     else:
-        for f in os.listdir(args.out):
-                if f.endswith("zip") or f.endswith("rar") or f.endswith("gz"):
-                    print("ta dir also has firmware, please check!")
-                    exit(0)
-        os.system(f'rm -r {args.out}/*')
-
-    fw_path = os.path.dirname(args.firmware)
-    if args.firmware.endswith(".zip"):
-        os.system(f"unzip -o '{args.firmware}' -d {tmpdir}")
-    if args.firmware.endswith(".rar"):
-        os.system(f"unrar e -op{tmpdir} '{args.firmware}'")
-    if args.firmware.endswith(".gz"):
-        os.system(f"tar xvf '{args.firmware}' --directory {tmpdir}")
-    # why tf do I need this?!?
-    os.system(f"sudo chmod -R 777 {tmpdir}")
-    # firmware-update/NON-HLOS.bin
-    hlos = None
-    for root, dirs, files in os.walk(tmpdir):
-        for f in files:
-            if f == "NON-HLOS.bin":
-                hlos = os.path.join(root, f)
-    if not hlos:
-        print("NON-HLOS.bin not found,please check at: ", tmpdir)
-        exit(-1)
-    hlos_folder = os.path.join(tmpdir, "hlos")
-    os.system(f"mkdir {hlos_folder}")
-    os.system(f"sudo mount -t auto -o ro '{hlos}' {hlos_folder}")
-    os.system(f"mkdir {tmpdir}/chunk_dir")
-    
-    os.system(f"cp -r {os.path.join(hlos_folder, 'image', '*')} {tmpdir}/chunk_dir")
-    unify_tas(f'{tmpdir}/chunk_dir', args.out)
-    os.system(f"sudo umount '{hlos_folder}'")
-    os.system(f"rm -r {tmpdir}")
+        clear_out_dir(args.out)
+
+    # Private per-job workspace, on tmpfs if NON-HLOS.bin and the TA chunks copied out of it fit
+    footprint = 2 * jobs.members_size(args.firmware, lambda f: f == "NON-HLOS.bin")
+    with workspace.job_workspace(footprint) as tmpdir:
+        with ledger.track(args.firmware, EXTRACTOR, "unpack", args.out) as stage:
+            # firmware-update/NON-HLOS.bin, read in place if stored uncompressed
+            hlos = open_members(args.firmware, tmpdir, lambda f: f == "NON-HLOS.bin")
+            if not hlos:
+                stage.fail(f"NON-HLOS.bin not found in {args.firmware}")
+            stage.bytes = sum(ledger.stream_size(image) for _, image in hlos)
+        if stage.error:
+            log.error(stage.error)
+            exit(-1)
+        with ledger.track(args.firmware, EXTRACTOR, "fs-walk", args.out) as stage:
+            chunk_dir = os.path.join(tmpdir, "chunk_dir")
+            os.mkdir(chunk_dir)
+            dump_non_hlos(hlos[0][1], chunk_dir)
+            ta_paths = unify_tas(chunk_dir, args.out)
+            if not ta_paths:
+                stage.fail(f"No TAs found in {args.firmware}")
+            stage.bytes = ledger.tree_size(args.out)
+        if stage.error:
+            # Nothing to cache: the next run extracts again
+            log.error(f"failed to extract TAs from {args.firmware}")
+            exit(-1)
+        extract_cache.record_extraction(args.out, args.firmware, EXTRACTOR, EXTRACTOR_VERSION, options, args.full_digest)
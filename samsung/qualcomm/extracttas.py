@@ -4,7 +4,6 @@ import argparse
 import tempfile
 import os
 import shutil
-import io
 import tarfile
 import logging
 import pexpect
@@ -13,12 +12,12 @@ import fs
 import pprint
 import pyfatfs
 import zipfile
-import lz4
 
 # local imports
-from utils import dump_ext4, utils
-from utils.utils import SPARSE_HEADER_MAGIC
-from utils.simg2img import simg2img
+from utils import dump_ext4, extract_cache, image_cache, jobs, ledger, utils, workspace
+from utils.archive import open_zip_members
+from utils.filesystem import FsType, open_filesystem
+from utils.lz4frame import LZ4FrameFile
 
 # type hinting
 from typing import List, Callable, BinaryIO, Tuple
@@ -34,8 +33,17 @@ log.setLevel(logging.DEBUG)
 # Globals
 ################################################################################
 
-TMP_DIR = tempfile.mkdtemp()
+EXTRACTOR = "samsung/qualcomm"
+# Bump whenever a change to this script changes its output, so cached extractions are redone
+EXTRACTOR_VERSION = 1
+# Memory a job needs for the modem images on top of jobs.BASE_JOB_MEMORY
+IMAGE_PEAK_MEMORY = 512 << 20
+# Workspace a job needs for the modem images and the TA chunks copied out of them
+IMAGE_SCRATCH = 512 << 20
 TA_PARTITIONS = ["modem", "NON-HLOS", "Core_NON-HLOS"]
+# The modem partition is mounted at /vendor/firmware_mnt, its TAs live in
+# image/. The rest of the image is only walked if this has none.
+TA_SEARCH_DIRS = ["/image"]
 
 ################################################################################
 # Script begin (main at bottom)
@@ -62,44 +70,11 @@ def contains_tas(fw_archive_path: str) -> bool:
             ret = True
     return ret
 
-def unlz4(ifp) -> io.BytesIO:
-    """decompresses path, lz4 creates file without .lz4 extenson from path."""
-    # TODO: use lz4.stream
+def unlz4(ifp, tmp_dir: str = None) -> LZ4FrameFile:
+    """Returns a lazily decompressed, seekable view of the LZ4 frames in
+    `ifp`. Decoded data beyond the memory threshold spills to `tmp_dir`."""
     ifp.seek(0)
-    out = lz4.frame.decompress(ifp.read())
-    return io.BytesIO(out)
-
-
-def unzip(
-    zip_path: str, filter_func: Callable[[str], bool], out_dir: str
-) -> List[str]:
-    """Unzip files from archive under `zip_path` using `filter_func` as a
-       filtering function for the files we want to extract.
-
-    Args:
-        zip_path (str): path to the zip archive
-        Callable[[str], bool]: function taking a string argument and returning
-                              `True` or `False` to indicate files we want to
-                              extract.
-        out_dir (str): output directory for the extracted files
-
-    Returns:
-        List[str]: a list of paths to the extracted files.
-    """
-
-    extracted_file_paths = []
-
-    if not zipfile.is_zipfile(zip_path):
-        log.error("{} is no .zip file.".format(zip_path))
-        return None
-
-    with zipfile.ZipFile(zip_path) as zip_ref:
-        files_to_extract = [x for x in zip_ref.namelist() if filter_func(x)]
-        for f in files_to_extract:
-            log.info(f"Adding {f} to analyze queue")
-            zip_ref.extract(f, path=out_dir)
-            extracted_file_paths.append(os.path.join(out_dir, f))
-    return extracted_file_paths
+    return LZ4FrameFile(ifp, tmp_dir=tmp_dir)
 
 
 def get_tar_archives(firmware_path: str) -> List[BinaryIO]:
@@ -109,12 +84,11 @@ def get_tar_archives(firmware_path: str) -> List[BinaryIO]:
         firmware_path (str): path to the firmware archive.
 
     Returns:
-        List(BinaryIO): A list of open file objects.
+        List(BinaryIO): A list of open file objects. Tarballs deflated in a
+                        zip are zipfile.ZipExtFile streams, to be read in one
+                        forward pass.
     """
 
-    # Create temporary dir for files
-    tmp_dir = tempfile.mkdtemp(dir=TMP_DIR)
-
     extracted_files = []
 
     if zipfile.is_zipfile(firmware_path):
@@ -123,11 +97,9 @@ def get_tar_archives(firmware_path: str) -> List[BinaryIO]:
         fw_name = os.path.basename(firmware_path)
         log.info(f"Detected firmware {fw_name} of type ZIPFILE")
 
-        # Extract images from zipfile
-        extracted_file_paths = unzip(firmware_path, contains_tas, tmp_dir)
-        for path in extracted_file_paths:
-            fd = open(path, "rb")
-            extracted_files.append(fd)
+        # Read the tarballs inside the zip, mapped if stored or decompressed
+        # on the fly, instead of unzipping them to disk first
+        extracted_files = open_zip_members(firmware_path, contains_tas)
 
     elif os.path.isdir(firmware_path):
         # If firmware is a folder with an already extracted firmware
@@ -247,7 +219,7 @@ def unify_tas(file_chunk_dir: str, fw_out_dir: str):
             mdn.close()
 
 
-def extract_tas(extracted_images: List[Tuple[str, BinaryIO]], fw_out_dir: str):
+def extract_tas(extracted_images: List[Tuple[str, BinaryIO]], fw_out_dir: str, tmp_dir: str = None):
     """Takes a list of (`image_name`, `fobj`) tuples and extracts all TAs in
        these images to `fw_out_dir`
 
@@ -256,6 +228,7 @@ def extract_tas(extracted_images: List[Tuple[str, BinaryIO]], fw_out_dir: str):
         extracted_images (List[Tuple[str, BinaryIO]]): (`image_name`, `fobj`)
                                                        tuples.
         fw_out_dir (str): output dir
+        tmp_dir (str): directory for the TA chunks copied out of the images
     """
 
     for img_filename, img in extracted_images:
@@ -277,22 +250,27 @@ def extract_tas(extracted_images: List[Tuple[str, BinaryIO]], fw_out_dir: str):
             log.debug(f"Skipping unrelevant image {img_filename}")
             continue
 
-        if img.read(4) == SPARSE_HEADER_MAGIC[::-1]:
-            # If image is sparse image, unsparse
-            extimg = io.BytesIO()
-            simg2img(img, extimg)
-            img = extimg
-
-        img.seek(0)
+        # Read the (possibly sparse) image itself rather than reopening it by name
+        img_fs = open_filesystem(img)
+        if img_fs.fstype != FsType.FAT:
+            log.error(f"Skipping {img_filename}, not a FAT image: {img_fs}")
+            continue
 
-        tmpdir = tempfile.mkdtemp(dir=TMP_DIR)
+        tmpdir = tempfile.mkdtemp(dir=tmp_dir)
 
-        fat_img = fs.open_fs(f"fat://{img_filename}")
+        fat_img = img_fs.open_fat()
         ofs = fs.open_fs(f"osfs://{tmpdir}")
 
         file_patterns = ["*.mdt", "*.MDT", "*.b??", "*.B??", "*.mbn"]
 
-        for img_path in fat_img.walk.files(filter=file_patterns):
+        img_paths = []
+        for search_dir in TA_SEARCH_DIRS:
+            if fat_img.isdir(search_dir):
+                img_paths.extend(fat_img.walk.files(path=search_dir, filter=file_patterns))
+        if not img_paths:
+            img_paths = fat_img.walk.files(filter=file_patterns)
+
+        for img_path in img_paths:
             filename = os.path.basename(img_path)
             fs.copy.copy_file(fat_img, img_path, ofs, filename.lower())
 
@@ -302,7 +280,9 @@ def extract_tas(extracted_images: List[Tuple[str, BinaryIO]], fw_out_dir: str):
     return
 
 
-def extract(firmware_path: str, out_dir: str, tas: bool = False) -> None:
+def extract(
+    firmware_path: str, out_dir: str, tas: bool = False, force: bool = False, full_digest: bool = False
+) -> None:
 
     log.debug(f"extracting {firmware_path}... to {out_dir}")
 
@@ -316,41 +296,99 @@ def extract(firmware_path: str, out_dir: str, tas: bool = False) -> None:
         os.makedirs(fw_out_dir)
     else:
         log.warn("Output dir {} already exist.".format(fw_out_dir))
-    print(fw_out_dir, "!!!")
-
-    tar_archives = get_tar_archives(firmware_path)
-    image_match_rule = lambda x: os.path.basename(x).endswith("modem.img") or os.path.basename(x).endswith("NON-HLOS.bin")
-    extracted_images = list()
-    for f in tar_archives:
-        log.debug(f"Processing tarball {os.path.basename(f.name)}")
-        with tarfile.open(fileobj=f) as tar:
-            files_to_extract = [x for x in tar.getnames() if image_match_rule(x)]
-            for f in files_to_extract:
-                log.info(f"Adding {f} to analyze queue")
-                tar.extract(f, path=fw_out_dir)
-                fd = open(os.path.join(fw_out_dir, f), "rb")
-                extracted_images.append((fd.name, fd))
 
-    
-
-    # create temporary dir for files
-    tmp_dir = tempfile.mkdtemp(dir=TMP_DIR)
-    log.debug(f"tmp dir is {tmp_dir}")
+    options = {"tas": tas}
+    if not force and extract_cache.is_cached(
+        fw_out_dir, firmware_path, EXTRACTOR, EXTRACTOR_VERSION, options, full_digest
+    ):
+        log.info(f"{fw_out_dir} is up to date with {firmware_path}, skipping it")
+        return
+    if force or extract_cache.load_manifest(fw_out_dir) is not None:
+        # The outputs are those of another, complete run: redo every stage
+        ledger.reset(firmware_path)
+    print(fw_out_dir, "!!!")
 
-    extract_tas(extracted_images, fw_out_dir)
+    with workspace.job_workspace(IMAGE_SCRATCH) as tmp_dir:
+        extract_workspace(firmware_path, fw_out_dir, tmp_dir)
 
+    extract_cache.record_extraction(
+        fw_out_dir, firmware_path, EXTRACTOR, EXTRACTOR_VERSION, options, full_digest
+    )
     return
 
 
-def multi_extract(fw_dir, our_dir, tas=False):
+def extract_workspace(firmware_path: str, fw_out_dir: str, tmp_dir: str):
+    """Body of `extract`, the modem images are extracted to the job's `tmp_dir`."""
+    image_match_rule = lambda x: os.path.basename(x).endswith("modem.img") or os.path.basename(x).endswith("NON-HLOS.bin")
+
+    def decode_images():
+        tar_archives = get_tar_archives(firmware_path)
+        extracted_images = list()
+        for f in tar_archives:
+            log.debug(f"Processing tarball {os.path.basename(f.name)}")
+            # Single forward pass, tarballs streamed out of a zip can't seek back
+            streamed = isinstance(f, zipfile.ZipExtFile)
+            with tarfile.open(fileobj=f, mode="r|" if streamed else "r") as tar:
+                for tm in tar:
+                    if not image_match_rule(tm.name):
+                        continue
+                    log.info(f"Adding {tm.name} to analyze queue")
+                    tar.extract(tm, path=tmp_dir)
+                    fd = open(os.path.join(tmp_dir, tm.name), "rb")
+                    extracted_images.append((tm.name, fd))
+        return extracted_images
+
+    with ledger.track(firmware_path, EXTRACTOR, "unpack", fw_out_dir) as stage:
+        # The extracted images are kept across runs if the image cache is enabled
+        extracted_images = image_cache.cached_images(firmware_path, f"{EXTRACTOR}:untar", decode_images)
+        stage.bytes = sum(ledger.stream_size(fobj) for _, fobj in extracted_images if fobj is not None)
+
+    # The TAs are unified straight into fw_out_dir, an earlier run that got
+    # past this stage left them there
+    if not ledger.completed(firmware_path, ["fs-walk"], fw_out_dir):
+        with ledger.track(firmware_path, EXTRACTOR, "fs-walk", fw_out_dir) as stage:
+            extract_tas(extracted_images, fw_out_dir, tmp_dir)
+            stage.bytes = ledger.tree_size(fw_out_dir)
+
+
+def estimate_memory(firmware_path: str) -> int:
+    """Peak memory of `extract`, for `multi_extract` with several jobs: the
+    modem images are extracted to the job's workspace, only their FAT
+    metadata is read."""
+    return jobs.BASE_JOB_MEMORY + IMAGE_PEAK_MEMORY
+
+
+def multi_extract(
+    fw_dir,
+    our_dir,
+    tas=False,
+    force=False,
+    full_digest=False,
+    n_jobs=1,
+    memory_budget=None,
+    summary=None,
+):
     fw_paths = [
         os.path.join(fw_dir, fw_name)
         for fw_name in os.listdir(fw_dir)
         if fw_name.endswith(".zip")
     ]
 
-    for fw_path in fw_paths:
-        extract(fw_path, our_dir, tas)
+    if n_jobs <= 1:
+        for fw_path in fw_paths:
+            extract(fw_path, our_dir, tas, force, full_digest)
+        return
+
+    if not os.path.exists(our_dir):
+        os.makedirs(our_dir)
+    jobs.run_jobs(
+        extract,
+        [(fw_path, our_dir, tas, force, full_digest) for fw_path in fw_paths],
+        estimate_memory,
+        n_jobs,
+        None if memory_budget is None else int(memory_budget * (1 << 30)),
+        summary or os.path.join(our_dir, "extract_summary.json"),
+    )
 
 
 def setup_args():
@@ -387,6 +425,35 @@ def setup_args():
         action="store",
         help="Directory to store outputs.",
     )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Extract again even if the outputs are up to date with the firmware.",
+    )
+    parser.add_argument(
+        "--full-digest",
+        action="store_true",
+        help="Also compare the sha256 of the whole firmware to decide if the outputs are up to date.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="With --multi, extract this many firmware images in parallel.",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        help="With --jobs, GiB of memory the parallel extractions may use together "
+        "(default: 80%% of the available memory).",
+    )
+    parser.add_argument(
+        "--summary",
+        action="store",
+        help="With --jobs, JSON file tracking the progress, timings and failures "
+        "(default: extract_summary.json in the output directory).",
+    )
     return parser
 
 
@@ -396,9 +463,18 @@ def main():
     args = arg_parser.parse_args()
 
     if args.firmware:
-        extract(args.firmware, args.out, args.tas)
+        extract(args.firmware, args.out, args.tas, args.force, args.full_digest)
     elif args.firmware_dir:
-        multi_extract(args.firmware_dir, args.out, args.tas)
+        multi_extract(
+            args.firmware_dir,
+            args.out,
+            args.tas,
+            args.force,
+            args.full_digest,
+            args.jobs,
+            args.memory_budget,
+            args.summary,
+        )
     else:
         arg_parser.print_help()
 
@@ -1,20 +1,16 @@
 #!/usr/bin/env python
 import sys
 import argparse
-import tempfile
 import os
-import shutil
 import zipfile
 import tarfile
 import logging
-import io
-import lz4.frame
 
 # local imports
-from utils import dump_ext4, utils
-from utils.utils import SPARSE_HEADER_MAGIC
-from utils.simg2img import simg2img
-from utils import lpunpack
+from utils import extract_cache, image_cache, jobs, ledger, utils, workspace
+from utils.archive import open_zip_members, spool_member, tar_member_window
+from utils.filesystem import FsType, open_filesystem
+from utils.lz4frame import LZ4FrameFile
 import sboot2mclf
 
 # type hinting
@@ -32,8 +28,25 @@ log.setLevel(logging.DEBUG)
 # Globals
 ################################################################################
 
-TMP_DIR = tempfile.mkdtemp()
+EXTRACTOR = "samsung/teegris"
+# Bump whenever a change to this script changes its output, so cached extractions are redone
+EXTRACTOR_VERSION = 1
+# Memory a job needs at most per AP/BL tarball, see estimate_memory
+TARBALL_PEAK_MEMORY = 1 << 30
 TA_PARTITIONS = ["system", "vendor", "super"]
+# Where TAs live inside the images (relative to the image root): mcRegistry up
+# to galaxy s9, tee from galaxy s10 on. Everything else is only walked if none
+# of these yields a TA.
+TA_SEARCH_DIRS = [
+    "app/mcRegistry",
+    "vendor/app/mcRegistry",
+    "system/app/mcRegistry",
+    "system/vendor/app/mcRegistry",
+    "tee",
+    "vendor/tee",
+    "system/tee",
+    "system/vendor/tee",
+]
 VERBOSE = True
 
 ################################################################################
@@ -57,44 +70,11 @@ def unsuper(super_file_path, out_dir):
     return
 
 
-def unlz4(ifp) -> io.BytesIO:
-    """decompresses path, lz4 creates file without .lz4 extenson from path."""
-    # TODO: use lz4.stream
+def unlz4(ifp, tmp_dir: str = None) -> LZ4FrameFile:
+    """Returns a lazily decompressed, seekable view of the LZ4 frames in
+    `ifp`. Decoded data beyond the memory threshold spills to `tmp_dir`."""
     ifp.seek(0)
-    out = lz4.frame.decompress(ifp.read())
-    return io.BytesIO(out)
-
-
-def unzip(
-    zip_path: str, filter_func: Callable[[str], bool], out_dir: str
-) -> List[str]:
-    """Unzip files from archive under `zip_path` using `filter_func` as a
-       filtering function for the files we want to extract.
-
-    Args:
-        zip_path (str): path to the zip archive
-        Callable[[str], bool]: function taking a string argument and returning
-                              `True` or `False` to indicate files we want to
-                              extract.
-        out_dir (str): output directory for the extracted files
-
-    Returns:
-        List[str]: a list of paths to the extracted files.
-    """
-
-    extracted_file_paths = []
-
-    if not zipfile.is_zipfile(zip_path):
-        log.error("{} is no .zip file.".format(zip_path))
-        return None
-
-    with zipfile.ZipFile(zip_path) as zip_ref:
-        files_to_extract = [x for x in zip_ref.namelist() if filter_func(x)]
-        for f in files_to_extract:
-            log.info(f"Adding {f} to analyze queue")
-            zip_ref.extract(f, path=out_dir)
-            extracted_file_paths.append(os.path.join(out_dir, f))
-    return extracted_file_paths
+    return LZ4FrameFile(ifp, tmp_dir=tmp_dir)
 
 
 def contains_tas(fw_archive_path: str) -> bool:
@@ -125,12 +105,11 @@ def get_tar_archives(firmware_path: str) -> List[BinaryIO]:
         firmware_path (str): path to the firmware archive.
 
     Returns:
-        List(BinaryIO): A list of open file objects.
+        List(BinaryIO): A list of open file objects. Tarballs deflated in a
+                        zip are zipfile.ZipExtFile streams, to be read in one
+                        forward pass.
     """
 
-    # Create temporary dir for files
-    tmp_dir = tempfile.mkdtemp(dir=TMP_DIR)
-
     extracted_files = []
 
     if zipfile.is_zipfile(firmware_path):
@@ -139,11 +118,9 @@ def get_tar_archives(firmware_path: str) -> List[BinaryIO]:
         fw_name = os.path.basename(firmware_path)
         log.info(f"Detected firmware {fw_name} of type ZIPFILE")
 
-        # Extract images from zipfile
-        extracted_file_paths = unzip(firmware_path, contains_tas, tmp_dir)
-        for path in extracted_file_paths:
-            fd = open(path, "rb")
-            extracted_files.append(fd)
+        # Read the tarballs inside the zip, mapped if stored or decompressed
+        # on the fly, instead of unzipping them to disk first
+        extracted_files = open_zip_members(firmware_path, contains_tas)
 
     elif os.path.isdir(firmware_path):
         # If firmware is a folder with an already extracted firmware
@@ -160,11 +137,44 @@ def get_tar_archives(firmware_path: str) -> List[BinaryIO]:
     return extracted_files
 
 
-def extract_images(files: List[BinaryIO]) -> List[Tuple[str, BinaryIO]]:
+def is_image_member(member_name: str) -> bool:
+    """Does tar member `member_name` hold an image `extract` looks at?
+
+    Those are the `TA_PARTITIONS` images, boot.img (startup.tzar) and
+    sboot.bin, possibly lz4 compressed. Decided from the name alone, so that
+    no data of the other members is read.
+
+    Args:
+        member_name (str): name of a member of an AP/BL tarball.
+
+    Returns:
+        bool: `True` if `extract` uses the member, `False` otherwise.
+    """
+    name = os.path.basename(member_name)
+    if name.endswith(".lz4"):
+        name = name[:-4]
+    if name.startswith("boot.img") or name.startswith("sboot.bin"):
+        return True
+    return name.endswith(".img") and any([(x in name) for x in TA_PARTITIONS])
+
+
+def extract_images(
+    files: List[BinaryIO],
+    filter_func: Callable[[str], bool] = is_image_member,
+    tmp_dir: str = None,
+) -> List[Tuple[str, BinaryIO]]:
     """Extract relevant images from `files`.
 
+    Each tarball is scanned once, in order, reading only the member headers:
+    members rejected by `filter_func` are seeked over, the others are returned
+    as mmap windows into the tarball (lz4 members decompress on read).
+    Tarballs streamed out of a zip can't be seeked back into, so the selected
+    members are copied to spooled temporary files during the scan instead.
+
     Args:
         files (List[BinaryIO]): list of open file objects.
+        filter_func (Callable[[str], bool]): selects members by name.
+        tmp_dir (str): directory of the spooled members and lz4 spill files.
 
     Returns:
         List[BinaryIO]: list of file objects of relevant images
@@ -173,15 +183,24 @@ def extract_images(files: List[BinaryIO]) -> List[Tuple[str, BinaryIO]]:
     extracted_images = list()
     for f in files:
         log.debug(f"Processing tarball {os.path.basename(f.name)}")
-        with tarfile.open(fileobj=f) as tf:
+        streamed = isinstance(f, zipfile.ZipExtFile)
+        with tarfile.open(fileobj=f, mode="r|" if streamed else "r") as tf:
             for tm in tf:
+                if not tm.isfile() or not filter_func(tm.name):
+                    log.debug(f"Skipping {tm.name}")
+                    continue
                 log.debug(f"Extracting {tm.name} from tarball")
-                ef = tf.extractfile(tm)
+                if streamed:
+                    ef = spool_member(tf.extractfile(tm), tmp_dir)
+                else:
+                    ef = tar_member_window(tf, tm)
+                    if ef is None:
+                        ef = tf.extractfile(tm)
                 en = tm.name
 
                 # first extract from lz4 if necessary
                 if tm.name.endswith(".lz4"):
-                    ef = unlz4(ef)
+                    ef = unlz4(ef, tmp_dir)
                     en = en[:-4]
 
                 extracted_images.append((en, ef))
@@ -202,25 +221,26 @@ def extract_from_super_image(super_img: BinaryIO) -> List[Tuple[str, BinaryIO]]:
 
     extracted_images = list()
 
-    # If image is sparse image, unsparse
-    if super_img.read(4) == SPARSE_HEADER_MAGIC[::-1]:
-        extimg = io.BytesIO()
-        simg2img(super_img, extimg)
-        super_img = extimg
-
-    super_img.seek(0)
+    # Unsparses the super image if needed
+    super_fs = open_filesystem(super_img)
+    if super_fs.fstype != FsType.SUPER:
+        log.error(f"Not a super image: {super_fs}")
+        return extracted_images
 
-    extracted_images.append(
-        ("system.img", lpunpack.LpUnpack(super_img, "system").unpack())
-    )
-    extracted_images.append(
-        ("vendor.img", lpunpack.LpUnpack(super_img, "vendor").unpack())
-    )
+    super_image = super_fs.open_super()
+    for name in ["system", "vendor"]:
+        if name not in super_image:
+            log.debug(f"Partition {name} not found in super image")
+            continue
+        extracted_images.append((f"{name}.img", super_image.open(name)))
     return extracted_images
 
 
-def extract_tas(extracted_images: List[Tuple[str, BinaryIO]], fw_out_dir: str):
+def extract_tas(extracted_images: List[Tuple[str, BinaryIO]], fw_out_dir: str) -> int:
+    """Dumps the TAs of the system and vendor images to `fw_out_dir`/tas,
+    returns how many were found."""
 
+    n_tas = 0
     for img_filename, img in extracted_images:
         if img is None:
             log.debug(f"Skipping NULL file {img_filename}")
@@ -240,44 +260,28 @@ def extract_tas(extracted_images: List[Tuple[str, BinaryIO]], fw_out_dir: str):
             log.debug(f"Skipping unrelevant image {img_filename}")
             continue
 
-        if img.read(4) == SPARSE_HEADER_MAGIC[::-1]:
-            # If image is sparse image, unsparse
-            extimg = io.BytesIO()
-            simg2img(img, extimg)
-            img = extimg
-
-        img.seek(0)
-
-        tmpdir = tempfile.mkdtemp()
+        # ext4 or erofs, sparse or not
+        img_fs = open_filesystem(img)
+        if img_fs.fstype not in (FsType.EXT4, FsType.EROFS):
+            log.error(f"Skipping {img_filename}, unsupported image {img_fs}")
+            continue
 
         # TODO: is this regex correct to find TAs?
-        dump_ext4.dump_folder(
-            img,
-            "",
-            tmpdir,
+        # up to galaxy s9: *.tlbin, galaxy s10: *-0000-0000-0000-*
+        tas_dstdir = os.path.join(fw_out_dir, "tas")
+        ta_paths = img_fs.dump_files(
+            tas_dstdir,
             file_regex=[".*-0000-0000-0000-.*", ".*\.tlbin"],
+            search_dirs=TA_SEARCH_DIRS,
+            flat=True,
         )
 
-        # up to galaxy s9
-        ta_paths = utils.find_files(tmpdir, "*.tlbin")
-        # galaxy s10
-        ta_paths_s10 = utils.find_files(tmpdir, "*-0000-0000-0000-*")
-
-        if ta_paths or ta_paths_s10:
-            tas_dstdir = os.path.join(fw_out_dir, "tas")
-            if not os.path.exists(tas_dstdir):
-                os.mkdir(tas_dstdir)
-            for ta_path in ta_paths + ta_paths_s10:
-                shutil.copy(ta_path, tas_dstdir)
-                pathfile = os.path.join(
-                    tas_dstdir, os.path.basename(ta_path) + "_origpath.txt"
-                )
-                with open(pathfile, "w") as pf:
-                    pf.write(os.path.normpath(ta_path.lstrip(tmpdir)))
-                    pf.write("\n")
+        if ta_paths:
+            utils.update_ta_manifest(tas_dstdir, ta_paths)
+            n_tas += len(ta_paths)
         else:
-            log.error("Could not find TAs in {} ({})".format(img, tmpdir))
-        shutil.rmtree(tmpdir)
+            log.error("Could not find TAs in {}".format(img_filename))
+    return n_tas
 
 
 def extract_sboot(sboot: BinaryIO, out_dir: str):
@@ -331,12 +335,11 @@ def extract_bootimg(bootimg: BinaryIO, out_dir: str):
             taf.write(ta.read())
 
 
-def extract(firmware_path, out_dir, tas=False):
+def extract(firmware_path, out_dir, tas=False, force=False, full_digest=False):
 
     # normalize fw path
     firmware_path = os.path.normpath(firmware_path)
     log.debug(f"Extracting {firmware_path}...")
-    breakpoint()
     if not os.path.exists(out_dir):
         log.warning("Output dir {} does not exist. Creating...".format(out_dir))
         os.mkdir(out_dir)
@@ -346,18 +349,55 @@ def extract(firmware_path, out_dir, tas=False):
     if not os.path.isdir(fw_out_dir):
         os.mkdir(fw_out_dir)
 
-    if not os.path.exists(TMP_DIR):
-        os.mkdir(TMP_DIR)
+    options = {"tas": tas}
+    if not force and extract_cache.is_cached(
+        fw_out_dir, firmware_path, EXTRACTOR, EXTRACTOR_VERSION, options, full_digest
+    ):
+        log.info(f"{fw_out_dir} is up to date with {firmware_path}, skipping it")
+        return
+    if force or extract_cache.load_manifest(fw_out_dir) is not None:
+        # The outputs are those of another, complete run: redo every stage
+        ledger.reset(firmware_path)
+
+    with workspace.job_workspace(estimate_scratch(firmware_path)) as tmp_dir:
+        complete = extract_workspace(firmware_path, fw_out_dir, tas, tmp_dir)
+    if not complete:
+        # Missing or incomplete TAs: neither the extraction cache nor the ledger may skip them next time
+        return
+    extract_cache.record_extraction(
+        fw_out_dir, firmware_path, EXTRACTOR, EXTRACTOR_VERSION, options, full_digest
+    )
+
 
-    # get relevant tar archives from `firmware_path`
-    tar_archives = get_tar_archives(firmware_path)
-    extracted_images = extract_images(tar_archives)
+def extract_workspace(firmware_path: str, fw_out_dir: str, tas: bool, tmp_dir: str) -> bool:
+    """Body of `extract`, spilling temporary files to the job's `tmp_dir`.
+    Returns False if a stage failed."""
+    tar_archives = []
+    complete = True
+
+    def decode_images():
+        # get relevant tar archives from `firmware_path`
+        tar_archives.extend(get_tar_archives(firmware_path))
+        extracted_images = extract_images(tar_archives, tmp_dir=tmp_dir)
+
+        # replace the super image by its system and vendor partitions
+        for idx, (name, fobj) in enumerate(extracted_images):
+            if name == "super.img":
+                del extracted_images[idx]
+                extracted_images.extend(extract_from_super_image(fobj))
+                break
+        return extracted_images
+
+    with ledger.track(firmware_path, EXTRACTOR, "unpack", fw_out_dir) as stage:
+        # decompressed images and super partitions are kept across runs if the image cache is enabled
+        extracted_images = image_cache.cached_images(
+            firmware_path, f"{EXTRACTOR}:unlz4,super(system,vendor)", decode_images
+        )
+        stage.bytes = sum(ledger.stream_size(fobj) for _, fobj in extracted_images if fobj is not None)
 
     sboot = None
     bootimg = None
-    super_img_idx = None
-    for idx, name_fobj in enumerate(extracted_images):
-        name, fobj = name_fobj
+    for name, fobj in extracted_images:
 
         # Find sboot
         if name.startswith("sboot.bin"):
@@ -367,45 +407,82 @@ def extract(firmware_path, out_dir, tas=False):
         if name.startswith("boot.img"):
             bootimg = fobj
 
-        # find super image if it exists
-        if name == "super.img":
-            super_img_idx = idx
-
-    if super_img_idx is not None:
-        _, fobj = extracted_images[super_img_idx]
-        del extracted_images[super_img_idx]
-        extracted_images.extend(extract_from_super_image(fobj))
-
-    if tas:
-        extract_tas(extracted_images, fw_out_dir)
-
-        if sboot:
-            extract_sboot(sboot, fw_out_dir)
-
-        if bootimg:
-            # extract startup.tzar
-            extract_bootimg(bootimg, fw_out_dir)
+    # Stages done by an earlier, failed run already wrote their TAs to fw_out_dir
+    if tas and not ledger.completed(firmware_path, ["fs-walk"], fw_out_dir):
+        with ledger.track(firmware_path, EXTRACTOR, "fs-walk", fw_out_dir) as stage:
+            if extract_tas(extracted_images, fw_out_dir) == 0:
+                stage.fail(f"No TAs found in {firmware_path}")
+            stage.bytes = ledger.tree_size(os.path.join(fw_out_dir, "tas"))
+        complete = stage.error is None
+
+    if tas and not ledger.completed(firmware_path, ["ta-copy"], fw_out_dir):
+        with ledger.track(firmware_path, EXTRACTOR, "ta-copy", fw_out_dir) as stage:
+            if sboot:
+                extract_sboot(sboot, fw_out_dir)
+
+            if bootimg:
+                # extract startup.tzar
+                extract_bootimg(bootimg, fw_out_dir)
+            stage.bytes = ledger.tree_size(os.path.join(fw_out_dir, "tas_sboot")) + ledger.tree_size(
+                os.path.join(fw_out_dir, "startup_tzar")
+            )
 
     for f in tar_archives:
         # close fobj and delete tarball if we unpacked to out dir
         f.close()
+    return complete
         #if out_dir in f.name:
         #    os.unlink(f.name)
 
-    # delete temporary dir
-    shutil.rmtree(TMP_DIR)
-    return
 
+def estimate_memory(firmware_path: str) -> int:
+    """Peak memory of `extract`, for `multi_extract` with several jobs: the
+    images are mapped or streamed, so an AP/BL tarball costs at most its
+    spooled members and lz4 block caches, TARBALL_PEAK_MEMORY."""
+    members = jobs.archive_members(firmware_path) or {}
+    return jobs.BASE_JOB_MEMORY + sum(
+        min(size, TARBALL_PEAK_MEMORY) for name, size in members.items() if contains_tas(name)
+    )
+
+
+def estimate_scratch(firmware_path: str) -> int:
+    """Bytes `extract` may write to its workspace: the selected members of
+    streamed tarballs and the lz4 images decoded beyond the memory threshold,
+    at most the AP/BL tarballs decompressed."""
+    return jobs.COMPRESSED_EXPANSION * jobs.members_size(firmware_path, contains_tas)
 
-def multi_extract(fw_dir, our_dir, tas=False):
+
+def multi_extract(
+    fw_dir,
+    our_dir,
+    tas=False,
+    force=False,
+    full_digest=False,
+    n_jobs=1,
+    memory_budget=None,
+    summary=None,
+):
     fw_paths = [
         os.path.join(fw_dir, fw_name)
         for fw_name in os.listdir(fw_dir)
         if fw_name.endswith(".zip")
     ]
 
-    for fw_path in fw_paths:
-        extract(fw_path, our_dir, tas)
+    if n_jobs <= 1:
+        for fw_path in fw_paths:
+            extract(fw_path, our_dir, tas, force, full_digest)
+        return
+
+    if not os.path.exists(our_dir):
+        os.makedirs(our_dir)
+    jobs.run_jobs(
+        extract,
+        [(fw_path, our_dir, tas, force, full_digest) for fw_path in fw_paths],
+        estimate_memory,
+        n_jobs,
+        None if memory_budget is None else int(memory_budget * (1 << 30)),
+        summary or os.path.join(our_dir, "extract_summary.json"),
+    )
 
 
 def setup_args():
@@ -442,6 +519,35 @@ def setup_args():
         action="store",
         help="Directory to store outputs.",
     )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Extract again even if the outputs are up to date with the firmware.",
+    )
+    parser.add_argument(
+        "--full-digest",
+        action="store_true",
+        help="Also compare the sha256 of the whole firmware to decide if the outputs are up to date.",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="With --multi, extract this many firmware images in parallel.",
+    )
+    parser.add_argument(
+        "--memory-budget",
+        type=float,
+        help="With --jobs, GiB of memory the parallel extractions may use together "
+        "(default: 80%% of the available memory).",
+    )
+    parser.add_argument(
+        "--summary",
+        action="store",
+        help="With --jobs, JSON file tracking the progress, timings and failures "
+        "(default: extract_summary.json in the output directory).",
+    )
     return parser
 
 
@@ -451,9 +557,18 @@ def main():
     args = arg_parser.parse_args()
 
     if args.firmware:
-        extract(args.firmware, args.out, args.tas)
+        extract(args.firmware, args.out, args.tas, args.force, args.full_digest)
     elif args.firmware_dir:
-        multi_extract(args.firmware_dir, args.out, args.tas)
+        multi_extract(
+            args.firmware_dir,
+            args.out,
+            args.tas,
+            args.force,
+            args.full_digest,
+            args.jobs,
+            args.memory_budget,
+            args.summary,
+        )
     else:
         arg_parser.print_help()
 
@@ -0,0 +1 @@
+"""Corpus-wide entry point: `python -m spill run`, see utils/corpus.py."""
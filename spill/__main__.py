@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+import argparse
+import logging
+import os
+import sys
+
+from data.config import fw_path
+from utils import corpus
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+def setup_args():
+    """Argument parser setup."""
+    parser = argparse.ArgumentParser(prog="python -m spill")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser(
+        "run",
+        help="Extract and parse the TAs of every firmware in the dataset.",
+    )
+    run.add_argument(
+        "--fw-path",
+        default=fw_path,
+        help=f"Root of the <vendor>/<model>[/<region>]/<version> tree (default: {fw_path}).",
+    )
+    run.add_argument(
+        "--vendor",
+        action="append",
+        dest="vendors",
+        help="Only process this vendor, can be repeated.",
+    )
+    run.add_argument(
+        "--device",
+        action="append",
+        dest="devices",
+        help="Only process this device (model), can be repeated.",
+    )
+    run.add_argument(
+        "--force",
+        action="store_true",
+        help="Extract and parse again even if the outputs are up to date.",
+    )
+    run.add_argument(
+        "--no-parse",
+        action="store_false",
+        dest="parse",
+        help="Only extract the TAs.",
+    )
+    run.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=os.cpu_count(),
+        help="Firmware processed in parallel (default: all cores).",
+    )
+    run.add_argument(
+        "--memory-budget",
+        type=float,
+        help="GiB the parallel jobs may use (default: 80%% of the available memory).",
+    )
+    run.add_argument(
+        "--summary",
+        action="store",
+        help="JSON file with the status, timing and error of every firmware "
+        "(default: corpus_summary.json in --fw-path).",
+    )
+    run.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="List the firmware and their pipelines without running anything.",
+    )
+    return parser
+
+
+def main():
+    args = setup_args().parse_args()
+
+    if args.dry_run:
+        for version_dir, vendor, key in corpus.discover(args.fw_path, args.vendors, args.devices):
+            firmware = corpus.find_firmware(version_dir, corpus.PIPELINES[key])
+            print(f"{key}\t{version_dir}\t{firmware or '-'}")
+        return
+
+    counts = corpus.run_corpus(
+        args.fw_path,
+        args.vendors,
+        args.devices,
+        args.force,
+        args.parse,
+        args.jobs,
+        None if args.memory_budget is None else int(args.memory_budget * (1 << 30)),
+        args.summary or os.path.join(args.fw_path, "corpus_summary.json"),
+    )
+    if counts["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+import os
+import shutil
+import subprocess
+
+import pytest
+
+from utils import dump_ext4
+
+pytestmark = pytest.mark.skipif(shutil.which("mke2fs") is None, reason="needs mke2fs")
+
+
+@pytest.fixture
+def system_img(tmp_path):
+    """ext4 image laid out like a system partition: system/vendor is a symlink
+    to /vendor, the TAs are in system/app/mcRegistry."""
+    root = tmp_path / "root"
+    (root / "system" / "app" / "mcRegistry").mkdir(parents=True)
+    (root / "system" / "app" / "mcRegistry" / "07010000000000000000000000000000.tlbin").write_bytes(b"TA")
+    os.symlink("/vendor", root / "system" / "vendor")
+    img = tmp_path / "system.img"
+    subprocess.check_call(["mke2fs", "-q", "-t", "ext4", "-b", "4096", "-d", str(root), str(img), "8M"])
+    with open(img, "rb") as f:
+        yield f
+
+
+def test_search_root_below_symlink_is_skipped(system_img):
+    found = dump_ext4.search_files(
+        system_img, [r".*\.tlbin"], ["system/vendor/app/mcRegistry", "system/app/mcRegistry"], fallback=False
+    )
+    assert [path for path, _ in found] == ["system/app/mcRegistry/07010000000000000000000000000000.tlbin"]
+
+
+def test_only_symlinked_roots_fall_back_to_full_walk(system_img):
+    found = dump_ext4.search_files(system_img, [r".*\.tlbin"], ["system/vendor/app/mcRegistry"])
+    assert [path for path, _ in found] == ["system/app/mcRegistry/07010000000000000000000000000000.tlbin"]
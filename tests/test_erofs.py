@@ -0,0 +1,60 @@
+import struct
+
+import pytest
+
+from utils import erofs
+from bench.erofs_lz4 import BLOCK_SIZE, S_IFDIR, S_IFREG, inode_v1, make_super_block
+
+NAMES = sorted(b"ta_%05d.tlbin" % i for i in range(5000))
+
+
+def make_dir_blocks(names):
+    """Sorted dirents of `names` (all pointing at nid 1) packed into 4 KiB blocks."""
+    blocks, block_names = [], []
+
+    def flush():
+        nameoff = 12 * len(block_names)
+        dirents = b""
+        for name in block_names:
+            dirents += struct.pack("<QHBB", 1, nameoff, erofs.FileType.EROFS_FT_REG_FILE.value, 0)
+            nameoff += len(name)
+        blocks.append(dirents + b"".join(block_names))
+
+    for name in names:
+        if 12 * (len(block_names) + 1) + sum(map(len, block_names)) + len(name) > BLOCK_SIZE:
+            flush()
+            block_names = []
+        block_names.append(name)
+    flush()
+    return blocks
+
+
+@pytest.fixture
+def big_dir():
+    """EROFS image whose root is an EROFS_INODE_FLAT_PLAIN directory spanning many blocks."""
+    blocks = make_dir_blocks(NAMES)
+    dir_size = BLOCK_SIZE * (len(blocks) - 1) + len(blocks[-1])
+    meta = inode_v1(S_IFDIR, erofs.DataMappingMode.EROFS_INODE_FLAT_PLAIN.value, dir_size, 2, 1)
+    meta += inode_v1(S_IFREG, erofs.DataMappingMode.EROFS_INODE_FLAT_PLAIN.value, 0, 0, 2)
+    image = make_super_block(2 + len(blocks), 1, 0) + meta.ljust(BLOCK_SIZE, b"\0")
+    image += b"".join(block.ljust(BLOCK_SIZE, b"\0") for block in blocks)
+    return erofs.Erofs(image).root_inode, len(blocks)
+
+
+def test_find_dirent_only_reads_probed_blocks(big_dir):
+    root, num_blocks = big_dir
+    assert root.get_num_dir_blocks() == num_blocks > 30
+    read = []
+    get_dir_block = root.get_dir_block
+    root.get_dir_block = lambda i: read.append(i) or get_dir_block(i)
+
+    assert root.find_dirent(NAMES[1234]).filename == NAMES[1234]
+    assert len(set(read)) <= num_blocks.bit_length()
+    assert root.find_dirent(b"ta_01234.tlbin.missing") is None
+    assert root.find_dirent(b"a") is None
+
+
+def test_dirents_match_lookup(big_dir):
+    root, _ = big_dir
+    assert [dirent.filename for dirent in root.dirents] == NAMES
+    assert all(root.find_dirent(name).filename == name for name in NAMES[::97])
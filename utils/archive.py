@@ -0,0 +1,266 @@
+import io
+import logging
+import mmap
+import os
+import shutil
+import struct
+import subprocess
+import tarfile
+import tempfile
+import zipfile
+from typing import BinaryIO, Callable, List, Optional, Tuple
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+# Member data kept in memory by `spool_member` before it moves to disk
+DEFAULT_SPOOL_MEMORY = 256 << 20
+# Offsets of the name and extra field lengths in zipfile.structFileHeader
+ZIP_FH_FILENAME_LENGTH = 10
+ZIP_FH_EXTRA_FIELD_LENGTH = 11
+
+
+class MappedWindow(io.RawIOBase):
+    """Read-only, seekable file object over a byte range of a mapped file,
+    e.g. a member stored uncompressed in a tarball or a zip. Reads copy only
+    what they return and `getbuffer` exposes the range without any copy, so
+    nested readers (sparse, super, ext4, EROFS, FAT) run straight over the
+    original download.
+
+    Use `map_file_range` or `MappedWindow.window` to create one.
+    """
+
+    def __init__(self, buf: memoryview, name: str, mm: mmap.mmap = None):
+        self.buf = buf
+        self.name = name
+        self.mmap = mm
+        self.size = len(buf)
+        self.cursor = 0
+
+    def window(self, offset: int, size: int, name: str) -> "MappedWindow":
+        """Sub-range of this window, sharing its mapping."""
+        if offset + size > self.size:
+            raise ValueError(f"{name}: 0x{offset:x}+0x{size:x} is past the end of {self.name}")
+        return MappedWindow(self.buf[offset : offset + size], name)
+
+    def getbuffer(self) -> memoryview:
+        return self.buf
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.cursor
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.cursor
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise OSError(22, "Invalid argument")
+        self.cursor = offset
+        return self.cursor
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.cursor
+        data = bytes(self.buf[self.cursor : self.cursor + size])
+        self.cursor += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.buf[self.cursor : self.cursor + len(b)]
+        b[: len(data)] = data
+        self.cursor += len(data)
+        return len(data)
+
+    def close(self):
+        if self.mmap is not None:
+            try:
+                self.buf.release()
+                self.mmap.close()
+            except BufferError:
+                # Sub-windows or getbuffer() views are still alive, unmapped once they are collected
+                pass
+        super().close()
+
+
+def map_file_range(fileobj: BinaryIO, offset: int, size: int, name: str = None) -> Optional[MappedWindow]:
+    """Maps `size` bytes at `offset` of the file behind `fileobj`, or returns
+    None if `fileobj` is not a plain file (a compressed stream, a tar member
+    sharing its parent's descriptor, ...). Windows are sliced, not remapped.
+
+    Returns:
+        Optional[MappedWindow]: the window, None if the range can't be mapped.
+    """
+    name = name or getattr(fileobj, "name", repr(fileobj))
+    if isinstance(fileobj, MappedWindow):
+        return fileobj.window(offset, size, name)
+    # tarfile.ExFileObject is a BufferedReader over its tarball's descriptor
+    if not isinstance(fileobj, (io.BufferedReader, io.FileIO)) or isinstance(fileobj, tarfile.ExFileObject):
+        return None
+    if size == 0:
+        return MappedWindow(memoryview(b""), name)
+    start = offset - offset % mmap.ALLOCATIONGRANULARITY
+    mm = mmap.mmap(fileobj.fileno(), offset - start + size, access=mmap.ACCESS_READ, offset=start)
+    return MappedWindow(memoryview(mm)[offset - start :], name, mm)
+
+
+def tar_member_window(tf: tarfile.TarFile, member: tarfile.TarInfo) -> Optional[MappedWindow]:
+    """Window over the data of a regular member of an uncompressed tarball,
+    None if it isn't a contiguous range of a plain file (compressed tarball,
+    sparse member)."""
+    if not member.isfile() or member.issparse():
+        return None
+    return map_file_range(tf.fileobj, member.offset_data, member.size, member.name)
+
+
+def zip_member_window(zf: zipfile.ZipFile, info: zipfile.ZipInfo) -> Optional[MappedWindow]:
+    """Window over the data of a ZIP_STORED, unencrypted entry of `zf`, None
+    for any other entry."""
+    if info.is_dir() or info.compress_type != zipfile.ZIP_STORED or info.flag_bits & 0x1:
+        return None
+    # The data follows the local file header, whose extra field may differ from the central directory's
+    zf.fp.seek(info.header_offset)
+    fheader = struct.unpack(zipfile.structFileHeader, zf.fp.read(zipfile.sizeFileHeader))
+    if fheader[0] != zipfile.stringFileHeader:
+        raise zipfile.BadZipFile(f"Bad local file header for {info.filename}")
+    offset = (
+        info.header_offset
+        + zipfile.sizeFileHeader
+        + fheader[ZIP_FH_FILENAME_LENGTH]
+        + fheader[ZIP_FH_EXTRA_FIELD_LENGTH]
+    )
+    return map_file_range(zf.fp, offset, info.file_size, info.filename)
+
+
+def open_zip_members(zip_path: str, predicate: Callable[[str], bool]) -> List[BinaryIO]:
+    """Opens the entries of `zip_path` whose name satisfies `predicate`
+    without extracting them: stored entries as MappedWindows, compressed ones
+    as ZipFile.open() streams, which decompress as they are read (seeking
+    backwards restarts them, so read them in one forward pass).
+
+    Returns:
+        List[BinaryIO]: open file objects named after their entries.
+    """
+    opened = []
+    with zipfile.ZipFile(zip_path) as zf:
+        for info in zf.infolist():
+            if info.is_dir() or not predicate(info.filename):
+                continue
+            log.info(f"Opening {info.filename} in {os.path.basename(zip_path)}")
+            window = zip_member_window(zf, info)
+            # The entry keeps the zip file open after zf is closed
+            opened.append(window if window is not None else zf.open(info))
+    return opened
+
+
+def spool_member(fileobj: BinaryIO, tmp_dir: str = None, max_memory: int = DEFAULT_SPOOL_MEMORY) -> BinaryIO:
+    """Copies a member of a streamed archive to a seekable temporary file,
+    held in memory up to `max_memory` bytes and written to `tmp_dir` past it."""
+    spool = tempfile.SpooledTemporaryFile(max_size=max_memory, dir=tmp_dir)
+    shutil.copyfileobj(fileobj, spool, 1 << 20)
+    spool.seek(0)
+    return spool
+
+
+def extract_members(
+    archive_path: str, dest: str, predicate: Callable[[str], bool]
+) -> List[str]:
+    """Extracts the regular files of a zip, tar(.gz) or rar firmware archive
+    whose basename satisfies `predicate` into `dest`, flattened like
+    `unrar e`. Nothing else in the archive is written to disk.
+
+    Args:
+        archive_path (str): firmware archive.
+        dest (str): existing output directory.
+        predicate (Callable[[str], bool]): called with each member basename.
+
+    Returns:
+        List[str]: paths of the extracted files, in archive order.
+    """
+    extracted = []
+
+    def extract(name, fi):
+        out_path = os.path.join(dest, name)
+        log.debug(f"Extracting {name} from {archive_path}")
+        with open(out_path, "wb") as fo:
+            shutil.copyfileobj(fi, fo, 1 << 20)
+        if out_path not in extracted:
+            extracted.append(out_path)
+
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as zf:
+            for info in zf.infolist():
+                name = os.path.basename(info.filename)
+                if not info.is_dir() and predicate(name):
+                    with zf.open(info) as fi:
+                        extract(name, fi)
+    elif archive_path.endswith(".rar"):
+        listing = subprocess.run(
+            ["unrar", "lb", archive_path], capture_output=True, check=True
+        )
+        members = [
+            x for x in listing.stdout.decode().splitlines() if predicate(os.path.basename(x))
+        ]
+        if members:
+            subprocess.run(
+                ["unrar", "e", "-o+", "-idq", archive_path, *members, dest + os.sep],
+                check=True,
+            )
+            for member in members:
+                out_path = os.path.join(dest, os.path.basename(member))
+                if os.path.isfile(out_path) and out_path not in extracted:
+                    extracted.append(out_path)
+    elif tarfile.is_tarfile(archive_path):
+        # Iterate in stream order so compressed tarballs are read only once
+        with tarfile.open(archive_path, "r|*") as tf:
+            for member in tf:
+                name = os.path.basename(member.name)
+                if member.isfile() and predicate(name):
+                    extract(name, tf.extractfile(member))
+    else:
+        raise ValueError(f"Unsupported firmware archive: {archive_path}")
+    return extracted
+
+
+def open_members(
+    archive_path: str, dest: str, predicate: Callable[[str], bool]
+) -> List[Tuple[str, BinaryIO]]:
+    """Same selection as `extract_members`, but returns open file objects:
+    members stored uncompressed (plain tar, ZIP_STORED) are mapped in place
+    and only the others are extracted to `dest`.
+
+    Returns:
+        List[Tuple[str, BinaryIO]]: (basename, file object) of the members.
+    """
+    opened = []
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as zf:
+            for info in zf.infolist():
+                name = os.path.basename(info.filename)
+                if info.is_dir() or not predicate(name):
+                    continue
+                window = zip_member_window(zf, info)
+                if window is None:
+                    # extract() sanitizes the name (leading "/", "..", drive letters), open what it wrote
+                    window = open(zf.extract(info, dest), "rb")
+                opened.append((name, window))
+        return opened
+    if not archive_path.endswith(".rar") and tarfile.is_tarfile(archive_path):
+        try:
+            with open(archive_path, "rb") as fi, tarfile.open(fileobj=fi, mode="r:") as tf:
+                return [
+                    (os.path.basename(m.name), tar_member_window(tf, m))
+                    for m in tf
+                    if m.isfile() and not m.issparse() and predicate(os.path.basename(m.name))
+                ]
+        except tarfile.ReadError:
+            # Compressed tarball, decompress the members instead
+            pass
+    return [(os.path.basename(path), open(path, "rb")) for path in extract_members(archive_path, dest, predicate)]
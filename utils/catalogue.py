@@ -0,0 +1,192 @@
+import datetime
+import json
+import logging
+import os
+import sqlite3
+from typing import Dict, List, Optional
+
+from data.config import catalogue_path, devices, fw_path
+from utils.parse_report import TA, get_date, get_tas
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+# Bump when parse_report changes what it reads out of a version directory,
+# every version is then parsed again
+CATALOGUE_VERSION = 1
+# Seconds a process waits for another one holding the database lock
+BUSY_TIMEOUT = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS catalogue_versions (
+    path TEXT PRIMARY KEY,
+    dev_dir TEXT NOT NULL,
+    version TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    date TEXT NOT NULL,
+    fingerprint TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS catalogue_versions_dev_dir ON catalogue_versions (dev_dir, date, position);
+CREATE TABLE IF NOT EXISTS catalogue_tas (
+    path TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    rollback_counter,
+    filepath TEXT,
+    device TEXT,
+    PRIMARY KEY (path, idx)
+);
+"""
+
+
+def _mtime_ns(path: str) -> Optional[int]:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def fingerprint(version_p: str, tee: str) -> str:
+    """What the TAs and date of a version directory are parsed from: the
+    reports, and the directories parse_report lists to find the TA files."""
+    version = os.path.basename(version_p)
+    inputs = [
+        os.path.join(version_p, "report.json"),
+        os.path.join(version_p, "metadata.json"),
+        version_p,
+        os.path.join(version_p, "tas"),
+        os.path.join(version_p, version),
+        os.path.join(version_p, version, "tas"),
+    ]
+    return json.dumps([CATALOGUE_VERSION, tee] + [_mtime_ns(path) for path in inputs])
+
+
+class Catalogue:
+    """SQLite catalogue of the parsed TAs (see parse_report.TA) and dates of
+    the firmware versions below fw_path, so that fw_repo doesn't load every
+    report.json and metadata.json again on each analysis run.
+
+    A device directory is refreshed before it is queried: versions whose
+    reports or TA directories changed mtime (see `fingerprint`) are parsed
+    again, vanished ones dropped, the others only cost a few stat calls.
+
+    Args:
+        path (str): database file, created if needed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._pid = None
+        self._connect()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Connections can't be shared with forked workers
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+            self._pid = os.getpid()
+        return self._conn
+
+    def refresh(self, vendor: str, device: str, region: str = None) -> str:
+        """Brings the versions of a device (and region) up to date with the
+        directories below fw_path.
+
+        Returns:
+            str: the device directory, key of its versions in the catalogue.
+        """
+        dev_p = os.path.join(fw_path, vendor, device)
+        if region:
+            dev_p = os.path.join(dev_p, region)
+        tee = devices[vendor][device]
+        conn = self._connect()
+        known = {
+            path: (fp, position)
+            for path, fp, position in conn.execute(
+                "SELECT path, fingerprint, position FROM catalogue_versions WHERE dev_dir = ?", (dev_p,)
+            )
+        }
+
+        changed = []
+        moved = []
+        # The listing order breaks ties between versions of the same date, as the scan used to
+        for position, version in enumerate(os.listdir(dev_p)):
+            version_p = os.path.join(dev_p, version)
+            fp = fingerprint(version_p, tee)
+            old = known.pop(version_p, None)
+            if old is None or old[0] != fp:
+                changed.append((position, version, version_p, fp))
+            elif old[1] != position:
+                moved.append((position, version_p))
+        if not (changed or moved or known):
+            return dev_p
+
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for path in list(known) + [version_p for _, _, version_p, _ in changed]:
+                conn.execute("DELETE FROM catalogue_versions WHERE path = ?", (path,))
+                conn.execute("DELETE FROM catalogue_tas WHERE path = ?", (path,))
+            for position, version_p in moved:
+                conn.execute("UPDATE catalogue_versions SET position = ? WHERE path = ?", (position, version_p))
+            for position, version, version_p, fp in changed:
+                report = os.path.join(version_p, "report.json")
+                date = get_date(report, tee, vendor)
+                tas = get_tas(report, tee, vendor, date)
+                conn.execute(
+                    "INSERT INTO catalogue_versions (path, dev_dir, version, position, date, fingerprint)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    (version_p, dev_p, version, position, date.isoformat(), fp),
+                )
+                conn.executemany(
+                    "INSERT INTO catalogue_tas (path, idx, name, rollback_counter, filepath, device)"
+                    " VALUES (?, ?, ?, ?, ?, ?)",
+                    [
+                        (version_p, idx, ta.name, ta.rollback_counter, ta.filepath, ta.device)
+                        for idx, ta in enumerate(tas)
+                    ],
+                )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        log.debug(f"Catalogue of {dev_p}: {len(changed)} versions parsed, {len(known)} dropped")
+        return dev_p
+
+    def get_all_tas(self, vendor: str, device: str, region: str = None) -> Dict[str, List[TA]]:
+        """fw_repo.get_all_tas out of the catalogue: {version: [TAs]} of the
+        versions with TAs, ordered by date. Of versions with the same date,
+        the last one listed wins."""
+        dev_p = self.refresh(vendor, device, region)
+        tee = devices[vendor][device]
+        rows = self._connect().execute(
+            "SELECT v.version, v.date, t.name, t.rollback_counter, t.filepath, t.device"
+            " FROM catalogue_versions v JOIN catalogue_tas t ON t.path = v.path"
+            " WHERE v.dev_dir = ? ORDER BY v.date, v.position, t.idx",
+            (dev_p,),
+        )
+        date2info = {}
+        for version, date, name, rollback_counter, filepath, ta_device in rows:
+            info = date2info.get(date)
+            if info is None or info[0] != version:
+                info = date2info[date] = (version, [], datetime.datetime.fromisoformat(date))
+            info[1].append(TA(name, rollback_counter, filepath, vendor, tee, info[2], ta_device))
+        return {version: tas for version, tas, _ in date2info.values()}
+
+
+_default_catalogue = None
+
+
+def default_catalogue() -> Optional[Catalogue]:
+    """The Catalogue at `catalogue_path` of data/config.py, None if it is
+    disabled or can't be opened."""
+    global _default_catalogue
+    if _default_catalogue is None:
+        _default_catalogue = False
+        if catalogue_path:
+            try:
+                _default_catalogue = Catalogue(catalogue_path)
+            except sqlite3.Error as e:
+                log.warning(f"Dataset catalogue disabled, can't use {catalogue_path}: {e}")
+    return _default_catalogue or None
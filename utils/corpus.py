@@ -0,0 +1,223 @@
+import logging
+import os
+import subprocess
+import sys
+from collections import namedtuple
+from typing import List, Optional, Tuple
+
+from data.config import devices, fw_path, samsung_mtk
+from utils import extract_cache, jobs, ledger
+from utils.fw_repo import vendor_has_region
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# Memory of a firmware job beyond jobs.BASE_JOB_MEMORY, the extractors map or
+# stream their archives so it doesn't grow much past this with the archive size
+FIRMWARE_PEAK_MEMORY = 2 << 30
+# Lines of a failed script's output kept in the error of its job
+ERROR_TAIL_LINES = 40
+
+# Arguments of the parse scripts, formatted with the paths of the firmware:
+# {version} is the version directory, {out} the extractor's output directory
+SAMSUNG_PARSE_ARGS = ["-t", "{out}", "-j", "{version}/report.json"]
+DIR_PARSE_ARGS = ["-d", "-p", "{out}", "-o", "{version}"]
+
+# extractor/parser are relative to the repo root. out_arg is what the
+# extractor gets as -o, out the directory it writes the TAs and its
+# extraction.json to, both formatted with {version}, {name} (basename of the
+# version directory), {archive} (basename of the firmware) and {base}: the
+# version directory for unpacked firmware, {version}/{name} for archives, so
+# that outputs named after the archive can't collide with it. Beanpod has no
+# rollback counters, so its TAs aren't parsed.
+Pipeline = namedtuple("Pipeline", "extractor out_arg out parser parse_args archives unpacked")
+
+PIPELINES = {
+    "samsung/kinibi": Pipeline(
+        "samsung/kinibi/extracttas.py", "{base}", "{base}/{archive}",
+        "samsung/kinibi/parse.py", SAMSUNG_PARSE_ARGS, (".zip",), True),
+    "samsung/teegris": Pipeline(
+        "samsung/teegris/extracttas.py", "{version}/{name}", "{version}/{name}",
+        "samsung/teegris/parse.py", SAMSUNG_PARSE_ARGS, (".zip",), True),
+    "samsung/qualcomm": Pipeline(
+        "samsung/qualcomm/extracttas.py", "{base}", "{base}/{archive}",
+        "samsung/qualcomm/parse.py", DIR_PARSE_ARGS, (".zip",), True),
+    "xiaomi/mediatek": Pipeline(
+        "xiaomi/mediatek/extracttas.py", "{version}", "{version}/{name}",
+        None, None, (".tgz",), False),
+    "xiaomi/qualcomm": Pipeline(
+        "xiaomi/qualcomm/extracttas.py", "{version}", "{version}/{name}",
+        "xiaomi/qualcomm/parse.py", DIR_PARSE_ARGS, (".tgz",), False),
+    "oppo/kinibi": Pipeline(
+        "other_vendors/oppo/mtk_kinibi_extracttas.py", "{version}/tas", "{version}/tas",
+        "other_vendors/oppo/mtk_kinibi_parse.py", DIR_PARSE_ARGS, (".zip", ".rar"), False),
+    "oppo/qualcomm": Pipeline(
+        "other_vendors/oppo/qc_extracttas.py", "{version}/tas", "{version}/tas",
+        "other_vendors/oppo/qc_parse.py", DIR_PARSE_ARGS, (".zip", ".rar"), False),
+    "vivo/kinibi": Pipeline(
+        "other_vendors/vivo/mtk_kinibi_extracttas.py", "{version}/tas", "{version}/tas",
+        "other_vendors/vivo/mtk_kinibi_parse.py", DIR_PARSE_ARGS, (".zip", ".rar"), False),
+    "vivo/qualcomm": Pipeline(
+        "other_vendors/vivo/qc_extracttas.py", "{version}/tas", "{version}/tas",
+        "other_vendors/vivo/qc_parse.py", DIR_PARSE_ARGS, (".zip", ".rar"), False),
+    "transsien/mediatek": Pipeline(
+        "other_vendors/transsien/mtk_bp_extracttas.py", "{version}/tas", "{version}/tas",
+        None, None, (".zip", ".rar"), False),
+}
+
+# Tecno and Infinix are Transsion brands
+VENDOR_PIPELINES = {"tecno": "transsien", "infinix": "transsien"}
+
+
+def resolve_pipeline(vendor: str, device: str) -> Optional[str]:
+    """Key of the PIPELINES entry for a device of `data/config.devices`, None
+    if there is no extractor for its TEE. Samsung's MediaTek devices
+    (`samsung_mtk`) run TEEgris."""
+    tee = devices[vendor][device]
+    if vendor == "samsung" and device in samsung_mtk:
+        tee = "teegris"
+    key = f"{VENDOR_PIPELINES.get(vendor, vendor)}/{tee}"
+    return key if key in PIPELINES else None
+
+
+def find_firmware(version_dir: str, pipeline: Pipeline) -> Optional[str]:
+    """The firmware archive in `version_dir`, or `version_dir` itself if it
+    holds the unpacked AP/BL tarballs of a Samsung firmware."""
+    names = sorted(os.listdir(version_dir))
+    for name in names:
+        if name.endswith(pipeline.archives) and os.path.isfile(os.path.join(version_dir, name)):
+            return os.path.join(version_dir, name)
+    if pipeline.unpacked and any(name[:3] in ("AP_", "BL_") and ".tar" in name for name in names):
+        return version_dir
+    return None
+
+
+def _subdirs(path: str) -> List[str]:
+    if not os.path.isdir(path):
+        return []
+    return sorted(name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name)))
+
+
+def discover(
+    root: str = fw_path, vendors: List[str] = None, device_names: List[str] = None
+) -> List[Tuple[str, str, str]]:
+    """Every `<vendor>/<model>[/<region>]/<version>` directory below `root`
+    whose device is in `data/config.devices` and has a pipeline.
+
+    Returns:
+        List[Tuple[str, str, str]]: (version dir, vendor, pipeline key).
+    """
+    found = []
+    for vendor in devices:
+        if vendors and vendor not in vendors:
+            continue
+        for device in devices[vendor]:
+            if device_names and device not in device_names:
+                continue
+            key = resolve_pipeline(vendor, device)
+            if key is None:
+                log.warning(f"No pipeline for {vendor}/{device} ({devices[vendor][device]}), skipping it")
+                continue
+            device_dir = os.path.join(root, vendor, device)
+            if vendor_has_region(vendor):
+                model_dirs = [os.path.join(device_dir, region) for region in _subdirs(device_dir)]
+            else:
+                model_dirs = [device_dir]
+            for model_dir in model_dirs:
+                for version in _subdirs(model_dir):
+                    found.append((os.path.join(model_dir, version), vendor, key))
+    return found
+
+
+def _run_script(script: str, args: List[str]):
+    """Runs one of the repo's scripts the way the README does, raising with
+    the end of its output if it fails."""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [REPO_ROOT, env.get("PYTHONPATH")]))
+    cmd = [sys.executable, os.path.join(REPO_ROOT, script), *args]
+    proc = subprocess.run(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if proc.returncode != 0:
+        tail = proc.stdout.decode(errors="replace").splitlines()[-ERROR_TAIL_LINES:]
+        raise RuntimeError(f"{' '.join(cmd)} exited with {proc.returncode}:\n" + "\n".join(tail))
+
+
+def run_firmware(version_dir: str, key: str, force: bool = False, parse: bool = True):
+    """Extracts, then parses, the TAs of the firmware in `version_dir` with
+    pipeline `key`. The extractors skip firmware whose outputs are up to
+    date, and parsing is skipped when report.json is newer than the
+    extraction."""
+    pipeline = PIPELINES[key]
+    firmware = find_firmware(version_dir, pipeline)
+    if firmware is None:
+        log.warning(f"No firmware for {key} in {version_dir}, skipping it")
+        return
+    name = os.path.basename(version_dir)
+    paths = {
+        "version": version_dir,
+        "name": name,
+        "archive": os.path.basename(os.path.normpath(firmware)),
+        "base": version_dir if firmware == version_dir else os.path.join(version_dir, name),
+    }
+    out_dir = pipeline.out.format(**paths)
+
+    log.info(f"Extracting {firmware} with {key}")
+    extract_args = ["-t", "-f", firmware, "-o", pipeline.out_arg.format(**paths)]
+    _run_script(pipeline.extractor, extract_args + (["--force"] if force else []))
+
+    if not parse or pipeline.parser is None:
+        return
+    report = os.path.join(version_dir, "report.json")
+    manifest = os.path.join(out_dir, extract_cache.CACHE_MANIFEST)
+    if (
+        not force
+        and os.path.exists(report)
+        and os.path.exists(manifest)
+        and os.path.getmtime(report) >= os.path.getmtime(manifest)
+    ):
+        log.info(f"{report} is up to date, skipping parsing")
+        return
+    log.info(f"Parsing the TAs in {out_dir}")
+    with ledger.track(firmware, key, "parse", report) as stage:
+        _run_script(pipeline.parser, [arg.format(out=out_dir, **paths) for arg in pipeline.parse_args])
+        stage.bytes = ledger.tree_size(out_dir)
+
+
+def estimate_memory(version_dir: str) -> int:
+    """Peak memory of `run_firmware`, for `run_corpus` with several jobs: grows
+    with the size of the firmware up to FIRMWARE_PEAK_MEMORY."""
+    size = 0
+    for name in os.listdir(version_dir):
+        path = os.path.join(version_dir, name)
+        if os.path.isfile(path):
+            size += os.path.getsize(path)
+    return jobs.BASE_JOB_MEMORY + min(size, FIRMWARE_PEAK_MEMORY)
+
+
+def run_corpus(
+    root: str = fw_path,
+    vendors: List[str] = None,
+    device_names: List[str] = None,
+    force: bool = False,
+    parse: bool = True,
+    n_jobs: int = None,
+    memory_budget: int = None,
+    summary_path: str = None,
+):
+    """Runs `run_firmware` on every firmware `discover` finds, as one batch of
+    `n_jobs` processes (all cores by default) scheduled by `jobs.run_jobs`.
+
+    Returns:
+        Dict[str, int]: number of firmware per final status ("ok", "failed").
+    """
+    firmware = discover(root, vendors, device_names)
+    log.info(f"Found {len(firmware)} firmware versions in {root}")
+    return jobs.run_jobs(
+        run_firmware,
+        [(version_dir, key, force, parse) for version_dir, _, key in firmware],
+        estimate_memory,
+        n_jobs or os.cpu_count(),
+        memory_budget,
+        summary_path,
+    )
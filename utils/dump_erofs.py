@@ -3,12 +3,12 @@ import utils.erofs as erofs
 import os.path
 import re
 
+from typing import Iterator, List, Tuple
+
 VERBOSE = True
 
 # Usage: dump_folder(open("/tmp/test.img", "rb"), "system", "/tmp/test")
 
-# TODO: support erofs, EROFS_INODE_FLAT_COMPRESSION
-
 def dump_folder(img: BufferedReader, dump_path_str: str, dest: str, file_regex = None):
     img.seek(0)
     dumped_files = 0 
@@ -66,4 +66,67 @@ def dump_folder(img: BufferedReader, dump_path_str: str, dest: str, file_regex =
             fi = f[1].get_data()
             fo.write(fi)
             fo.close()
-    return dumped_files
\ No newline at end of file
+    return dumped_files
+
+
+def _walk_files(v: erofs.Erofs, path: str, inode_obj: erofs.DirInode) -> Iterator[Tuple[str, erofs.DirEnt]]:
+    """Yields (path, dirent) of every regular file below `inode_obj`, loading directory inodes only."""
+    dir_queue = [ ( path, inode_obj ) ]
+    while len(dir_queue) > 0:
+        dir_path, dir_inode = dir_queue.pop()
+        for dirent in dir_inode.dirents:
+            if dirent.filename in [b".", b".."]:
+                continue
+            entry_path = os.path.join( dir_path, dirent.filename.decode() )
+            if dirent.file_type == erofs.FileType.EROFS_FT_DIR:
+                dir_queue.append( ( entry_path, v.get_inode(dirent.nid, dirent.file_type) ) )
+            elif dirent.file_type == erofs.FileType.EROFS_FT_REG_FILE:
+                yield entry_path, dirent
+
+
+def search_files(img: BufferedReader, file_regex: List[str], search_dirs: List[str] = None, fallback: bool = True) -> Iterator[Tuple[str, erofs.RegFileInode]]:
+    """Yields (path, inode) of the regular files whose basename matches any of `file_regex`, looking only below
+    `search_dirs` (paths relative to the image root, missing ones are skipped). Walks the whole image only if
+    `search_dirs` is None or, unless `fallback` is False, nothing matched below them."""
+    img.seek(0)
+    v = erofs.Erofs(img)
+    file_regex = [ re.compile(x) for x in file_regex ]
+
+    def matches(roots):
+        seen = set()
+        for root in roots:
+            try:
+                root_inode = v.get_file(root.encode()) if root.strip("/") else v.root_inode
+            except (FileNotFoundError, ValueError):
+                continue
+            if not isinstance(root_inode, erofs.DirInode):
+                continue
+            for path, dirent in _walk_files(v, root.strip("/"), root_inode):
+                if path in seen:
+                    continue
+                if any([ x.match(os.path.basename(path)) for x in file_regex ]):
+                    seen.add(path)
+                    yield path, v.get_inode(dirent.nid, dirent.file_type)
+
+    found = False
+    if search_dirs is not None:
+        for match in matches(search_dirs):
+            found = True
+            yield match
+    if not found and (fallback or search_dirs is None):
+        yield from matches([""])
+
+
+def dump_files(img: BufferedReader, dest: str, file_regex: List[str], search_dirs: List[str] = None, flat: bool = False, fallback: bool = True) -> List[str]:
+    """Writes the files found by `search_files` to `dest`, keeping their path inside the image but creating only the
+    directories leading to them. With `flat`, files are written straight into `dest` under their basename. Returns the
+    image paths of the dumped files."""
+    dumped = []
+    for path, inode_obj in search_files(img, file_regex, search_dirs, fallback):
+        out_path = os.path.join( dest, os.path.basename(path) if flat else path )
+        os.makedirs( os.path.dirname(out_path), exist_ok = True )
+        if VERBOSE: print(f"Copying file { out_path } ")
+        with open( out_path, "wb" ) as fo:
+            fo.write( inode_obj.get_data() )
+        dumped.append(path)
+    return dumped
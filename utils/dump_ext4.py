@@ -2,6 +2,9 @@ from io import BufferedReader
 import utils.ext4 as ext4
 import os.path
 import re
+import shutil
+
+from typing import Iterator, List, Tuple
 
 VERBOSE = True
 
@@ -18,15 +21,8 @@ def dump_folder(
         dump_path = dump_path_str.split("/")
     v = ext4.Volume(img, offset=0)
 
-    # Navigate the directory tree
-    inode_obj = v.root
-    for e in dump_path:
-        inodes = [f[1] for f in inode_obj.open_dir() if f[0] == e]
-        if len(inodes) == 0:
-            raise FileNotFoundError
-        assert len(inodes) == 1
-        inode = inodes[0]
-        inode_obj = v.get_inode(inode)
+    # Navigate the directory tree (hash tree directories are looked up by name hash)
+    inode_obj = v.root.get_inode(*dump_path)
 
     # Create dest directory
     os.makedirs(os.path.join(dest, dump_path_str), exist_ok=True)
@@ -67,3 +63,99 @@ def dump_folder(
             fi = f[1].open_read()
             fo.write(fi.read())
             fo.close()
+
+
+def _walk_files(
+    v: ext4.Volume, path: str, inode_obj: ext4.Inode
+) -> Iterator[Tuple[str, int, int]]:
+    """Yields (path, inode index, file type) of every non-directory entry below
+    `inode_obj`. Directories are told apart by their entry's file type, so the
+    inodes of non-directories are never read here."""
+    dir_queue = [(path, inode_obj)]
+    while len(dir_queue) > 0:
+        dir_path, dir_inode = dir_queue.pop()
+        for name, inode_idx, file_type in dir_inode.open_dir():
+            if name in [".", ".."]:
+                continue
+            entry_path = os.path.join(dir_path, name)
+            if file_type == ext4.InodeType.UNKNOWN:
+                # no filetype feature, look at the inode itself
+                child = v.get_inode(inode_idx)
+                if child.is_dir:
+                    dir_queue.append((entry_path, child))
+                elif child.is_file:
+                    yield entry_path, inode_idx, ext4.InodeType.FILE
+            elif file_type == ext4.InodeType.DIRECTORY:
+                dir_queue.append((entry_path, v.get_inode(inode_idx)))
+            else:
+                yield entry_path, inode_idx, file_type
+
+
+def search_files(
+    img: BufferedReader,
+    file_regex: List[str],
+    search_dirs: List[str] = None,
+    fallback: bool = True,
+) -> Iterator[Tuple[str, ext4.Inode]]:
+    """Yields (path, inode) of the regular files whose basename matches any of
+    `file_regex`, looking only below `search_dirs` (paths relative to the image
+    root, missing ones are skipped). Walks the whole image only if `search_dirs`
+    is None or, unless `fallback` is False, nothing matched below them.
+
+    Usage: search_files(img, [".*\\.tlbin"], ["app/mcRegistry", "system/app/mcRegistry"])
+    """
+    img.seek(0)
+    v = ext4.Volume(img, offset=0)
+    file_regex = [re.compile(x) for x in file_regex]
+
+    def matches(roots):
+        seen = set()
+        for root in roots:
+            try:
+                root_inode = v.root.get_inode(*[x for x in root.split("/") if x])
+            except (FileNotFoundError, ext4.Ext4Error):
+                # missing, or below a symlink (e.g. system/vendor -> /vendor)
+                continue
+            if not root_inode.is_dir:
+                continue
+            for path, inode_idx, file_type in _walk_files(v, root.strip("/"), root_inode):
+                if file_type != ext4.InodeType.FILE or path in seen:
+                    continue
+                if any([x.match(os.path.basename(path)) for x in file_regex]):
+                    seen.add(path)
+                    yield path, v.get_inode(inode_idx)
+
+    found = False
+    if search_dirs is not None:
+        for match in matches(search_dirs):
+            found = True
+            yield match
+    if not found and (fallback or search_dirs is None):
+        yield from matches([""])
+
+
+def dump_files(
+    img: BufferedReader,
+    dest: str,
+    file_regex: List[str],
+    search_dirs: List[str] = None,
+    flat: bool = False,
+    fallback: bool = True,
+) -> List[str]:
+    """Writes the files found by `search_files` to `dest`, keeping their path
+    inside the image but creating only the directories leading to them. With
+    `flat`, files are written straight into `dest` under their basename.
+
+    Returns:
+        List[str]: image paths of the dumped files.
+    """
+    dumped = []
+    for path, inode_obj in search_files(img, file_regex, search_dirs, fallback):
+        out_path = os.path.join(dest, os.path.basename(path) if flat else path)
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        if VERBOSE:
+            print(f"Copying file {out_path}")
+        with open(out_path, "wb") as fo:
+            shutil.copyfileobj(inode_obj.open_read(), fo)
+        dumped.append(path)
+    return dumped
@@ -25,15 +25,24 @@ import mmap
 import os
 
 import construct
+from collections import namedtuple
 from construct import Struct, Int32ul, Int16ul, Int8ul, Int64ul, Array, Union
 from enum import Enum
-from typing import List, Set
+from typing import Iterator, List, Set
 import subprocess
 from io import BytesIO
+import io
 import math
+import struct
 import sys
+import zlib
 from stat import S_IFLNK, S_IFDIR, S_IFREG, S_IFMT
 
+try:
+    import lz4.block
+except ImportError:
+    lz4 = None
+
 
 # Parser for Huawei EROFS filesystem, used on some new models.
 # Supported by Linux Kernel 4.19 and later
@@ -144,7 +153,9 @@ struct_erofs_super = Struct(
     "xattr_blkaddr" / Int32ul,
     "uuid" / Array(16, Int8ul),
     "volume_name" / Array(16, Int8ul),
-    "reserved2" / Array(48, Int8ul)
+    "feature_incompat" / Int32ul,
+    "u1" / Int16ul,
+    "reserved2" / Array(42, Int8ul)
 )
 assert struct_erofs_super.sizeof() == 128, struct_erofs_super.sizeof()
 
@@ -173,6 +184,12 @@ struct_erofs_inode_v1 = Struct(
 )
 assert struct_erofs_inode_v1.sizeof() == 32, struct_erofs_inode_v1.sizeof()
 
+# The construct definitions are kept for debugging, hot paths unpack with precompiled struct.Struct formats into
+# namedtuples carrying the same field names
+erofs_inode_v1 = namedtuple("erofs_inode_v1", [subcon.name for subcon in struct_erofs_inode_v1.subcons])
+fast_erofs_inode_v1 = struct.Struct("<HHHHIIIIHHI")
+assert fast_erofs_inode_v1.size == struct_erofs_inode_v1.sizeof()
+
 
 class FileType(Enum):
     EROFS_FT_UNKNOWN = 0
@@ -195,12 +212,16 @@ struct_erofs_dirent = Struct(
 )
 assert struct_erofs_dirent.sizeof() == 12, struct_erofs_dirent.sizeof()
 
+erofs_dirent = namedtuple("erofs_dirent", [subcon.name for subcon in struct_erofs_dirent.subcons])
+fast_erofs_dirent = struct.Struct("<QHBB")
+assert fast_erofs_dirent.size == struct_erofs_dirent.sizeof()
+
 
 class DecompressIndexType(Enum):
     Z_EROFS_VLE_CLUSTER_TYPE_PLAIN = 0
     Z_EROFS_VLE_CLUSTER_TYPE_HEAD = 1
     Z_EROFS_VLE_CLUSTER_TYPE_NONHEAD = 2
-    Z_EROFS_VLE_CLUSTER_TYPE_RESERVED = 3
+    Z_EROFS_VLE_CLUSTER_TYPE_RESERVED = 3  # Z_EROFS_LCLUSTER_TYPE_HEAD2 (second algorithm) in newer images
 
 
 # noinspection PyUnresolvedReferences
@@ -214,27 +235,126 @@ struct_z_erofs_vle_decompressed_index = Struct(
 )
 assert recursive_union_sizeof(struct_z_erofs_vle_decompressed_index) == 8
 
+# di_advise, di_clusterofs, di_u.blkaddr (di_u.delta is blkaddr & 0xffff, blkaddr >> 16)
+fast_z_erofs_vle_decompressed_index = struct.Struct("<HHI")
+assert fast_z_erofs_vle_decompressed_index.size == recursive_union_sizeof(struct_z_erofs_vle_decompressed_index)
+
 
 # noinspection PyUnresolvedReferences
 struct_z_erofs_map_header = Struct(
-    "h_reserved1" / Int32ul,
+    "h_reserved1" / Int16ul,
+    "h_idata_size" / Int16ul,
     "h_advise" / Int16ul,
     "h_algorithmtype" / Int8ul,
     "h_clusterbits" / Int8ul
 )
 
 
+EROFS_FEATURE_INCOMPAT_ZERO_PADDING = 0x00000001
+
+# h_advise of struct z_erofs_map_header
+Z_EROFS_ADVISE_COMPACTED_2B = 0x0001
+Z_EROFS_ADVISE_BIG_PCLUSTER_1 = 0x0002
+Z_EROFS_ADVISE_BIG_PCLUSTER_2 = 0x0004
+Z_EROFS_ADVISE_INLINE_PCLUSTER = 0x0008
+Z_EROFS_ADVISE_INTERLACED_PCLUSTER = 0x0010
+Z_EROFS_ADVISE_FRAGMENT_PCLUSTER = 0x0020
+Z_EROFS_FRAGMENT_INODE_BIT = 7
+
+# NONHEAD delta[0] of the lcluster following a HEAD carries the compressed block count (big pclusters)
+Z_EROFS_LI_D0_CBLKCNT = 1 << 11
+
+Z_EROFS_COMPRESSION_LZ4 = 0
+Z_EROFS_COMPRESSION_DEFLATE = 2
+
+
+class BufferView:
+    """
+    Slices of a memoryview (BytesIO buffer, bytearray, ...) as bytes, so that Erofs can use it like an mmap without
+    copying the whole image.
+    """
+    def __init__(self, buf: memoryview):
+        self.buf = buf
+
+    def __len__(self):
+        return len(self.buf)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return bytes(self.buf[key])
+        return self.buf[key]
+
+
+class StreamView:
+    """
+    Slices of a seekable stream (SparseImage, PartitionView, ...) read on demand, so that Erofs can use it like an
+    mmap without reading the whole stream into memory.
+    """
+    def __init__(self, stream):
+        self.stream = stream
+        self.size = stream.seek(0, os.SEEK_END)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self[key:key + 1][0]
+        start, stop, step = key.indices(self.size)
+        if step != 1:
+            raise ValueError("StreamView does not support extended slices")
+        if stop <= start:
+            return b""
+        self.stream.seek(start)
+        parts = []
+        remaining = stop - start
+        while remaining > 0:
+            part = self.stream.read(remaining)
+            if not part:
+                break
+            parts.append(part)
+            remaining -= len(part)
+        return b"".join(parts)
+
+
+def map_stream(stream):
+    """
+    Returns an mmap-like (sliceable) view of a seekable stream: the buffer of a BytesIO or MappedWindow, an mmap of a
+    regular file or a StreamView otherwise. The stream is never read in full.
+    """
+    if hasattr(stream, "getbuffer"):
+        return BufferView(stream.getbuffer())
+    size = stream.seek(0, os.SEEK_END)
+    try:
+        fd = stream.fileno()
+        # Only map streams that are the whole file, not e.g. a member of a tarball sharing its file descriptor
+        if size > 0 and os.fstat(fd).st_size == size:
+            return mmap.mmap(fd, 0, mmap.MAP_SHARED, mmap.PROT_READ)
+    except (OSError, ValueError):
+        pass
+    return StreamView(stream)
+
+
 class Erofs:
     def __init__(self, fn):
+        """
+        :param fn: Path to an image file, bytes-like object (bytes, bytearray, memoryview, mmap) or seekable stream
+        (file, BytesIO, SparseImage, PartitionView, ...). Neither is copied in full.
+        """
         if type(fn) == str:
             self.fn = fn
             self.file_handle = open(fn, 'rb')
-            self.file_size = os.fstat(self.file_handle.fileno()).st_size
             self.mmap = mmap.mmap(self.file_handle.fileno(), 0, mmap.MAP_SHARED, mmap.PROT_READ)
+        elif isinstance(fn, (bytes, mmap.mmap)):
+            self.file_handle = None
+            self.mmap = fn
+        elif isinstance(fn, (bytearray, memoryview)):
+            self.file_handle = None
+            self.mmap = BufferView(memoryview(fn))
         else:
             self.file_handle = fn
-            self.file_size = self.file_handle.getbuffer().nbytes
-            self.mmap = self.file_handle.read()
+            self.mmap = map_stream(fn)
+        self.file_size = len(self.mmap)
         self.super = struct_erofs_super.parse(self.mmap[0x400:0x400+struct_erofs_super.sizeof()])
         print("0x%08x-0x%08x: SUPER" % (0x400, 0x400 + struct_erofs_super.sizeof()))
         assert self.super.magic == 0xe0f5e1e2, "0x%x" % self.super.magic
@@ -256,34 +376,28 @@ class Erofs:
         else:
             raise ValueError("inode type %r not supported" % file_type)
 
-    def get_inode_header(self, nid) -> struct_erofs_inode_v1:
+    def get_inode_header(self, nid) -> erofs_inode_v1:
         inode_off = self.super.meta_blkaddr * 4096 + 32 * nid
-        if inode_off + struct_erofs_inode_v1.sizeof() > self.file_size:
+        if inode_off + fast_erofs_inode_v1.size > self.file_size:
             raise ValueError("Inode nid 0x016%x out of range" % nid)
-        inode_buf = self.mmap[inode_off:inode_off + struct_erofs_inode_v1.sizeof()]
-        return struct_erofs_inode_v1.parse(inode_buf)
+        inode_buf = self.mmap[inode_off:inode_off + fast_erofs_inode_v1.size]
+        return erofs_inode_v1._make(fast_erofs_inode_v1.unpack(inode_buf))
 
     def get_file(self, path: bytes) -> "Inode":
         path = path.split(b'/')
         path = [x for x in path if x != b'']
         inode: DirInode = self.root_inode
         for i in range(len(path)):
-            path_elem = path[i]
-            ok = False
-            for dirent in inode.get_dirents():
-                if dirent.filename == path_elem:
-                    if i == len(path) - 1:
-                        return self.get_inode(dirent.nid, dirent.file_type)
-                    else:
-                        next_inode = self.get_inode(dirent.nid, dirent.file_type)
-                        if isinstance(next_inode, DirInode):
-                            inode = next_inode
-                            ok = True
-                        else:
-                            raise ValueError("Inode at %r is of type %r instead of DirInode" % (path[0:i], type(next_inode)))
-            if not ok:
+            dirent = inode.find_dirent(path[i])
+            if dirent is None:
                 raise FileNotFoundError("Failed to find %r in %r" % (path[i], path[0:i]))
-        assert False, path
+            next_inode = self.get_inode(dirent.nid, dirent.file_type)
+            if i == len(path) - 1:
+                return next_inode
+            if not isinstance(next_inode, DirInode):
+                raise ValueError("Inode at %r is of type %r instead of DirInode" % (path[0:i + 1], type(next_inode)))
+            inode = next_inode
+        return inode
 
 
 class Inode:
@@ -291,9 +405,11 @@ class Inode:
         self.erofs = erofs
         self.nid: int = nid
         self.inode_off = erofs.super.meta_blkaddr * 4096 + 32 * nid
-        inode_buf = erofs.mmap[self.inode_off:self.inode_off + struct_erofs_inode_v1.sizeof()]
-        self.inode_header = struct_erofs_inode_v1.parse(inode_buf)
-        self.xattr_start_off = self.inode_off + struct_erofs_inode_v1.sizeof()
+        inode_buf = erofs.mmap[self.inode_off:self.inode_off + fast_erofs_inode_v1.size]
+        if len(inode_buf) != fast_erofs_inode_v1.size:
+            raise ValueError("Inode nid 0x%x out of range" % nid)
+        self.inode_header = erofs_inode_v1._make(fast_erofs_inode_v1.unpack(inode_buf))
+        self.xattr_start_off = self.inode_off + fast_erofs_inode_v1.size
         if self.inode_header.i_xattr_icount > 0:
             self.xattr_size = 12 + (self.inode_header.i_xattr_icount - 1) * 4
         else:
@@ -344,62 +460,65 @@ class Inode:
             # assert False
             prev_clusterofs = 0
             num_decompressed_blocks = math.ceil(self.inode_header.i_size / 4096)
+            # Unpack the whole index array at once
+            indexes_size = fast_z_erofs_vle_decompressed_index.size * num_decompressed_blocks
+            indexes_buf = self.erofs.mmap[decompress_index_header_pos:decompress_index_header_pos + indexes_size]
+            if len(indexes_buf) != indexes_size:
+                raise ValueError("Decompression indexes of nid=%r are out of range" % self.nid)
+            indexes = list(fast_z_erofs_vle_decompressed_index.iter_unpack(indexes_buf))
             with BytesIO() as out:
                 prev_blkaddr = 0
                 prev_reserved_blkaddr = 0
-                for di_number in range(num_decompressed_blocks):
-                    buf = self.erofs.mmap[decompress_index_header_pos + recursive_union_sizeof(struct_z_erofs_vle_decompressed_index) * di_number: decompress_index_header_pos + recursive_union_sizeof(struct_z_erofs_vle_decompressed_index) * (di_number + 1)]
-                    # print("  %s" % codecs.encode(buf, 'hex').decode())
-                    di = struct_z_erofs_vle_decompressed_index.parse(buf)
+                for di_number, (di_advise, di_clusterofs, di_blkaddr) in enumerate(indexes):
                     if debug:
-                        print("DI %d/%d: adv=0x%04x %r" % (di_number, num_decompressed_blocks, di.di_advise, di))
-                        print("  OFF %r" % ((2**16 + di.di_clusterofs - prev_clusterofs) % 2**16))
-                    prev_clusterofs = di.di_clusterofs
+                        print("DI %d/%d: adv=0x%04x %r" % (di_number, num_decompressed_blocks, di_advise, struct_z_erofs_vle_decompressed_index.parse(indexes_buf[8*di_number:8*di_number+8])))
+                        print("  OFF %r" % ((2**16 + di_clusterofs - prev_clusterofs) % 2**16))
+                    prev_clusterofs = di_clusterofs
                     Z_EROFS_VLE_DI_CLUSTER_TYPE_BIT = 0
                     Z_EROFS_VLE_DI_CLUSTER_TYPE_BITS = 2
                     # See vle_legacy_load_cluster_from_disk() in drivers/staging/erofs/zmap.c
-                    type_int = (di.di_advise >> Z_EROFS_VLE_DI_CLUSTER_TYPE_BIT) & ((1 << Z_EROFS_VLE_DI_CLUSTER_TYPE_BITS) - 1)
+                    type_int = (di_advise >> Z_EROFS_VLE_DI_CLUSTER_TYPE_BIT) & ((1 << Z_EROFS_VLE_DI_CLUSTER_TYPE_BITS) - 1)
                     decompress_index_type = DecompressIndexType(type_int)
                     # print("DI %r: %r" % (di_number, decompress_index_type))
-                    # print("OFFSET CHECK: %r <=> %r" % (out.tell() % 4096, di.di_clusterofs))
+                    # print("OFFSET CHECK: %r <=> %r" % (out.tell() % 4096, di_clusterofs))
                     if decompress_index_type == DecompressIndexType.Z_EROFS_VLE_CLUSTER_TYPE_RESERVED:
-                        if di.di_u.blkaddr == prev_blkaddr:
+                        if di_blkaddr == prev_blkaddr:
                             decompress_index_type = DecompressIndexType.Z_EROFS_VLE_CLUSTER_TYPE_NONHEAD
                         else:
                             decompress_index_type = DecompressIndexType.Z_EROFS_VLE_CLUSTER_TYPE_HEAD
-                        prev_blkaddr = di.di_u.blkaddr
+                        prev_blkaddr = di_blkaddr
                     if decompress_index_type == DecompressIndexType.Z_EROFS_VLE_CLUSTER_TYPE_PLAIN:
-                        out.seek(di_number * 4096 + di.di_clusterofs)
-                        assert out.tell() == di_number * 4096 + di.di_clusterofs
-                        blkaddr = di.di_u.blkaddr
+                        out.seek(di_number * 4096 + di_clusterofs)
+                        assert out.tell() == di_number * 4096 + di_clusterofs
+                        blkaddr = di_blkaddr
                         buf = self.erofs.mmap[4096 * blkaddr: 4096 * (blkaddr + 1)]
                         if self.inode_header.i_size < out.tell() + len(buf):
                             buf = buf[0:self.inode_header.i_size - out.tell()]
                         out.write(buf)
                     elif decompress_index_type == DecompressIndexType.Z_EROFS_VLE_CLUSTER_TYPE_HEAD:
-                        if out.tell() % 4096 != di.di_clusterofs:
-                            if di.di_clusterofs == 0:
+                        if out.tell() % 4096 != di_clusterofs:
+                            if di_clusterofs == 0:
                                 out.seek(out.tell() - (out.tell() % 4096))
                             else:
-                                raise ValueError("Cluster offset check failed: %r <=> %r" % (out.tell() % 4096, di.di_clusterofs))
-                        # assert out.tell() % 4096 == di.di_clusterofs, "Cluster offset check failed: %r <=> %r" % (out.tell() % 4096, di.di_clusterofs)
-                        blkaddr = di.di_u.blkaddr
+                                raise ValueError("Cluster offset check failed: %r <=> %r" % (out.tell() % 4096, di_clusterofs))
+                        # assert out.tell() % 4096 == di_clusterofs, "Cluster offset check failed: %r <=> %r" % (out.tell() % 4096, di_clusterofs)
+                        blkaddr = di_blkaddr
                         compressed_buf = self.erofs.mmap[4096 * blkaddr: 4096 * (blkaddr + 1)]
                         # hd(compressed_buf)
                         # decompressed_buf = pp_decompress_lz4(compressed_buf, maxlen=self.inode_header.i_size - out.tell(), expected=open("/usr/bin/lxc", "rb").read()[out.tell():])
-                        decompressed_buf = pp_decompress_lz4(compressed_buf, maxlen=self.inode_header.i_size - out.tell())
+                        decompressed_buf = decompress_lz4(compressed_buf, maxlen=self.inode_header.i_size - out.tell())
                         out.write(decompressed_buf)
                     elif decompress_index_type == DecompressIndexType.Z_EROFS_VLE_CLUSTER_TYPE_NONHEAD:
                         pass
                     elif decompress_index_type == DecompressIndexType.Z_EROFS_VLE_CLUSTER_TYPE_RESERVED:
-                        blkaddr = di.di_u.blkaddr
+                        blkaddr = di_blkaddr
                         if blkaddr == prev_reserved_blkaddr:
                             continue
                         else:
                             prev_reserved_blkaddr = blkaddr
                         compressed_buf = self.erofs.mmap[4096 * blkaddr: 4096 * (blkaddr + 1)]
                         # hd(compressed_buf)
-                        decompressed_buf = pp_decompress_lz4(compressed_buf, maxlen=self.inode_header.i_size - out.tell())
+                        decompressed_buf = decompress_lz4(compressed_buf, maxlen=self.inode_header.i_size - out.tell())
                         print("len(decompressed_buf)=%r  decompressed_buf[0:50] = %r" % (len(decompressed_buf), decompressed_buf[0:50]))
                         out.write(decompressed_buf)
                     else:
@@ -420,10 +539,162 @@ class Inode:
             # assert False
             return data
         elif self.data_mapping_mode == DataMappingMode.EROFS_INODE_FLAT_COMPRESSION:
-            raise NotImplementedError("TODO: Implement EROFS_INODE_FLAT_COMPRESSION")
+            return self.get_data_compacted(debug=debug)
         else:
             raise ValueError("Don't know how to get data for data_mapping_mode=%r" % self.data_mapping_mode)
 
+    def get_lclusters_compacted(self, ebase: int, totalidx: int, big_pcluster: bool):
+        """
+        Decodes the compacted (2B/4B) lcluster indexes starting at `ebase`, see z_erofs_load_compact_lcluster() and
+        unpack_compacted_index() in fs/erofs/zmap.c.
+        :return: (types, los, pblks, end) with the lcluster type, the low bits (clusterofs for HEAD/PLAIN, delta[0] or
+        the compressed block count for NONHEAD) and the physical block of each HEAD/PLAIN lcluster, plus the end offset
+        of the index array (where a ztailpacking pcluster is inlined)
+        """
+        lclusterbits = 12
+        lobits = max(lclusterbits, Z_EROFS_LI_D0_CBLKCNT.bit_length())
+        # used to align to 32-byte (compacted_2b) alignment
+        compacted_4b_initial = (32 - ebase % 32) // 4
+        if compacted_4b_initial == 32 // 4:
+            compacted_4b_initial = 0
+        if self.z_advise & Z_EROFS_ADVISE_COMPACTED_2B and compacted_4b_initial < totalidx:
+            compacted_2b = (totalidx - compacted_4b_initial) // 16 * 16
+        else:
+            compacted_2b = 0
+
+        # Read the whole index array at once: 4B packs up to 32-byte alignment, 2B packs, 4B packs for the rest
+        compacted_4b_initial = min(compacted_4b_initial, totalidx + totalidx % 2)
+        compacted_4b_end = totalidx - compacted_4b_initial - compacted_2b
+        indexes_size = 4 * compacted_4b_initial + 2 * compacted_2b + 4 * (compacted_4b_end + compacted_4b_end % 2)
+        indexes = self.erofs.mmap[ebase:ebase + indexes_size]
+        if len(indexes) != indexes_size:
+            raise ValueError("Compacted indexes at 0x%x are out of range" % ebase)
+
+        types: List[int] = []
+        los: List[int] = []
+        pblks: List[int] = []
+        pos = ebase
+        while len(types) < totalidx:
+            lcn = len(types)
+            if compacted_4b_initial <= lcn < compacted_4b_initial + compacted_2b:
+                vcnt, packsize = 16, 32
+            else:
+                vcnt, packsize = 2, 8
+            pack = indexes[pos - ebase:pos - ebase + packsize]
+            encodebits = (packsize - 4) * 8 // vcnt
+            bits = int.from_bytes(pack[0:packsize - 4], "little")
+            pack_types = []
+            pack_los = []
+            for i in range(vcnt):
+                v = bits >> (encodebits * i)
+                pack_los.append(v & ((1 << lobits) - 1))
+                pack_types.append((v >> lobits) & 3)
+            base_blkaddr = struct.unpack_from("<I", pack, packsize - 4)[0]
+
+            for i in range(min(vcnt, totalidx - lcn)):
+                pblk = None
+                if pack_types[i] != DecompressIndexType.Z_EROFS_VLE_CLUSTER_TYPE_NONHEAD.value:
+                    # Count the blocks of the pclusters preceding this HEAD within the pack
+                    j = i
+                    if not big_pcluster:
+                        nblk = 1
+                        while j > 0:
+                            j -= 1
+                            if pack_types[j] == DecompressIndexType.Z_EROFS_VLE_CLUSTER_TYPE_NONHEAD.value:
+                                j -= pack_los[j]
+                            if j >= 0:
+                                nblk += 1
+                    else:
+                        nblk = 0
+                        while j > 0:
+                            j -= 1
+                            if pack_types[j] == DecompressIndexType.Z_EROFS_VLE_CLUSTER_TYPE_NONHEAD.value:
+                                if pack_los[j] & Z_EROFS_LI_D0_CBLKCNT:
+                                    j -= 1
+                                    nblk += pack_los[j + 1] & ~Z_EROFS_LI_D0_CBLKCNT
+                                    continue
+                                if pack_los[j] <= 1:
+                                    raise ValueError("Bad delta[0] %r in big pcluster index pack at 0x%x" % (pack_los[j], pos))
+                                j -= pack_los[j] - 2
+                                continue
+                            nblk += 1
+                    pblk = base_blkaddr + nblk
+                types.append(pack_types[i])
+                los.append(pack_los[i])
+                pblks.append(pblk)
+            pos += packsize
+        return types, los, pblks, pos
+
+    def get_data_compacted(self, debug=False) -> bytes:
+        """
+        Gets the data of an EROFS_INODE_FLAT_COMPRESSION inode (compacted indexes, optionally with big pclusters and
+        an inlined tail pcluster). The extents between consecutive HEAD/PLAIN lclusters are decoded in order, every
+        extent has its own physical cluster, decompressed once.
+        """
+        map_header_pos = self.xattr_start_off + self.xattr_size
+        map_header_pos += (8 - map_header_pos % 8) % 8
+        map_header = struct_z_erofs_map_header.parse(self.erofs.mmap[map_header_pos:map_header_pos + struct_z_erofs_map_header.sizeof()])
+        self.z_advise = map_header.h_advise
+        if debug:
+            print(map_header)
+        if map_header.h_clusterbits >> Z_EROFS_FRAGMENT_INODE_BIT or self.z_advise & Z_EROFS_ADVISE_FRAGMENT_PCLUSTER:
+            raise NotImplementedError("Fragments (packed inode) are not supported")
+        if map_header.h_clusterbits & 0x07 != 0:
+            raise NotImplementedError("Logical cluster size %r is not supported" % (4096 << (map_header.h_clusterbits & 0x07)))
+
+        i_size = self.inode_header.i_size
+        if i_size == 0:
+            return b""
+        totalidx = math.ceil(i_size / 4096)
+        types, los, pblks, idata_off = self.get_lclusters_compacted(map_header_pos + struct_z_erofs_map_header.sizeof(), totalidx, self.z_advise & Z_EROFS_ADVISE_BIG_PCLUSTER_1 != 0)
+
+        zero_padding = self.erofs.super.feature_incompat & EROFS_FEATURE_INCOMPAT_ZERO_PADDING != 0
+        heads = [lcn for lcn in range(totalidx) if types[lcn] != DecompressIndexType.Z_EROFS_VLE_CLUSTER_TYPE_NONHEAD.value]
+        if len(heads) == 0 or heads[0] != 0 or los[0] != 0:
+            raise ValueError("Inode nid=%r does not start with a HEAD lcluster" % self.nid)
+
+        out = bytearray(i_size)
+        for k, lcn in enumerate(heads):
+            start = lcn * 4096 + los[lcn]
+            end = heads[k + 1] * 4096 + los[heads[k + 1]] if k + 1 < len(heads) else i_size
+            if end <= start:
+                continue
+            cluster_type = types[lcn]
+            if cluster_type == DecompressIndexType.Z_EROFS_VLE_CLUSTER_TYPE_HEAD.value:
+                big_pcluster = self.z_advise & Z_EROFS_ADVISE_BIG_PCLUSTER_1
+                algorithm = map_header.h_algorithmtype & 0x0f
+            else:
+                big_pcluster = self.z_advise & Z_EROFS_ADVISE_BIG_PCLUSTER_2
+                algorithm = map_header.h_algorithmtype >> 4
+
+            if end == i_size and self.z_advise & Z_EROFS_ADVISE_INLINE_PCLUSTER:
+                # ztailpacking: the last pcluster directly follows the indexes
+                pcluster_key = "inline"
+                pcluster = self.erofs.mmap[idata_off:idata_off + map_header.h_idata_size]
+            else:
+                blocks = 1
+                if big_pcluster and lcn + 1 < totalidx and types[lcn + 1] == DecompressIndexType.Z_EROFS_VLE_CLUSTER_TYPE_NONHEAD.value and los[lcn + 1] & Z_EROFS_LI_D0_CBLKCNT:
+                    blocks = los[lcn + 1] & ~Z_EROFS_LI_D0_CBLKCNT
+                pcluster_key = (pblks[lcn], blocks)
+                pcluster = self.erofs.mmap[4096 * pblks[lcn]:4096 * (pblks[lcn] + blocks)]
+            if debug:
+                print("EXTENT 0x%x-0x%x: type=%r pcluster=%r" % (start, end, cluster_type, pcluster_key))
+
+            length = end - start
+            if cluster_type == DecompressIndexType.Z_EROFS_VLE_CLUSTER_TYPE_PLAIN.value:
+                if self.z_advise & Z_EROFS_ADVISE_INTERLACED_PCLUSTER and pcluster_key != "inline":
+                    # The block is rotated so that the data of `start` sits at its offset within the block
+                    rightpart = min(4096 - start % 4096, length)
+                    data = pcluster[start % 4096:start % 4096 + rightpart] + pcluster[0:length - rightpart]
+                else:
+                    data = pcluster[0:length]
+            else:
+                data = decompress_pcluster(pcluster, algorithm, length, zero_padding)[0:length]
+            if len(data) != length:
+                raise ValueError("Extent 0x%x-0x%x of nid=%r decoded to %r bytes" % (start, end, self.nid, len(data)))
+            out[start:end] = data
+        return bytes(out)
+
     def get_data_dir(self, debug=False) -> bytes:
         """
         Gets the directory data (struct erofs_dirent + filename buffer).
@@ -461,42 +732,131 @@ class DirInode(Inode):
         super(DirInode, self).__init__(erofs, nid)
         if S_IFMT(self.inode_header.i_mode) != S_IFDIR:
             raise ValueError("DirInode at nid=0x%16x is not of type S_IFDIR, self.inode_header.i_mode=0x%08x" % (nid, self.inode_header.i_mode))
-        # print("self.inode_off=0x%x" % self.inode_off)
-        # print(self.inode_header)
-        data = self.get_data_dir()
-        self.dirents: List[DirEnt] = []
-        if len(data) == 0:
-            return
-        # hd(data)
-        dirent0 = struct_erofs_dirent.parse(data[0:12])
-        # print(dirent0)
-        # return
-        assert dirent0.nameoff % 12 == 0
-        num_dirents = int(dirent0.nameoff / 12)
-        struct_dirents: List[struct_erofs_dirent] = []
-        for i in range(num_dirents):
-            struct_dirents.append(struct_erofs_dirent.parse(data[12*i:12*i+12]))
-        self.dirents = []
-        filenames_done: Set[bytes] = set()
-        for i in range(num_dirents):
-            struct_dirent = struct_dirents[i]
-            name_end = len(data)
-            if i < num_dirents - 1:
-                name_end = struct_dirents[i+1].nameoff
-            filename = data[struct_dirent.nameoff:name_end]
-            filename = filename.split(b'\0', 1)[0]
-            if filename == b'':
-                raise ValueError("Empty filename")
-            if filename in filenames_done:
-                raise ValueError("Duplicate filename %r" % filename)
-            # print("FILE %r: %r" % (filename, struct_dirent))
-            assert len(filename) < 255, "Filename too long(%d bytes): %r..." % (len(filename), filename[0:50])
-            if struct_dirent.file_type >= FileType.EROFS_FT_MAX.value:
-                raise ValueError("Bad struct_dirent.file_type %r" % struct_dirent.file_type)
-            file_type = FileType(struct_dirent.file_type)
-            dirent = DirEnt(filename, file_type, struct_dirent.nid)
-            self.dirents.append(dirent)
-            # print("%r" % dirent)
+        self._dir_data = None
+        self._dirents = None
+
+    def get_num_dir_blocks(self) -> int:
+        return math.ceil(self.inode_header.i_size / 4096)
+
+    def get_dir_block(self, i: int) -> bytes:
+        """
+        Directory data is split into blocks, each holding its own sorted struct erofs_dirent array followed by the
+        filenames, nameoff being relative to the start of the block. Uncompressed directories are read one block at
+        a time straight from the image, compressed ones are decoded (once) as a whole.
+        """
+        start = 4096 * i
+        end = min(start + 4096, self.inode_header.i_size)
+        if self.data_mapping_mode == DataMappingMode.EROFS_INODE_FLAT_INLINE:
+            data_off = self.xattr_start_off + self.xattr_size
+            return self.erofs.mmap[data_off + start:data_off + end]
+        if self.data_mapping_mode == DataMappingMode.EROFS_INODE_FLAT_PLAIN:
+            data_off = self.inode_header.i_u * 4096
+            return self.erofs.mmap[data_off + start:data_off + end]
+        if self._dir_data is None:
+            self._dir_data = self.get_data_dir()
+        return self._dir_data[start:end]
+
+    def get_dir_blocks(self) -> Iterator[bytes]:
+        for i in range(self.get_num_dir_blocks()):
+            yield self.get_dir_block(i)
+
+    @staticmethod
+    def get_block_dirent(block: bytes, i: int, num_dirents: int):
+        """
+        :return: (filename, erofs_dirent) of the i-th dirent in a directory block
+        """
+        struct_dirent = erofs_dirent._make(fast_erofs_dirent.unpack_from(block, 12*i))
+        name_end = len(block)
+        if i < num_dirents - 1:
+            name_end = fast_erofs_dirent.unpack_from(block, 12*i+12)[1]
+        filename = block[struct_dirent.nameoff:name_end]
+        filename = filename.split(b'\0', 1)[0]
+        return filename, struct_dirent
+
+    @staticmethod
+    def get_block_dirents(block: bytes, num_dirents: int):
+        """
+        :return: (filename, erofs_dirent) of all dirents in a directory block, unpacked at once
+        """
+        struct_dirents = [erofs_dirent._make(x) for x in fast_erofs_dirent.iter_unpack(block[0:12*num_dirents])]
+        result = []
+        for i, struct_dirent in enumerate(struct_dirents):
+            name_end = struct_dirents[i+1].nameoff if i < num_dirents - 1 else len(block)
+            filename = block[struct_dirent.nameoff:name_end]
+            result.append((filename.split(b'\0', 1)[0], struct_dirent))
+        return result
+
+    @staticmethod
+    def get_block_num_dirents(block: bytes) -> int:
+        nameoff = fast_erofs_dirent.unpack_from(block, 0)[1]
+        assert nameoff % 12 == 0
+        return nameoff // 12
+
+    @staticmethod
+    def make_dirent(filename: bytes, struct_dirent) -> DirEnt:
+        if filename == b'':
+            raise ValueError("Empty filename")
+        assert len(filename) < 255, "Filename too long(%d bytes): %r..." % (len(filename), filename[0:50])
+        if struct_dirent.file_type >= FileType.EROFS_FT_MAX.value:
+            raise ValueError("Bad struct_dirent.file_type %r" % struct_dirent.file_type)
+        return DirEnt(filename, FileType(struct_dirent.file_type), struct_dirent.nid)
+
+    @property
+    def dirents(self) -> List[DirEnt]:
+        """
+        All dirents of this directory, parsed on first access.
+        """
+        if self._dirents is None:
+            dirents: List[DirEnt] = []
+            filenames_done: Set[bytes] = set()
+            for block in self.get_dir_blocks():
+                for filename, struct_dirent in self.get_block_dirents(block, self.get_block_num_dirents(block)):
+                    if filename in filenames_done:
+                        raise ValueError("Duplicate filename %r" % filename)
+                    filenames_done.add(filename)
+                    dirents.append(self.make_dirent(filename, struct_dirent))
+            self._dirents = dirents
+        return self._dirents
+
+    def find_dirent(self, filename: bytes):
+        """
+        Looks up a single dirent, binary searching first the directory blocks and then the dirents within the block,
+        as erofs_namei() in the kernel. Dirents are sorted by filename (strcmp order) across all blocks.
+        :return: DirEnt or None if there is no such file
+        """
+        if self._dirents is not None:
+            for dirent in self._dirents:
+                if dirent.filename == filename:
+                    return dirent
+            return None
+        # Last block whose first filename is <= filename, only the probed blocks are read
+        lo, hi = 0, self.get_num_dir_blocks() - 1
+        target = None
+        target_block = None
+        while lo <= hi:
+            mid = (lo + hi) // 2
+            block = self.get_dir_block(mid)
+            first_filename, _ = self.get_block_dirent(block, 0, self.get_block_num_dirents(block))
+            if first_filename <= filename:
+                target, target_block = mid, block
+                lo = mid + 1
+            else:
+                hi = mid - 1
+        if target is None:
+            return None
+        block = target_block
+        num_dirents = self.get_block_num_dirents(block)
+        lo, hi = 0, num_dirents - 1
+        while lo <= hi:
+            mid = (lo + hi) // 2
+            mid_filename, struct_dirent = self.get_block_dirent(block, mid, num_dirents)
+            if mid_filename == filename:
+                return self.make_dirent(mid_filename, struct_dirent)
+            elif mid_filename < filename:
+                lo = mid + 1
+            else:
+                hi = mid - 1
+        return None
 
     def get_dirents(self) -> List[DirEnt]:
         return self.dirents
@@ -584,6 +944,54 @@ def hd(buf: bytes):
     p.wait()
 
 
+def decompress_pcluster(buf: bytes, algorithm: int, length: int, zero_padding: bool) -> bytes:
+    """
+    Decompresses the first `length` bytes of a physical cluster compressed with `algorithm` (h_algorithmtype).
+    """
+    if algorithm == Z_EROFS_COMPRESSION_LZ4:
+        return decompress_lz4(buf, maxlen=length)
+    elif algorithm == Z_EROFS_COMPRESSION_DEFLATE:
+        if zero_padding:
+            buf = bytes(buf).lstrip(b"\0")
+        return zlib.decompressobj(-15).decompress(buf, length)
+    else:
+        raise NotImplementedError("Compression algorithm %r is not supported" % algorithm)
+
+
+# Cross-check every natively decompressed cluster against pp_decompress_lz4 (slow, for debugging)
+LZ4_VERIFY = False
+# LZ4 cannot expand a block by more than this factor, bounds the native output buffer
+LZ4_MAX_EXPANSION = 255
+
+
+def decompress_lz4(buf: bytes, maxlen: int = None) -> bytes:
+    """
+    Decompresses one EROFS LZ4 cluster, with the native lz4 module if available and pp_decompress_lz4 otherwise.
+    Compressed data is padded to the cluster size, either in front (EROFS_FEATURE_INCOMPAT_LZ4_0PADDING) or at the
+    end (older images). LZ4 streams cannot start with a zero byte, so leading zeros are skipped; trailing zeros may be
+    part of the final literals, so a few of them are tried back before falling back to the Python decoder.
+    :param buf: Compressed cluster
+    :param maxlen: Maximum length to extract
+    :return:
+    """
+    buf = bytes(buf).lstrip(b"\0")
+    if lz4 is not None:
+        capacity = LZ4_MAX_EXPANSION * len(buf)
+        if maxlen is not None:
+            capacity = min(capacity, maxlen)
+        stripped = buf.rstrip(b"\0")
+        for end in range(len(stripped), min(len(stripped) + 4, len(buf)) + 1):
+            try:
+                out = lz4.block.decompress(buf[0:end], uncompressed_size=capacity)
+            except lz4.block.LZ4BlockError:
+                continue
+            if LZ4_VERIFY:
+                expected = pp_decompress_lz4(buf, maxlen=maxlen)
+                assert out == expected[0:len(out)], "Native LZ4 output differs from pp_decompress_lz4"
+            return out
+    return pp_decompress_lz4(buf, maxlen=maxlen)
+
+
 def pp_decompress_lz4(buf: bytes, maxlen: int = None, expected: bytes = None) -> bytes:
     """
     https://github.com/lz4/lz4/blob/master/doc/lz4_Block_format.md
@@ -592,70 +1000,64 @@ def pp_decompress_lz4(buf: bytes, maxlen: int = None, expected: bytes = None) ->
     :param expected: Optional known decompressed value to debug extraction errors
     :return:
     """
-    with BytesIO() as out:
-        pos = 0
-        while pos < len(buf):
-            token_byte = buf[pos]
-            # print("Token 0x%02x at 0x%x" % (token_byte, pos))
+    out = bytearray()
+    pos = 0
+    while pos < len(buf):
+        token_byte = buf[pos]
+        # print("Token 0x%02x at 0x%x" % (token_byte, pos))
+        pos += 1
+        # Get length of literal from input
+        literal_length = token_byte >> 4
+        if literal_length == 0xf:
+            length_byte = buf[pos]
             pos += 1
-            # Get length of literal from input
-            literal_length = token_byte >> 4
-            if literal_length == 0xf:
+            literal_length += length_byte
+            while length_byte == 0xff:
                 length_byte = buf[pos]
                 pos += 1
                 literal_length += length_byte
-                while length_byte == 0xff:
-                    length_byte = buf[pos]
-                    pos += 1
-                    literal_length += length_byte
-            literal_buf = buf[pos: pos + literal_length]
-            pos += literal_length
-            if expected is not None:
-                for i in range(len(literal_buf)):
-                    assert literal_buf[i] == expected[out.tell() + i], "Mismatch at position 0x%x: %r <=> %r" % (out.tell() + i, literal_buf[i], expected[out.tell() + i])
-            out.write(literal_buf)
-            if maxlen is not None and out.tell() >= maxlen:
-                return out.getvalue()[0:maxlen]
-            if pos == len(buf) or pos == len(buf) - 1:
-                # Reached end of input after literal => OK
-                break
-            # print("OFFSET POS: 0x%x" % pos)
-            # Get offset for copy operation
-            offset = buf[pos] + 256 * buf[pos + 1]
-            pos += 2
-            if offset == 0:
-                continue
-                # raise ValueError("Offset cannot be 0")
-            # Get matchlength for copy operation
-            matchlength = token_byte & 0x0f
-            if matchlength == 0xf:
+        literal_buf = buf[pos: pos + literal_length]
+        pos += literal_length
+        if expected is not None:
+            for i in range(len(literal_buf)):
+                assert literal_buf[i] == expected[len(out) + i], "Mismatch at position 0x%x: %r <=> %r" % (len(out) + i, literal_buf[i], expected[len(out) + i])
+        out += literal_buf
+        if maxlen is not None and len(out) >= maxlen:
+            return bytes(out[0:maxlen])
+        if pos == len(buf) or pos == len(buf) - 1:
+            # Reached end of input after literal => OK
+            break
+        # print("OFFSET POS: 0x%x" % pos)
+        # Get offset for copy operation
+        offset = buf[pos] + 256 * buf[pos + 1]
+        pos += 2
+        if offset == 0:
+            continue
+            # raise ValueError("Offset cannot be 0")
+        # Get matchlength for copy operation
+        matchlength = token_byte & 0x0f
+        if matchlength == 0xf:
+            length_byte = buf[pos]
+            pos += 1
+            matchlength += length_byte
+            while length_byte == 0xff:
                 length_byte = buf[pos]
                 pos += 1
                 matchlength += length_byte
-                while length_byte == 0xff:
-                    length_byte = buf[pos]
-                    pos += 1
-                    matchlength += length_byte
-            matchlength += 4
-            match_pos = out.tell() - offset
-            while matchlength > 0:
-                copylen = min(matchlength, out.tell() - match_pos)
-                copybuf = out.getvalue()[match_pos: match_pos + copylen]
-                if expected is not None:
-                    for i in range(len(copybuf)):
-                        assert copybuf[i] == expected[out.tell() + i], "Mismatch at position %r" % (out.tell() + i)
-                out.write(copybuf)
-                if maxlen is not None and out.tell() >= maxlen:
-                    return out.getvalue()[0:maxlen]
-                matchlength -= copylen
-                # print("copylen=%r" % copylen)
-                # Copy from the original position => Copy as many bytes as possible at a time
-                assert copylen % offset == 0 or matchlength == 0
-                # match_pos += copylen % offset
-            # Old, un-optimized code:
-            # for i in range(matchlength):
-            #     out.write(out.getvalue()[match_pos + i:match_pos + i + 1])
-        return out.getvalue()
+        matchlength += 4
+        match_pos = len(out) - offset
+        while matchlength > 0:
+            # Copy from the original position => Copy as many bytes as possible at a time
+            copylen = min(matchlength, len(out) - match_pos)
+            copybuf = out[match_pos: match_pos + copylen]
+            if expected is not None:
+                for i in range(len(copybuf)):
+                    assert copybuf[i] == expected[len(out) + i], "Mismatch at position %r" % (len(out) + i)
+            out += copybuf
+            if maxlen is not None and len(out) >= maxlen:
+                return bytes(out[0:maxlen])
+            matchlength -= copylen
+    return bytes(out)
 
 
 if __name__ == "__main__":
@@ -1,5 +1,7 @@
 # Source: https://github.com/cubinator/ext4
 
+import bisect
+import collections
 import ctypes
 import functools
 import io
@@ -23,6 +25,121 @@ def wcscmp (str_a, str_b):
     tmp = len(str_a) - len(str_b)
     return -1 if tmp < 0 else 1 if tmp > 0 else 0
 
+def rol32 (value, shift):
+    """
+    Rotates a 32-bit value left by shift bits
+    """
+    value &= 0xFFFFFFFF
+    return ((value << shift) | (value >> (32 - shift))) & 0xFFFFFFFF
+
+def str2hashbuf (raw, num, signed):
+    """
+    Port of str2hashbuf_{signed,unsigned} from fs/ext4/hash.c: Packs up to num * 4 bytes of raw into num 32-bit words
+    """
+    length = len(raw)
+    pad = (length | (length << 8)) & 0xFFFFFFFF
+    pad |= (pad << 16) & 0xFFFFFFFF
+
+    buf = []
+    val = pad
+    for i in range(min(length, num * 4)):
+        c = raw[i] - 256 if signed and raw[i] >= 128 else raw[i]
+        val = (c + (val << 8)) & 0xFFFFFFFF
+        if (i % 4) == 3:
+            buf.append(val)
+            val = pad
+
+    if len(buf) < num:
+        buf.append(val)
+    while len(buf) < num:
+        buf.append(pad)
+
+    return buf
+
+def half_md4_transform (buf, data):
+    """
+    Port of half_md4_transform from fs/ext4/hash.c, updates buf in place
+    """
+    F = lambda x, y, z: z ^ (x & (y ^ z))
+    G = lambda x, y, z: ((x & y) + ((x ^ y) & z)) & 0xFFFFFFFF
+    H = lambda x, y, z: x ^ y ^ z
+    K1, K2, K3 = 0, 0o13240474631, 0o15666365641
+
+    a, b, c, d = buf
+    for f, k, order in [
+        (F, K1, [(0, 3), (1, 7), (2, 11), (3, 19), (4, 3), (5, 7), (6, 11), (7, 19)]),
+        (G, K2, [(1, 3), (3, 5), (5, 9), (7, 13), (0, 3), (2, 5), (4, 9), (6, 13)]),
+        (H, K3, [(3, 3), (7, 9), (2, 11), (6, 15), (1, 3), (5, 9), (0, 11), (4, 15)])
+    ]:
+        for i, (idx, shift) in enumerate(order):
+            # ROUND(f, a, b, c, d, x, s) with the (a, b, c, d) roles rotating by one register per step
+            if i % 4 == 0: a = rol32(a + f(b, c, d) + data[idx] + k, shift)
+            elif i % 4 == 1: d = rol32(d + f(a, b, c) + data[idx] + k, shift)
+            elif i % 4 == 2: c = rol32(c + f(d, a, b) + data[idx] + k, shift)
+            else: b = rol32(b + f(c, d, a) + data[idx] + k, shift)
+
+    buf[0] = (buf[0] + a) & 0xFFFFFFFF
+    buf[1] = (buf[1] + b) & 0xFFFFFFFF
+    buf[2] = (buf[2] + c) & 0xFFFFFFFF
+    buf[3] = (buf[3] + d) & 0xFFFFFFFF
+
+def tea_transform (buf, data):
+    """
+    Port of TEA_transform from fs/ext4/hash.c, updates buf in place
+    """
+    total = 0
+    b0, b1 = buf[0], buf[1]
+    a, b, c, d = data
+
+    for _ in range(16):
+        total = (total + 0x9E3779B9) & 0xFFFFFFFF
+        b0 = (b0 + ((((b1 << 4) + a) & 0xFFFFFFFF) ^ ((b1 + total) & 0xFFFFFFFF) ^ (((b1 >> 5) + b) & 0xFFFFFFFF))) & 0xFFFFFFFF
+        b1 = (b1 + ((((b0 << 4) + c) & 0xFFFFFFFF) ^ ((b0 + total) & 0xFFFFFFFF) ^ (((b0 >> 5) + d) & 0xFFFFFFFF))) & 0xFFFFFFFF
+
+    buf[0] = (buf[0] + b0) & 0xFFFFFFFF
+    buf[1] = (buf[1] + b1) & 0xFFFFFFFF
+
+def dx_hack_hash (raw, signed):
+    """
+    Port of dx_hack_hash_{signed,unsigned} from fs/ext4/hash.c (the legacy hash)
+    """
+    hash0, hash1 = 0x12A3FE2D, 0x37ABE8F9
+
+    for c in raw:
+        if signed and c >= 128: c -= 256
+        value = (hash1 + (hash0 ^ ((c * 7152373) & 0xFFFFFFFF))) & 0xFFFFFFFF
+        if value & 0x80000000: value = (value - 0x7FFFFFFF) & 0xFFFFFFFF
+        hash1, hash0 = hash0, value
+
+    return (hash0 << 1) & 0xFFFFFFFF
+
+def dx_hash (raw, hash_version, seed):
+    """
+    Port of ext4fs_dirhash from fs/ext4/hash.c: Returns the major hash of the directory entry name raw (bytes) as used
+    by hash tree directories. hash_version is one of the DX_HASH_* constants of HashTree, seed the superblock's
+    s_hash_seed.
+    """
+    buf = [0x67452301, 0xEFCDAB89, 0x98BADCFE, 0x10325476]
+    if any(seed): buf = list(seed)
+
+    if hash_version in (HashTree.DX_HASH_LEGACY, HashTree.DX_HASH_LEGACY_UNSIGNED):
+        value = dx_hack_hash(raw, hash_version == HashTree.DX_HASH_LEGACY)
+    elif hash_version in (HashTree.DX_HASH_HALF_MD4, HashTree.DX_HASH_HALF_MD4_UNSIGNED):
+        for i in range(0, max(len(raw), 1), 32):
+            half_md4_transform(buf, str2hashbuf(raw[i:], 8, hash_version == HashTree.DX_HASH_HALF_MD4))
+        value = buf[1]
+    elif hash_version in (HashTree.DX_HASH_TEA, HashTree.DX_HASH_TEA_UNSIGNED):
+        for i in range(0, max(len(raw), 1), 16):
+            tea_transform(buf, str2hashbuf(raw[i:], 4, hash_version == HashTree.DX_HASH_TEA))
+        value = buf[0]
+    else:
+        raise NotImplementedError("Hash version {hash_version:d} is not supported.".format(hash_version = hash_version))
+
+    value &= ~1 & 0xFFFFFFFF
+    if value == (0x7FFFFFFF << 1): value = (0x7FFFFFFF - 1) << 1 # EXT4_HTREE_EOF_32BIT
+
+    return value
+
 
 
 ########################################################################################################################
@@ -111,6 +228,34 @@ class ext4_dir_entry_2 (ext4_struct):
 
 
 
+class ext4_dx_countlimit (ext4_struct):
+    _fields_ = [
+        ("limit", ctypes.c_ushort), # 0x0
+        ("count", ctypes.c_ushort), # 0x2
+        ("block", ctypes.c_uint)    # 0x4, Block of the first (implicitly zero-hashed) entry
+    ]
+
+
+
+class ext4_dx_entry (ext4_struct):
+    _fields_ = [
+        ("hash", ctypes.c_uint), # 0x0
+        ("block", ctypes.c_uint) # 0x4
+    ]
+
+
+
+class ext4_dx_root_info (ext4_struct):
+    _fields_ = [
+        ("reserved_zero", ctypes.c_uint),    # 0x0
+        ("hash_version", ctypes.c_ubyte),    # 0x4
+        ("info_length", ctypes.c_ubyte),     # 0x5, Must be 0x8
+        ("indirect_levels", ctypes.c_ubyte), # 0x6
+        ("unused_flags", ctypes.c_ubyte)     # 0x7
+    ]
+
+
+
 class ext4_extent (ext4_struct):
     _fields_ = [
         ("ee_block", ctypes.c_uint),      # 0x0000
@@ -471,6 +616,22 @@ class InodeType:
 
 
 
+class HashTree:
+    DX_HASH_LEGACY            = 0x0
+    DX_HASH_HALF_MD4          = 0x1
+    DX_HASH_TEA               = 0x2
+    DX_HASH_LEGACY_UNSIGNED   = 0x3
+    DX_HASH_HALF_MD4_UNSIGNED = 0x4
+    DX_HASH_TEA_UNSIGNED      = 0x5
+    DX_HASH_SIPHASH           = 0x6 # Casefolded directories only, not supported
+
+    EXT2_FLAGS_UNSIGNED_HASH  = 0x2 # s_flags: Hash versions 0 - 2 are to be read as their unsigned variants
+
+    DX_ROOT_INFO_OFFSET       = 0x18 # dx_root_info follows the fake "." and ".." entries in the first block
+    DX_NODE_OFFSET            = 0x8  # dx_countlimit follows a fake, empty directory entry in interior blocks
+
+
+
 ########################################################################################################################
 ####################################################   HIGH LEVEL   ####################################################
 ########################################################################################################################
@@ -545,12 +706,14 @@ class Volume:
     """
 
     ROOT_INODE = 2
+    CACHE_BLOCKS = 4096 # Default capacity of the metadata block cache (16 MiB with 4 KiB blocks)
 
-    def __init__ (self, stream, offset = 0, ignore_flags = False, ignore_magic = False):
+    def __init__ (self, stream, offset = 0, ignore_flags = False, ignore_magic = False, cache_blocks = CACHE_BLOCKS):
         """
         Initializes a new ext4 reader at a given offset in stream. If ignore_magic is True, no exception will be thrown,
         when a structure with wrong magic number is found. Analogously passing True to ignore_flags suppresses Exception
-        caused by wrong flags.
+        caused by wrong flags. cache_blocks bounds the LRU cache used for metadata blocks (inode tables, extent nodes,
+        directory blocks); 0 disables it.
         """
         self.ignore_flags = ignore_flags
         self.ignore_magic = ignore_magic
@@ -558,8 +721,13 @@ class Volume:
         self.platform64 = True # Initial value needed for Volume.read_struct
         self.stream = stream
 
-        # Superblock
-        self.superblock = self.read_struct(ext4_superblock, 0x400)
+        self.cache_blocks = cache_blocks
+        self.cache = collections.OrderedDict() # disk_block_idx -> bytes, least recently used first
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        # Superblock (read uncached, block_size is not known yet)
+        self.superblock = ext4_superblock._from_buffer_copy(self.read(0x400, ctypes.sizeof(ext4_superblock)), platform64 = True)
         self.platform64 = (self.superblock.s_feature_incompat & ext4_superblock.INCOMPAT_64BIT) != 0
 
         if not ignore_magic and self.superblock.s_magic != 0xEF53:
@@ -588,9 +756,10 @@ class Volume:
         """
         return 1 << (10 + self.superblock.s_log_block_size)
 
-    def get_inode (self, inode_idx):
+    def get_inode (self, inode_idx, file_type = InodeType.UNKNOWN):
         """
-        Returns an Inode instance representing the inode specified by its index inode_idx.
+        Returns an Inode instance representing the inode specified by its index inode_idx. file_type is accepted for
+        compatibility with callers passing the directory entry's type and is not used.
         """
         group_idx, inode_table_entry_idx = self.get_inode_group(inode_idx)
 
@@ -616,11 +785,54 @@ class Volume:
 
         return self.stream.read(byte_len)
 
+    def read_cached (self, offset, byte_len):
+        """
+        Like Volume.read, but serves whole blocks from the metadata block cache. Meant for metadata which is read
+        repeatedly; bulk file content should go through Volume.read.
+        """
+        if self.cache_blocks <= 0:
+            return self.read(offset, byte_len)
+
+        block_size = self.block_size
+        first_block_idx = offset // block_size
+        last_block_idx = (offset + byte_len - 1) // block_size
+
+        blocks = []
+        for block_idx in range(first_block_idx, last_block_idx + 1):
+            block = self.cache.get(block_idx)
+            if block is None:
+                self.cache_misses += 1
+                block = self.read(block_idx * block_size, block_size)
+                self.cache[block_idx] = block
+                if len(self.cache) > self.cache_blocks:
+                    self.cache.popitem(last = False)
+            else:
+                self.cache_hits += 1
+                self.cache.move_to_end(block_idx)
+            blocks.append(block)
+
+        start = offset - first_block_idx * block_size
+        raw = blocks[0] if len(blocks) == 1 else b"".join(blocks)
+        return raw[start : start + byte_len]
+
+    @property
+    def cache_info (self):
+        """
+        Returns the metadata block cache statistics as dictionary.
+        """
+        return {
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "blocks": len(self.cache),
+            "max_blocks": self.cache_blocks
+        }
+
     def read_struct (self, structure, offset, platform64 = None):
         """
-        Interprets the bytes at offset as structure and returns the interpreted instance
+        Interprets the bytes at offset as structure and returns the interpreted instance. Structures are read through
+        the metadata block cache.
         """
-        raw = self.read(offset, ctypes.sizeof(structure))
+        raw = self.read_cached(offset, ctypes.sizeof(structure))
 
         if hasattr(structure, "_from_buffer_copy"):
             return structure._from_buffer_copy(raw, platform64 = platform64 if platform64 != None else self.platform64)
@@ -784,7 +996,7 @@ class Inode:
                     inode = inode_idx
                 ))
 
-            file_name, inode_idx, file_type = next(filter(lambda entry: entry[0] == part, current_inode.open_dir(decode_name)), (None, None, None))
+            file_name, inode_idx, file_type = current_inode.find_dir_entry(part, decode_name) or (None, None, None)
 
             if inode_idx == None:
                 current_path = "/".join(relative_path[:i])
@@ -799,6 +1011,118 @@ class Inode:
 
         return current_inode
 
+    def find_dir_entry (self, name, decode_name = None):
+        """
+        Returns the directory entry (decode_name(name), inode, file_type) whose decoded name equals name, or None if
+        there is no such entry. For hash tree directories only the leaf block(s) the name hashes to are read, otherwise
+        (or if the name cannot be hashed, i.e. it is a str and decode_name is given) all entries are scanned.
+        """
+        if (self.inode.i_flags & ext4_inode.EXT4_INDEX_FL) != 0:
+            raw_name = name if isinstance(name, bytes) else name.encode("utf8") if decode_name == None and isinstance(name, str) else None
+
+            if raw_name != None:
+                try:
+                    leaf_blocks = self._get_dx_leaf_blocks(raw_name)
+                except NotImplementedError:
+                    leaf_blocks = None
+
+                if leaf_blocks != None:
+                    if decode_name == None:
+                        decode_name = lambda raw: raw.decode("utf8")
+
+                    reader = self.open_read(cached = True)
+                    for file_block_idx in leaf_blocks:
+                        for dirent in self._parse_dir_entries(reader.read_block(file_block_idx)):
+                            if dirent.name == raw_name:
+                                return (decode_name(dirent.name), dirent.inode, dirent.file_type)
+
+                    return None
+
+        return next(filter(lambda entry: entry[0] == name, self.open_dir(decode_name)), None)
+
+    def _get_dx_leaf_blocks (self, raw_name):
+        """
+        Walks this directory's hash tree and returns the list of file block indices of the leaf blocks that may hold
+        raw_name: the block covering its hash plus the following blocks continuing a hash collision. Returns None if the
+        index looks inconsistent, in which case the caller has to fall back to a linear scan.
+        """
+        reader = self.open_read(cached = True)
+        raw_data = reader.read_block(0)
+        root_info = ext4_dx_root_info.from_buffer_copy(raw_data, HashTree.DX_ROOT_INFO_OFFSET)
+
+        hash_version = root_info.hash_version
+        if hash_version <= HashTree.DX_HASH_TEA and (self.volume.superblock.s_flags & HashTree.EXT2_FLAGS_UNSIGNED_HASH) != 0:
+            hash_version += 3
+        target_hash = dx_hash(raw_name, hash_version, self.volume.superblock.s_hash_seed)
+
+        def read_node (raw_data, offset):
+            countlimit = ext4_dx_countlimit.from_buffer_copy(raw_data, offset)
+            if countlimit.count == 0 or countlimit.count > countlimit.limit:
+                return None
+
+            # Entry 0 has an implicit hash of 0, its hash field is taken by dx_countlimit
+            entries = [(0, countlimit.block)]
+            for i in range(1, countlimit.count):
+                dx_entry = ext4_dx_entry.from_buffer_copy(raw_data, offset + 8 * i)
+                entries.append((dx_entry.hash, dx_entry.block))
+            return entries
+
+        # path holds [entries, entry_idx] for every level from the root down to the node pointing at the leaves
+        path = []
+        entries = read_node(raw_data, HashTree.DX_ROOT_INFO_OFFSET + root_info.info_length)
+        for level in range(root_info.indirect_levels + 1):
+            if entries == None:
+                return None
+            entry_idx = bisect.bisect_right([entry_hash for entry_hash, _ in entries], target_hash) - 1
+            path.append([entries, entry_idx])
+
+            if level < root_info.indirect_levels:
+                entries = read_node(reader.read_block(entries[entry_idx][1]), HashTree.DX_NODE_OFFSET)
+
+        leaf_blocks = [path[-1][0][path[-1][1]][1]]
+
+        # Port of ext4_htree_next_block: The low bit of a hash marks a block continuing the collision chain of the
+        # previous one, which may be reached through the next entry of any node up the path
+        while True:
+            level = len(path) - 1
+            while level >= 0 and path[level][1] + 1 >= len(path[level][0]):
+                level -= 1
+            if level < 0:
+                break
+
+            path[level][1] += 1
+            entries, entry_idx = path[level]
+            if (entries[entry_idx][0] & ~1) != target_hash:
+                break
+
+            for level in range(level + 1, len(path)):
+                entries = read_node(reader.read_block(entries[entry_idx][1]), HashTree.DX_NODE_OFFSET)
+                if entries == None:
+                    return None
+                entry_idx = 0
+                path[level] = [entries, entry_idx]
+
+            leaf_blocks.append(entries[entry_idx][1])
+
+        return leaf_blocks
+
+    def _parse_dir_entries (self, raw_data):
+        """
+        Generator: Yields the directory entries (ext4_dir_entry_2) of raw_data (one or more directory blocks), skipping
+        unused entries, checksum entries and the fake entries hiding hash tree nodes.
+        """
+        offset = 0
+
+        while offset < len(raw_data):
+            dirent = ext4_dir_entry_2._from_buffer_copy(raw_data, offset, platform64 = self.volume.platform64)
+
+            if dirent.inode != 0 and dirent.file_type != InodeType.CHECKSUM:
+                yield dirent
+
+            if dirent.rec_len == 0:
+                break
+            offset += dirent.rec_len
+
     @property
     def is_dir (self):
         """
@@ -881,25 +1205,18 @@ class Inode:
         if not self.volume.ignore_flags and not self.is_dir:
             raise Ext4Error("Inode ({inode:d}) is not a directory.".format(inode = self.inode_idx))
 
-        # # Hash trees are compatible with linear arrays
-        if (self.inode.i_flags & ext4_inode.EXT4_INDEX_FL) != 0:
-            raise NotImplementedError("Hash trees are not implemented yet.")
-
-        # Read raw directory content
-        raw_data = self.open_read().read()
-        offset = 0
-
-        while offset < len(raw_data):
-            dirent = ext4_dir_entry_2._from_buffer_copy(raw_data, offset, platform64 = self.volume.platform64)
+        # Hash trees are compatible with linear arrays: the index lives in the rec_len of ".." in the first block and in
+        # fake, unused entries spanning the interior blocks, both of which _parse_dir_entries skips over.
+        # Read raw directory content (through the metadata block cache)
+        raw_data = self.open_read(cached = True).read()
 
-            if dirent.file_type != InodeType.CHECKSUM:
-                yield (decode_name(dirent.name), dirent.inode, dirent.file_type)
+        for dirent in self._parse_dir_entries(raw_data):
+            yield (decode_name(dirent.name), dirent.inode, dirent.file_type)
 
-            offset += dirent.rec_len
-
-    def open_read (self):
+    def open_read (self, cached = False):
         """
-        Returns an BlockReader instance for reading this inode's raw content.
+        Returns an BlockReader instance for reading this inode's raw content. If cached is True, the reader goes through
+        the volume's metadata block cache (used for directories).
         """
         if (self.inode.i_flags & ext4_inode.EXT4_EXTENTS_FL) != 0:
             # Obtain mapping from extents
@@ -928,10 +1245,10 @@ class Inode:
                         mapping.append(MappingEntry(extent.ee_block, extent.ee_start, extent.ee_len))
 
             MappingEntry.optimize(mapping)
-            return BlockReader(self.volume, len(self), mapping)
+            return BlockReader(self.volume, len(self), mapping, cached = cached)
         else:
             # Inode uses inline data
-            i_block = self.volume.read(self.offset + ext4_inode.i_block.offset, ext4_inode.i_block.size)
+            i_block = self.volume.read_cached(self.offset + ext4_inode.i_block.offset, ext4_inode.i_block.size)
             return io.BytesIO(i_block[:self.inode.i_size])
 
     @property
@@ -965,7 +1282,7 @@ class Inode:
         inline_data_length = self.offset + self.volume.superblock.s_inode_size - inline_data_offset
 
         if check_inline and inline_data_length > ctypes.sizeof(ext4_xattr_ibody_header):
-            inline_data = self.volume.read(inline_data_offset, inline_data_length)
+            inline_data = self.volume.read_cached(inline_data_offset, inline_data_length)
             xattrs_header = ext4_xattr_ibody_header.from_buffer_copy(inline_data)
 
             # TODO Find way to detect inline xattrs without checking the h_magic field to enable error detection with the h_magic field.
@@ -1003,20 +1320,22 @@ class Inode:
 class BlockReader:
     """
     Maps disk blocks into a linear byte stream.
-    NOTE: This class does not implement buffering or caching.
+    NOTE: This class does not implement buffering. Caching only happens in the volume's metadata block cache, if the
+    reader was created with cached = True.
     """
 
     # OSError
     EINVAL = 22
 
-    def __init__ (self, volume, byte_size, block_map):
+    def __init__ (self, volume, byte_size, block_map, cached = False):
         """
         Initializes a new block reader on the specified volume. mapping must be a list of MappingEntry instances. If
         you prefer a way to use 2-tuples (disk_block_idx, block_count) with inferred file_block_index entries, see
-        MappingEntry.create_mapping.
+        MappingEntry.create_mapping. If cached is True, disk blocks are read through Volume.read_cached.
         """
         self.byte_size = byte_size
         self.volume = volume
+        self.volume_read = volume.read_cached if cached else volume.read
 
         self.cursor = 0
 
@@ -1025,6 +1344,7 @@ class BlockReader:
         # Optimize mapping (stich together)
         MappingEntry.optimize(block_map)
         self.block_map = block_map
+        self.block_map_starts = [entry.file_block_idx for entry in block_map] # Sorted, for bisect
 
     def __repr__ (self):
         return "{type_name:s}(byte_size = {size!r:s}, block_map = {block_map!r:s}, volume_uuid = {uuid!r:s})".format(
@@ -1038,21 +1358,44 @@ class BlockReader:
         """
         Returns the disk block index of the file block specified by file_block_idx.
         """
-        disk_block_idx = None
+        entry_idx = bisect.bisect_right(self.block_map_starts, file_block_idx) - 1
 
-        # Find disk block
-        for entry in self.block_map:
-            if entry.file_block_idx <= file_block_idx < entry.file_block_idx + entry.block_count:
-                block_diff = file_block_idx - entry.file_block_idx
-                disk_block_idx = entry.disk_block_idx + block_diff
-                break
+        if entry_idx >= 0:
+            entry = self.block_map[entry_idx]
+            if file_block_idx < entry.file_block_idx + entry.block_count:
+                return entry.disk_block_idx + (file_block_idx - entry.file_block_idx)
 
-        return disk_block_idx
+        return None
+
+    def get_runs (self, start_block_idx, end_block_idx):
+        """
+        Generator: Splits the file blocks start_block_idx to end_block_idx (inclusive) into runs and yields tuples
+        (disk_block_idx, block_count) per run, where disk_block_idx is None for unmapped blocks (holes).
+        """
+        block_idx = start_block_idx
+        entry_idx = max(0, bisect.bisect_right(self.block_map_starts, block_idx) - 1)
+
+        while block_idx <= end_block_idx:
+            entry = self.block_map[entry_idx] if entry_idx < len(self.block_map) else None
+
+            if entry is None or block_idx < entry.file_block_idx:
+                # Hole up to the next mapped entry
+                hole_end = end_block_idx + 1 if entry is None else min(end_block_idx + 1, entry.file_block_idx)
+                yield (None, hole_end - block_idx)
+                block_idx = hole_end
+            elif block_idx >= entry.file_block_idx + entry.block_count:
+                entry_idx += 1
+            else:
+                run_end = min(end_block_idx + 1, entry.file_block_idx + entry.block_count)
+                yield (entry.disk_block_idx + (block_idx - entry.file_block_idx), run_end - block_idx)
+                block_idx = run_end
+                entry_idx += 1
 
     def read (self, byte_len = -1):
         """
         Reades up to byte_len bytes from the block device beginning at the cursor's current position. This operation will
         not exceed the inode's size. If -1 is passed for byte_len, the inode is read to the end.
+        Contiguous disk blocks are fetched with a single read, holes are served from a shared zero buffer.
         """
         # Parse args
         if byte_len < -1: raise ValueError("byte_len must be non-negative or -1")
@@ -1063,21 +1406,27 @@ class BlockReader:
         if byte_len == 0: return b""
 
         # Reading blocks
-        start_block_idx = self.cursor // self.volume.block_size
-        end_block_idx = (self.cursor + byte_len - 1) // self.volume.block_size
-        end_of_stream_check = byte_len
-
-        blocks = [self.read_block(i) for i in range(start_block_idx, end_block_idx - start_block_idx + 1)]
-
-        start_offset = self.cursor % self.volume.block_size
-        if start_offset != 0: blocks[0] = blocks[0][start_offset:]
-        byte_len = (byte_len + start_offset - self.volume.block_size - 1) % self.volume.block_size + 1
-        blocks[-1] = blocks[-1][:byte_len]
+        block_size = self.volume.block_size
+        start_block_idx = self.cursor // block_size
+        end_block_idx = (self.cursor + byte_len - 1) // block_size
+
+        # Only the requested bytes are read: the first run starts at the cursor, the last one ends at byte_len
+        parts = []
+        skip = self.cursor % block_size
+        remaining = byte_len
+        for disk_block_idx, block_count in self.get_runs(start_block_idx, end_block_idx):
+            run_len = min(block_count * block_size - skip, remaining)
+            if disk_block_idx is None:
+                parts.append(BlockReader.zeros(run_len))
+            else:
+                parts.append(self.volume_read(disk_block_idx * block_size + skip, run_len))
+            remaining -= run_len
+            skip = 0
 
-        result = b"".join(blocks)
+        result = parts[0] if len(parts) == 1 and isinstance(parts[0], bytes) else b"".join(parts)
 
         # Check read
-        if len(result) != end_of_stream_check:
+        if len(result) != byte_len:
             raise EndOfStreamError("The volume's underlying stream ended {0:d} bytes before EOF.".format(byte_len - len(result)))
 
         self.cursor += len(result)
@@ -1090,9 +1439,27 @@ class BlockReader:
         disk_block_idx = self.get_block_mapping(file_block_idx)
 
         if disk_block_idx != None:
-            return self.volume.read(disk_block_idx * self.volume.block_size, self.volume.block_size)
+            return self.volume_read(disk_block_idx * self.volume.block_size, self.volume.block_size)
         else:
-            return bytes([0] * self.volume.block_size)
+            return BlockReader.zeros(self.volume.block_size)
+
+    # Largest hole served from the shared zero buffer, larger ones get their own zeros
+    ZERO_BUFFER_MAX = 4 << 20
+    _zero_buffer = memoryview(bytes(0))
+
+    @staticmethod
+    def zeros (byte_len):
+        """
+        Returns byte_len zero bytes: a read-only view of a buffer shared by all BlockReader instances (grown up to
+        ZERO_BUFFER_MAX bytes), or fresh bytes for larger holes so that they aren't kept alive afterwards.
+        """
+        if byte_len > BlockReader.ZERO_BUFFER_MAX:
+            return bytes(byte_len)
+
+        if len(BlockReader._zero_buffer) < byte_len:
+            BlockReader._zero_buffer = memoryview(bytes(byte_len))
+
+        return BlockReader._zero_buffer[:byte_len]
 
     def seek (self, seek, seek_mode = io.SEEK_SET):
         """
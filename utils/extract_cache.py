@@ -0,0 +1,158 @@
+import hashlib
+import json
+import logging
+import os
+import stat
+import time
+from typing import Optional
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+# Written into every extraction output directory, records what produced it
+CACHE_MANIFEST = "extraction.json"
+# Bump when the shared readers (utils/) change what any extractor outputs
+PIPELINE_VERSION = 1
+# Bytes hashed at the start, middle and end of an archive for its partial hash
+PARTIAL_HASH_CHUNK = 1 << 20
+
+
+def _hash_file(path: str, partial: bool) -> str:
+    h = hashlib.sha256()
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        if partial and size > 3 * PARTIAL_HASH_CHUNK:
+            for offset in (0, (size - PARTIAL_HASH_CHUNK) // 2, size - PARTIAL_HASH_CHUNK):
+                f.seek(offset)
+                h.update(f.read(PARTIAL_HASH_CHUNK))
+        else:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def archive_key(firmware_path: str, full_digest: bool = False) -> dict:
+    """Identifies a firmware archive by size, mtime and a sha256 over its
+    first, middle and last PARTIAL_HASH_CHUNK bytes, plus the sha256 of the
+    whole file with `full_digest`. Already extracted firmware directories are
+    identified by the name, size and mtime of the files they contain, except
+    subdirectories and JSON files.
+
+    Returns:
+        dict: {"size", "mtime_ns", "partial_sha256"[, "sha256"]}
+    """
+    if os.path.isdir(firmware_path):
+        h = hashlib.sha256()
+        size = mtime_ns = 0
+        for name in sorted(os.listdir(firmware_path)):
+            st = os.stat(os.path.join(firmware_path, name))
+            if not stat.S_ISREG(st.st_mode) or name.endswith(".json"):
+                # Outputs, metadata.json and report.json live next to the tarballs
+                continue
+            h.update(f"{name}\0{st.st_size}\0{st.st_mtime_ns}\0".encode())
+            size += st.st_size
+            mtime_ns = max(mtime_ns, st.st_mtime_ns)
+        key = {"size": size, "mtime_ns": mtime_ns, "partial_sha256": h.hexdigest()}
+        if full_digest:
+            key["sha256"] = key["partial_sha256"]
+        return key
+
+    st = os.stat(firmware_path)
+    key = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "partial_sha256": _hash_file(firmware_path, True)}
+    if full_digest:
+        key["sha256"] = _hash_file(firmware_path, False)
+    return key
+
+
+def load_manifest(fw_out_dir: str) -> Optional[dict]:
+    try:
+        with open(os.path.join(fw_out_dir, CACHE_MANIFEST)) as mf:
+            return json.load(mf)
+    except (OSError, ValueError):
+        return None
+
+
+def is_cached(
+    fw_out_dir: str,
+    firmware_path: str,
+    extractor: str,
+    version: int,
+    options: dict = None,
+    full_digest: bool = False,
+) -> bool:
+    """Was `fw_out_dir` produced from this very `firmware_path` by the same
+    extractor, extractor version, PIPELINE_VERSION and options?
+
+    Size and mtime decide on their own when they match. A changed mtime
+    falls back to the partial hash (copied or re-downloaded archives).
+    With `full_digest` the whole archive is hashed as well; outputs recorded
+    without a full digest are upgraded in place when everything else matches.
+
+    Returns:
+        bool: `True` if the extraction can be skipped.
+    """
+    manifest = load_manifest(fw_out_dir)
+    if manifest is None:
+        return False
+    if (
+        manifest.get("extractor") != extractor
+        or manifest.get("version") != version
+        or manifest.get("pipeline_version") != PIPELINE_VERSION
+        or manifest.get("options") != (options or {})
+    ):
+        log.info(f"{fw_out_dir} was produced by {manifest.get('extractor')} v{manifest.get('version')}, redoing it")
+        return False
+
+    cached_key = manifest.get("archive", {})
+    if os.path.isfile(firmware_path):
+        st = os.stat(firmware_path)
+        if st.st_size != cached_key.get("size"):
+            return False
+        if st.st_mtime_ns == cached_key.get("mtime_ns") and not full_digest:
+            return True
+
+    key = archive_key(firmware_path, full_digest)
+    if key["size"] != cached_key.get("size") or key["partial_sha256"] != cached_key.get("partial_sha256"):
+        return False
+    if full_digest and "sha256" in cached_key and key["sha256"] != cached_key["sha256"]:
+        return False
+
+    if key != cached_key:
+        # Same content under a new mtime, or a first full digest: remember it
+        manifest["archive"] = {**cached_key, **key}
+        _write_manifest(fw_out_dir, manifest)
+    return True
+
+
+def _write_manifest(fw_out_dir: str, manifest: dict):
+    manifest_path = os.path.join(fw_out_dir, CACHE_MANIFEST)
+    with open(manifest_path + ".tmp", "w") as mf:
+        json.dump(manifest, mf, indent=2, sort_keys=True)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+
+def record_extraction(
+    fw_out_dir: str,
+    firmware_path: str,
+    extractor: str,
+    version: int,
+    options: dict = None,
+    full_digest: bool = False,
+):
+    """Records in `fw_out_dir`'s CACHE_MANIFEST that it holds the complete
+    output of `extractor` for `firmware_path`. Call it only once the
+    extraction has finished, so interrupted runs are redone."""
+    os.makedirs(fw_out_dir, exist_ok=True)
+    _write_manifest(
+        fw_out_dir,
+        {
+            "archive": archive_key(firmware_path, full_digest),
+            "firmware": os.path.abspath(firmware_path),
+            "extractor": extractor,
+            "version": version,
+            "pipeline_version": PIPELINE_VERSION,
+            "options": options or {},
+            "extracted_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        },
+    )
@@ -0,0 +1,211 @@
+import io
+import logging
+import os
+import re
+import shutil
+import struct
+from enum import Enum
+from typing import BinaryIO, List
+
+from utils import dump_erofs, dump_ext4, lpunpack
+from utils.simg2img import SparseImage
+
+try:
+    from pyfatfs.PyFatFS import PyFatBytesIOFS
+except ImportError:
+    PyFatBytesIOFS = None
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+# Covers every magic below: the LP metadata geometry of super images follows
+# the first LP_PARTITION_RESERVED_BYTES
+HEADER_SIZE = lpunpack.LP_PARTITION_RESERVED_BYTES + 0x1000
+
+SPARSE_MAGIC = 0xED26FF3A
+EXT4_MAGIC_OFFSET = 0x438
+EXT4_MAGIC = 0xEF53
+EROFS_MAGIC_OFFSET = 0x400
+EROFS_MAGIC = 0xE0F5E1E2
+
+
+class FsType(Enum):
+    UNKNOWN = 0
+    EXT4 = 1
+    EROFS = 2
+    FAT = 3
+    SUPER = 4
+
+
+def detect_fstype(header: bytes) -> FsType:
+    """Identifies an unsparsed image from its first HEADER_SIZE bytes."""
+    # EROFS first: the 2-byte ext4 magic offset falls inside the EROFS superblock's uuid, while the EROFS magic
+    # offset is ext4's s_inodes_count, which never reaches 0xE0F5E1E2
+    if len(header) >= EROFS_MAGIC_OFFSET + 4 and struct.unpack_from("<I", header, EROFS_MAGIC_OFFSET)[0] == EROFS_MAGIC:
+        return FsType.EROFS
+    if len(header) >= EXT4_MAGIC_OFFSET + 2 and struct.unpack_from("<H", header, EXT4_MAGIC_OFFSET)[0] == EXT4_MAGIC:
+        return FsType.EXT4
+    geometry_offset = lpunpack.LP_PARTITION_RESERVED_BYTES
+    if (
+        len(header) >= geometry_offset + 4
+        and struct.unpack_from("<I", header, geometry_offset)[0] == lpunpack.LP_METADATA_GEOMETRY_MAGIC
+    ):
+        return FsType.SUPER
+    if len(header) >= 512 and header[510:512] == b"\x55\xAA":
+        # FAT12/16 and FAT32 boot sectors name their type at different offsets,
+        # otherwise require the x86 jump and a sane sector size (not an MBR)
+        if header[0x36:0x39] == b"FAT" or header[0x52:0x57] == b"FAT32":
+            return FsType.FAT
+        bytes_per_sector = struct.unpack_from("<H", header, 0x0B)[0]
+        if header[0] in (0xEB, 0xE9) and bytes_per_sector in (512, 1024, 2048, 4096):
+            return FsType.FAT
+    return FsType.UNKNOWN
+
+
+class BorrowedStream(io.RawIOBase):
+    """Read-only view of a stream that leaves it open when closed, for readers
+    that close the file they were given (pyfatfs)."""
+
+    def __init__(self, stream: BinaryIO):
+        self.stream = stream
+        self.name = getattr(stream, "name", repr(stream))
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self.stream.seek(offset, whence)
+
+    def tell(self):
+        return self.stream.tell()
+
+    def read(self, size=-1):
+        return self.stream.read(size)
+
+    def readinto(self, b):
+        data = self.stream.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+
+class Filesystem:
+    """An image identified by `open_filesystem`, read in-process by the
+    matching reader.
+
+    Attributes:
+        fstype (FsType): detected type.
+        stream (BinaryIO): the image, already unsparsed.
+        sparse (bool): whether the image was an Android sparse image.
+    """
+
+    def __init__(self, fstype: FsType, stream: BinaryIO, sparse: bool = False):
+        self.fstype = fstype
+        self.stream = stream
+        self.sparse = sparse
+
+    def __repr__(self):
+        return f"Filesystem({self.fstype.name}, sparse={self.sparse})"
+
+    def open_fat(self) -> "PyFatBytesIOFS":
+        """Returns a read-only pyfilesystem of a FAT image."""
+        if self.fstype != FsType.FAT:
+            raise ValueError(f"Not a FAT image: {self}")
+        if PyFatBytesIOFS is None:
+            raise ImportError("pyfatfs is required to read FAT images")
+        self.stream.seek(0)
+        return PyFatBytesIOFS(BorrowedStream(self.stream))
+
+    def open_super(self) -> lpunpack.SuperImage:
+        """Returns the partition table of a super image."""
+        if self.fstype != FsType.SUPER:
+            raise ValueError(f"Not a super image: {self}")
+        self.stream.seek(0)
+        return lpunpack.SuperImage(self.stream)
+
+    def dump_files(
+        self,
+        dest: str,
+        file_regex: List[str],
+        search_dirs: List[str] = None,
+        flat: bool = False,
+        fallback: bool = True,
+    ) -> List[str]:
+        """Same as `dump_ext4.dump_files`/`dump_erofs.dump_files`, for any
+        supported filesystem.
+
+        Returns:
+            List[str]: image paths of the dumped files.
+        """
+        self.stream.seek(0)
+        if self.fstype == FsType.EXT4:
+            return dump_ext4.dump_files(self.stream, dest, file_regex, search_dirs, flat, fallback)
+        elif self.fstype == FsType.EROFS:
+            return dump_erofs.dump_files(self.stream, dest, file_regex, search_dirs, flat, fallback)
+        elif self.fstype == FsType.FAT:
+            return self._dump_fat_files(dest, file_regex, search_dirs, flat, fallback)
+        raise ValueError(f"Cannot dump files from {self}")
+
+    def _dump_fat_files(
+        self,
+        dest: str,
+        file_regex: List[str],
+        search_dirs: List[str] = None,
+        flat: bool = False,
+        fallback: bool = True,
+    ) -> List[str]:
+        fat_img = self.open_fat()
+        file_regex = [re.compile(x) for x in file_regex]
+
+        def matches(roots):
+            for root in roots:
+                if not fat_img.isdir(root):
+                    continue
+                for path in fat_img.walk.files(path=root):
+                    if any([x.match(os.path.basename(path)) for x in file_regex]):
+                        yield path
+
+        paths = []
+        if search_dirs is not None:
+            paths = list(dict.fromkeys(matches(["/" + x.strip("/") for x in search_dirs])))
+        if not paths and (fallback or search_dirs is None):
+            paths = list(matches(["/"]))
+
+        dumped = []
+        with fat_img:
+            for path in paths:
+                path = path.lstrip("/")
+                out_path = os.path.join(dest, os.path.basename(path) if flat else path)
+                os.makedirs(os.path.dirname(out_path), exist_ok=True)
+                with fat_img.openbin(path) as fi, open(out_path, "wb") as fo:
+                    shutil.copyfileobj(fi, fo)
+                dumped.append(path)
+        return dumped
+
+
+def open_filesystem(stream: BinaryIO) -> Filesystem:
+    """Identifies `stream` from the magic numbers in its first HEADER_SIZE
+    bytes (sparse, super, ext4, EROFS, FAT) instead of trying every reader in
+    turn. Sparse images are unsparsed on the fly and identified again.
+
+    Args:
+        stream (BinaryIO): seekable image.
+
+    Returns:
+        Filesystem: the image with its type, FsType.UNKNOWN if nothing matched.
+    """
+    stream.seek(0)
+    header = stream.read(HEADER_SIZE)
+    sparse = False
+    if len(header) >= 4 and struct.unpack_from("<I", header)[0] == SPARSE_MAGIC:
+        stream = SparseImage(stream)
+        stream.seek(0)
+        header = stream.read(HEADER_SIZE)
+        sparse = True
+    stream.seek(0)
+    filesystem = Filesystem(detect_fstype(header), stream, sparse)
+    log.debug(f"Detected {filesystem}")
+    return filesystem
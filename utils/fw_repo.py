@@ -1,8 +1,13 @@
 from .parse_report import get_tas, get_date
+from .catalogue import default_catalogue
 from data.config import fw_path, devices
 import datetime
+import logging
 import os
 import copy
+import sqlite3
+
+log = logging.getLogger(__name__)
 
 
 def vendor_has_region(vendor):
@@ -11,6 +16,18 @@ def vendor_has_region(vendor):
 
 def get_all_tas(vendor, device, region=None):
     # returns the dictionary of all tas sorted by data
+    catalogue = default_catalogue()
+    if catalogue is not None:
+        try:
+            return catalogue.get_all_tas(vendor, device, region)
+        except sqlite3.Error as e:
+            # e.g. a read-only dataset mount, where the catalogue can't be refreshed
+            log.warning(f"Dataset catalogue unusable for {vendor}/{device}, scanning the reports: {e}")
+    return scan_all_tas(vendor, device, region)
+
+
+def scan_all_tas(vendor, device, region=None):
+    # get_all_tas straight from the reports, without the catalogue
     dev_p = os.path.join(fw_path, vendor, device)
     out = {}
     tee = devices[vendor][device]
@@ -21,7 +38,7 @@ def get_all_tas(vendor, device, region=None):
         version_p = os.path.join(dev_p, version)
         report = os.path.join(version_p, "report.json")
         date = get_date(report, tee, vendor)
-        tas = get_tas(report, tee, vendor)
+        tas = get_tas(report, tee, vendor, date)
         if len(tas) > 0:
             date2info[date] = (version, tas)
     out = dict([date2info[datetime.datetime.fromtimestamp(date)] for date in sorted([datetime.datetime.timestamp(dt) for dt in date2info.keys()])])
@@ -0,0 +1,241 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import time
+import uuid
+from typing import BinaryIO, Callable, List, Optional, Tuple
+
+from data.config import image_cache_budget, image_cache_dir
+from utils.archive import MappedWindow, map_file_range
+from utils.extract_cache import PIPELINE_VERSION, archive_key
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+# Lists the images of an entry, in the order they were produced
+ENTRY_INDEX = "index.json"
+LOCK_FILE = ".lock"
+TMP_PREFIX = ".tmp-"
+# Unpublished entries left behind by killed workers are removed after this long
+STALE_TMP_SECONDS = 24 * 3600
+COPY_CHUNK = 1 << 20
+
+
+def source_key(firmware_path: str) -> str:
+    """Content key of a firmware archive (size and partial sha256, see
+    `extract_cache.archive_key`), the root of every cache key."""
+    key = archive_key(firmware_path)
+    return f"{key['size']}-{key['partial_sha256']}"
+
+
+def cache_key(*parts: str) -> str:
+    """Entry name for a source and the transform chain applied to it. The
+    PIPELINE_VERSION is part of every key, so changes to the shared readers
+    never serve stale images."""
+    return hashlib.sha256("\0".join([f"pipeline-{PIPELINE_VERSION}", *parts]).encode()).hexdigest()
+
+
+def _disk_usage(path: str) -> int:
+    """Bytes allocated to `path` (a file, or a directory of files), holes excluded."""
+    if os.path.isfile(path):
+        return os.stat(path).st_blocks * 512
+    usage = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                usage += os.stat(os.path.join(dirpath, filename)).st_blocks * 512
+            except FileNotFoundError:
+                pass
+    return usage
+
+
+def _copy_sparse(fi: BinaryIO, out_path: str) -> int:
+    """Copies `fi` from its start to `out_path`, leaving holes for all-zero
+    chunks (the DONT_CARE and empty areas of unsparsed images)."""
+    zeros = bytes(COPY_CHUNK)
+    size = 0
+    fi.seek(0)
+    with open(out_path, "wb") as fo:
+        while True:
+            chunk = fi.read(COPY_CHUNK)
+            if not chunk:
+                break
+            if chunk == zeros[: len(chunk)]:
+                fo.seek(len(chunk), os.SEEK_CUR)
+            else:
+                fo.write(chunk)
+            size += len(chunk)
+        fo.truncate(size)
+    return size
+
+
+def _map(path: str, name: str) -> MappedWindow:
+    with open(path, "rb") as fi:
+        # The mapping outlives the file object
+        return map_file_range(fi, 0, os.fstat(fi.fileno()).st_size, name)
+
+
+class ImageCache:
+    """Persistent on-disk cache of decoded firmware images (decompressed
+    .lz4/.tgz members, OFP-decrypted images, logical partitions of super
+    images), shared by every extractor run on the machine.
+
+    An entry is a directory `<root>/<key[:2]>/<key>` holding the images of
+    one transform chain applied to one firmware, and an ENTRY_INDEX listing
+    their names. Entries are built under a private temporary name and
+    published with a single rename, so concurrent workers never see partial
+    entries; if two workers build the same entry the first rename wins.
+    Hits refresh the index mtime, which orders the LRU eviction that keeps the
+    disk usage of the cache below `budget` bytes. Hits are returned as
+    read-only MappedWindows, which stay valid after their entry is evicted.
+
+    Args:
+        root (str): cache directory, created if needed.
+        budget (int): maximum disk usage of the entries in bytes.
+    """
+
+    def __init__(self, root: str, budget: int):
+        self.root = root
+        self.budget = budget
+        os.makedirs(root, exist_ok=True)
+
+    def entry_path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key)
+
+    def get(self, key: str) -> Optional[List[Tuple[str, MappedWindow]]]:
+        """Returns the images of entry `key`, None on a miss."""
+        entry = self.entry_path(key)
+        index_path = os.path.join(entry, ENTRY_INDEX)
+        try:
+            with open(index_path) as index_file:
+                names = json.load(index_file)
+            images = [(name, _map(os.path.join(entry, str(i)), name)) for i, name in enumerate(names)]
+            os.utime(index_path)
+        except (OSError, ValueError):
+            # Missing, or evicted while we were opening it
+            return None
+        return images
+
+    def put(self, key: str, images: List[Tuple[str, BinaryIO]]) -> List[Tuple[str, MappedWindow]]:
+        """Copies `images` to entry `key`, evicting the least recently used
+        entries to stay within the budget, and returns the copies. Entries
+        larger than the whole budget are returned but not kept."""
+        tmp = os.path.join(self.root, f"{TMP_PREFIX}{uuid.uuid4().hex}")
+        os.mkdir(tmp)
+        try:
+            for i, (name, fobj) in enumerate(images):
+                log.debug(f"Caching {name}")
+                _copy_sparse(fobj, os.path.join(tmp, str(i)))
+            with open(os.path.join(tmp, ENTRY_INDEX), "w") as index_file:
+                json.dump([name for name, _ in images], index_file)
+            stored = [(name, _map(os.path.join(tmp, str(i)), name)) for i, (name, _) in enumerate(images)]
+
+            usage = _disk_usage(tmp)
+            if usage > self.budget:
+                log.warning(f"Not caching {key}, its {usage} bytes exceed the {self.budget} bytes budget")
+                return stored
+            self.evict(self.budget - usage)
+            entry = self.entry_path(key)
+            os.makedirs(os.path.dirname(entry), exist_ok=True)
+            try:
+                os.rename(tmp, entry)
+            except OSError:
+                # Published meanwhile by another worker, ours is identical
+                pass
+            return stored
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def get_or_put(
+        self, key: str, produce: Callable[[], Optional[List[Tuple[str, BinaryIO]]]]
+    ) -> Optional[List[Tuple[str, MappedWindow]]]:
+        """Images of entry `key`, `produce()` stored as `key` on a miss. A
+        `produce` returning None (nothing could be decoded) isn't cached."""
+        images = self.get(key)
+        if images is not None:
+            log.info(f"Image cache hit for {key}: {[name for name, _ in images]}")
+            return images
+        images = produce()
+        return images if images is None else self.put(key, images)
+
+    def entries(self) -> List[Tuple[float, str]]:
+        """(last use, path) of every published entry."""
+        entries = []
+        for prefix in os.listdir(self.root):
+            prefix_dir = os.path.join(self.root, prefix)
+            if prefix.startswith(".") or not os.path.isdir(prefix_dir):
+                continue
+            for key in os.listdir(prefix_dir):
+                entry = os.path.join(prefix_dir, key)
+                try:
+                    entries.append((os.stat(os.path.join(entry, ENTRY_INDEX)).st_mtime, entry))
+                except FileNotFoundError:
+                    entries.append((0, entry))
+        return entries
+
+    def evict(self, target: int = None):
+        """Removes the least recently used entries until they use at most
+        `target` bytes (default: the budget), plus the temporary entries of
+        dead workers. Serialized across processes by a lock file."""
+        target = self.budget if target is None else target
+        with open(os.path.join(self.root, LOCK_FILE), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            now = time.time()
+            for name in os.listdir(self.root):
+                path = os.path.join(self.root, name)
+                try:
+                    if name.startswith(TMP_PREFIX) and now - os.stat(path).st_mtime > STALE_TMP_SECONDS:
+                        shutil.rmtree(path, ignore_errors=True)
+                except FileNotFoundError:
+                    pass
+
+            entries = sorted(self.entries())
+            usage = sum(_disk_usage(entry) for _, entry in entries)
+            for _, entry in entries:
+                if usage <= target:
+                    break
+                entry_usage = _disk_usage(entry)
+                # Unpublish first, so readers see either the whole entry or a miss
+                trash = os.path.join(self.root, f"{TMP_PREFIX}{uuid.uuid4().hex}")
+                os.rename(entry, trash)
+                shutil.rmtree(trash, ignore_errors=True)
+                usage -= entry_usage
+                log.debug(f"Evicted {os.path.basename(entry)} from the image cache")
+
+
+_default_cache = None
+
+
+def default_cache() -> Optional[ImageCache]:
+    """The ImageCache configured by `image_cache_dir` and `image_cache_budget`
+    in data/config.py, None if it is disabled or can't be created."""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = False
+        if image_cache_dir:
+            try:
+                _default_cache = ImageCache(image_cache_dir, image_cache_budget)
+            except OSError as e:
+                log.warning(f"Image cache disabled, can't use {image_cache_dir}: {e}")
+    return _default_cache or None
+
+
+def cached_images(
+    firmware_path: str, transforms: str, produce: Callable[[], Optional[List[Tuple[str, BinaryIO]]]]
+) -> Optional[List[Tuple[str, BinaryIO]]]:
+    """Returns the (name, image) pairs `produce` decodes from `firmware_path`,
+    out of the default cache if it already holds them. `transforms` names the
+    transform chain `produce` applies, so that changing it changes the key.
+    Without a cache, this is just `produce()`.
+
+    On a miss the images are read in full once to be stored, so `produce`
+    should only return the images that will be used.
+    """
+    cache = default_cache()
+    if cache is None:
+        return produce()
+    return cache.get_or_put(cache_key(source_key(firmware_path), transforms), produce)
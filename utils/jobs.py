@@ -0,0 +1,222 @@
+import concurrent.futures
+import json
+import logging
+import os
+import tarfile
+import time
+import traceback
+import zipfile
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, List, Optional, Sequence
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+# Interpreter, readers and output buffers of a job, on top of its images
+BASE_JOB_MEMORY = 256 << 20
+# Share of MemAvailable handed out to jobs when no budget is given
+DEFAULT_MEMORY_SHARE = 0.8
+# Uncompressed over compressed size assumed for archives that can't be listed cheaply (.tgz, .rar)
+COMPRESSED_EXPANSION = 2
+
+
+def available_memory() -> int:
+    """MemAvailable from /proc/meminfo, in bytes."""
+    with open("/proc/meminfo") as meminfo:
+        for line in meminfo:
+            if line.startswith("MemAvailable:"):
+                return int(line.split()[1]) * 1024
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+
+
+def archive_members(archive_path: str) -> Optional[Dict[str, int]]:
+    """Uncompressed size of every regular file of a zip, an uncompressed
+    tarball or an already extracted firmware directory, read from their
+    headers. None for archives that would have to be decompressed to be
+    listed (.tgz, .rar).
+
+    Returns:
+        Optional[Dict[str, int]]: member basename to size.
+    """
+    if os.path.isdir(archive_path):
+        return {
+            name: os.path.getsize(os.path.join(archive_path, name))
+            for name in os.listdir(archive_path)
+            if os.path.isfile(os.path.join(archive_path, name))
+        }
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as zf:
+            return {os.path.basename(i.filename): i.file_size for i in zf.infolist() if not i.is_dir()}
+    try:
+        with tarfile.open(archive_path, "r:") as tf:
+            return {os.path.basename(m.name): m.size for m in tf if m.isfile()}
+    except tarfile.ReadError:
+        return None
+
+
+def members_size(archive_path: str, predicate: Callable[[str], bool]) -> int:
+    """Uncompressed size of the members of `archive_path` whose basename
+    satisfies `predicate`, COMPRESSED_EXPANSION times the archive size if it
+    can't be listed (see `archive_members`)."""
+    members = archive_members(archive_path)
+    if members is None:
+        return COMPRESSED_EXPANSION * os.path.getsize(archive_path)
+    return sum(size for name, size in members.items() if predicate(name))
+
+
+def _run_job(func: Callable, args: Sequence) -> Optional[str]:
+    try:
+        func(*args)
+    except (Exception, SystemExit):
+        return traceback.format_exc()
+    return None
+
+
+class _Summary:
+    """Progress of `run_jobs`, rewritten to `path` (if any) on every change."""
+
+    def __init__(self, path: Optional[str], names: List[str], estimates: List[int], n_jobs: int, budget: int):
+        self.path = path
+        self.started = time.time()
+        self.n_jobs = n_jobs
+        self.budget = budget
+        self.jobs = [
+            {"job": name, "status": "pending", "estimated_memory": estimate, "seconds": None, "error": None}
+            for name, estimate in zip(names, estimates)
+        ]
+        self.starts = {}
+
+    def start(self, idx: int):
+        self.starts[idx] = time.perf_counter()
+        self.jobs[idx]["status"] = "running"
+        self.write()
+
+    def finish(self, idx: int, error: Optional[str]):
+        job = self.jobs[idx]
+        job["seconds"] = round(time.perf_counter() - self.starts.pop(idx), 3)
+        job["status"] = "failed" if error else "ok"
+        job["error"] = error
+        done = sum(j["status"] in ("ok", "failed") for j in self.jobs)
+        if error:
+            log.error(f"[{done}/{len(self.jobs)}] {job['job']} failed after {job['seconds']}s:\n{error}")
+        else:
+            log.info(f"[{done}/{len(self.jobs)}] {job['job']} done in {job['seconds']}s")
+        self.write()
+
+    def requeue(self, idx: int):
+        self.starts.pop(idx, None)
+        self.jobs[idx]["status"] = "pending"
+        self.write()
+
+    def counts(self) -> Dict[str, int]:
+        counts = {"pending": 0, "running": 0, "ok": 0, "failed": 0}
+        for job in self.jobs:
+            counts[job["status"]] += 1
+        return counts
+
+    def write(self):
+        if self.path is None:
+            return
+        summary = {
+            "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(self.started)),
+            "elapsed_seconds": round(time.time() - self.started, 3),
+            "n_jobs": self.n_jobs,
+            "memory_budget": self.budget,
+            **self.counts(),
+            "jobs": self.jobs,
+        }
+        with open(self.path + ".tmp", "w") as summary_file:
+            json.dump(summary, summary_file, indent=2)
+        os.replace(self.path + ".tmp", self.path)
+
+
+def run_jobs(
+    func: Callable,
+    jobs: List[Sequence],
+    estimate: Callable[[str], int],
+    n_jobs: int,
+    memory_budget: int = None,
+    summary_path: str = None,
+    initializer: Callable = None,
+) -> Dict[str, int]:
+    """Runs `func(*args)` for every `args` of `jobs` in a pool of `n_jobs`
+    processes, only starting a job when its estimated peak memory fits in
+    what the running jobs leave of `memory_budget`. Jobs are started in
+    order, except that a job that doesn't fit lets smaller ones behind it go
+    first. A job larger than the whole budget runs once nothing else does.
+
+    Failures (exceptions, exit(), crashed workers) are recorded and don't
+    stop the other jobs. When a worker dies, the jobs that were running are
+    run again one at a time, and only the one that kills its worker again
+    is recorded as failed.
+
+    Args:
+        func (Callable): module-level function, the first of its args names the job.
+        jobs (List[Sequence]): arguments of each call.
+        estimate (Callable[[str], int]): peak memory of a job from its name.
+        n_jobs (int): worker processes.
+        memory_budget (int): bytes, DEFAULT_MEMORY_SHARE of the available memory if None.
+        summary_path (str): JSON file kept up to date with the progress,
+            timings and errors of every job.
+        initializer (Callable): run once in each worker process.
+
+    Returns:
+        Dict[str, int]: number of jobs per final status ("ok", "failed").
+    """
+    if memory_budget is None:
+        memory_budget = int(available_memory() * DEFAULT_MEMORY_SHARE)
+    names = [str(args[0]) for args in jobs]
+    estimates = [estimate(name) for name in names]
+    summary = _Summary(summary_path, names, estimates, n_jobs, memory_budget)
+    log.info(f"Running {len(jobs)} jobs on {n_jobs} processes within {memory_budget >> 20} MiB")
+
+    pending = list(range(len(jobs)))
+    running = {}
+    # Jobs that were running when a worker died, retried one at a time to find the culprit
+    isolated = set()
+    executor = concurrent.futures.ProcessPoolExecutor(n_jobs, initializer=initializer)
+    try:
+        while pending or running:
+            in_use = sum(estimates[idx] for idx in running.values())
+            for idx in list(pending):
+                if len(running) >= n_jobs or isolated.intersection(running.values()):
+                    break
+                if running and (idx in isolated or in_use + estimates[idx] > memory_budget):
+                    continue
+                pending.remove(idx)
+                summary.start(idx)
+                running[executor.submit(_run_job, func, jobs[idx])] = idx
+                in_use += estimates[idx]
+
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            broken = False
+            for future in done:
+                idx = running.pop(future)
+                try:
+                    summary.finish(idx, future.result())
+                except BrokenProcessPool:
+                    broken = True
+                    if idx in isolated:
+                        summary.finish(idx, "worker process died (out of memory?)")
+                    else:
+                        isolated.add(idx)
+                        summary.requeue(idx)
+                        pending.append(idx)
+            if broken:
+                # Every job of the pool died with it
+                for idx in running.values():
+                    isolated.add(idx)
+                    summary.requeue(idx)
+                    pending.append(idx)
+                pending.sort()
+                running = {}
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = concurrent.futures.ProcessPoolExecutor(n_jobs, initializer=initializer)
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+        summary.write()
+
+    counts = summary.counts()
+    log.info(f"{counts['ok']} jobs done, {counts['failed']} failed")
+    return counts
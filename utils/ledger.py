@@ -0,0 +1,220 @@
+import contextlib
+import logging
+import os
+import sqlite3
+import time
+import traceback
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+from data.config import ledger_path
+from utils.extract_cache import archive_key
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+# What a firmware goes through, in order. Extractors record the stages they
+# have: decoding the images (unpack), dumping the TAs out of filesystem
+# images (fs-walk), writing the TAs that need more than a copy, e.g. sboot,
+# startup.tzar or split QSEE images (ta-copy); `python -m spill run` records
+# parse. The bytes of a stage are those it produced.
+STAGES = ("unpack", "fs-walk", "ta-copy", "parse")
+# Seconds a process waits for another one holding the database lock
+BUSY_TIMEOUT = 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS stages (
+    firmware TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    pipeline TEXT NOT NULL,
+    output TEXT,
+    archive_size INTEGER,
+    archive_mtime_ns INTEGER,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    started_at REAL,
+    seconds REAL,
+    bytes INTEGER,
+    error TEXT,
+    PRIMARY KEY (firmware, stage)
+);
+CREATE INDEX IF NOT EXISTS stages_pipeline ON stages (pipeline, stage, status);
+"""
+
+
+def _identity(firmware_path: str) -> Tuple[int, int]:
+    """(size, mtime_ns) of a firmware archive or unpacked firmware directory,
+    the rows of an archive that changed since are stale."""
+    if os.path.isdir(firmware_path):
+        key = archive_key(firmware_path)
+        return key["size"], key["mtime_ns"]
+    st = os.stat(firmware_path)
+    return st.st_size, st.st_mtime_ns
+
+
+def stream_size(fobj: BinaryIO) -> int:
+    """Size of a seekable image, from its end."""
+    pos = fobj.tell()
+    size = fobj.seek(0, os.SEEK_END)
+    fobj.seek(pos)
+    return size
+
+
+def tree_size(path: str) -> int:
+    """Bytes of the regular files below `path`, 0 if it doesn't exist."""
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            file_path = os.path.join(dirpath, filename)
+            if os.path.isfile(file_path) and not os.path.islink(file_path):
+                size += os.path.getsize(file_path)
+    return size
+
+
+class StageRecord:
+    """Handed out by `Ledger.stage`, the block sets the bytes it produced, and
+    calls `fail` for errors it recovers from but that leave its output
+    incomplete."""
+
+    def __init__(self):
+        self.bytes = None
+        self.error = None
+
+    def fail(self, error: str):
+        """Records the stage as "failed" with `error` once the block exits."""
+        self.error = error if self.error is None else f"{self.error}\n{error}"
+
+
+class Ledger:
+    """SQLite ledger of what every firmware went through: one row per
+    firmware and stage (see STAGES) with its status ("running", "ok",
+    "failed"), attempts, duration, bytes processed and error. Rows are keyed
+    by the absolute firmware path and remember the archive size and mtime, so
+    a replaced archive starts over.
+
+    The table doubles as a performance dataset, e.g. throughput per stage:
+
+        SELECT pipeline, stage, SUM(bytes) / SUM(seconds) FROM stages
+        WHERE status = 'ok' GROUP BY pipeline, stage;
+
+    Every process opens its own connection, concurrent writers (jobs of
+    `multi_extract` or `python -m spill run`) wait for each other's
+    transactions.
+
+    Args:
+        path (str): database file, created if needed.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn = None
+        self._pid = None
+        self._connect()
+
+    def _connect(self) -> sqlite3.Connection:
+        # Connections can't be shared with forked workers
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, isolation_level=None)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.executescript(SCHEMA)
+            self._pid = os.getpid()
+        return self._conn
+
+    def status(self, firmware_path: str, stage: str, output: str = None) -> Optional[str]:
+        """Status of `stage` for the current archive, None if it never ran
+        (or ran with another `output`, if given)."""
+        firmware_path = os.path.abspath(firmware_path)
+        row = (
+            self._connect()
+            .execute(
+                "SELECT status, archive_size, archive_mtime_ns, output FROM stages WHERE firmware = ? AND stage = ?",
+                (firmware_path, stage),
+            )
+            .fetchone()
+        )
+        if row is None or tuple(row[1:3]) != _identity(firmware_path):
+            return None
+        if output is not None and row[3] != os.path.abspath(output):
+            return None
+        return row[0]
+
+    def completed(self, firmware_path: str, stages: List[str], output: str = None) -> bool:
+        """Did every one of `stages` succeed on the current archive (and
+        write to `output`, if given)?"""
+        return all(self.status(firmware_path, stage, output) == "ok" for stage in stages)
+
+    def reset(self, firmware_path: str):
+        """Forgets every stage of `firmware_path`, e.g. for --force."""
+        self._connect().execute("DELETE FROM stages WHERE firmware = ?", (os.path.abspath(firmware_path),))
+
+    @contextlib.contextmanager
+    def stage(self, firmware_path: str, pipeline: str, stage: str, output: str = None) -> Iterator[StageRecord]:
+        """Records the block as `stage` of `firmware_path`, writing to
+        `output`: "running" while it runs, then "ok", or "failed" with the
+        traceback if it raises (the exception propagates) or with the errors
+        passed to `StageRecord.fail`."""
+        firmware_path = os.path.abspath(firmware_path)
+        output = output and os.path.abspath(output)
+        size, mtime_ns = _identity(firmware_path)
+        started = time.time()
+        self._connect().execute(
+            "INSERT INTO stages"
+            " (firmware, stage, pipeline, output, archive_size, archive_mtime_ns, status, attempts, started_at)"
+            " VALUES (?, ?, ?, ?, ?, ?, 'running', 1, ?)"
+            " ON CONFLICT (firmware, stage) DO UPDATE SET"
+            " pipeline = excluded.pipeline, output = excluded.output, archive_size = excluded.archive_size,"
+            " archive_mtime_ns = excluded.archive_mtime_ns, status = 'running', attempts = attempts + 1,"
+            " started_at = excluded.started_at, seconds = NULL, bytes = NULL, error = NULL",
+            (firmware_path, stage, pipeline, output, size, mtime_ns, started),
+        )
+        record = StageRecord()
+        status, error = "failed", None
+        try:
+            yield record
+            status, error = ("failed" if record.error else "ok"), record.error
+        except BaseException:
+            error = traceback.format_exc()
+            raise
+        finally:
+            self._connect().execute(
+                "UPDATE stages SET status = ?, seconds = ?, bytes = ?, error = ? WHERE firmware = ? AND stage = ?",
+                (status, round(time.time() - started, 3), record.bytes, error, firmware_path, stage),
+            )
+
+
+_default_ledger = None
+
+
+def default_ledger() -> Optional[Ledger]:
+    """The Ledger at `ledger_path` of data/config.py, None if it is disabled
+    or can't be opened."""
+    global _default_ledger
+    if _default_ledger is None:
+        _default_ledger = False
+        if ledger_path:
+            try:
+                _default_ledger = Ledger(ledger_path)
+            except sqlite3.Error as e:
+                log.warning(f"Job ledger disabled, can't use {ledger_path}: {e}")
+    return _default_ledger or None
+
+
+def track(firmware_path: str, pipeline: str, stage: str, output: str = None):
+    """`Ledger.stage` on the default ledger, a no-op without one."""
+    ledger = default_ledger()
+    if ledger is None:
+        return contextlib.nullcontext(StageRecord())
+    return ledger.stage(firmware_path, pipeline, stage, output)
+
+
+def completed(firmware_path: str, stages: List[str], output: str = None) -> bool:
+    """`Ledger.completed` on the default ledger, False without one."""
+    ledger = default_ledger()
+    return ledger is not None and ledger.completed(firmware_path, stages, output)
+
+
+def reset(firmware_path: str):
+    """`Ledger.reset` on the default ledger."""
+    ledger = default_ledger()
+    if ledger is not None:
+        ledger.reset(firmware_path)
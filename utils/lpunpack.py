@@ -2,6 +2,8 @@
 
 import io
 import sys
+import bisect
+import shutil
 from pathlib import Path
 from collections import namedtuple
 from struct import unpack, calcsize
@@ -11,6 +13,8 @@ LP_METADATA_GEOMETRY_MAGIC = 0x616c4467
 LP_METADATA_GEOMETRY_SIZE = 4096
 LP_METADATA_HEADER_MAGIC = 0x414C5030
 LP_SECTOR_SIZE = 512
+LP_TARGET_TYPE_LINEAR = 0
+LP_TARGET_TYPE_ZERO = 1
 
 class LpMetadataGeometry(object):
     """
@@ -138,19 +142,75 @@ class LpUnpackError(Exception):
     def __str__(self):
         return self.message
 
+class PartitionView(io.RawIOBase):
+    """
+    Read-only, seekable view of a logical partition inside a super image.
+
+    `extents` is a list of (partition_offset, size, super_offset) tuples; a
+    super_offset of None denotes a zero-filled extent. Reads are served from
+    the super image on demand instead of copying the partition.
+    """
+    def __init__(self, fin, extents):
+        self.in_file_fd = fin
+        self.extents = extents
+        self.extent_offsets = [extent[0] for extent in extents]
+        self.size = sum(extent[1] for extent in extents)
+        self.cursor = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.cursor
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.cursor
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise OSError(22, "Invalid argument")
+        self.cursor = offset
+        return self.cursor
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.cursor
+        size = max(0, min(size, self.size - self.cursor))
+        if size == 0:
+            return b""
+
+        parts = []
+        index = bisect.bisect_right(self.extent_offsets, self.cursor) - 1
+        while size > 0:
+            part_offset, part_size, super_offset = self.extents[index]
+            skip = self.cursor - part_offset
+            n = min(size, part_size - skip)
+            if super_offset is None:
+                parts.append(bytes(n))
+            else:
+                self.in_file_fd.seek(super_offset + skip)
+                parts.append(self.in_file_fd.read(n))
+            self.cursor += n
+            size -= n
+            index += 1
+        return b"".join(parts)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
 class LpUnpack(object):
     def __init__(self, fin, pname):
         self.partition_name = pname
         self.slot_num = None
         self.in_file_fd = fin
 
-    def _ReadChunk(self, block_size):
-        while True:
-            data = self.in_file_fd.read(block_size)
-            if not data:
-                break
-            yield data
-
     def ReadPrimaryGeometry(self):
         lpMetadataGeometry = LpMetadataGeometry(self.in_file_fd.read(LP_METADATA_GEOMETRY_SIZE))
         if lpMetadataGeometry is not None:
@@ -240,30 +300,31 @@ class LpUnpack(object):
         return metadata
 
     def ExtractPartition(self, meta):
-        print('Extracting super partition [{}] ....'.format(meta.name), end='', flush=True)
-        size = meta.size
-        self.in_file_fd.seek(meta.offset)
-        bio = io.BytesIO()
-        for block in self._ReadChunk(meta.geometry.logical_block_size):
-            if size == 0:
-                break
-            bio.write(block)
-            size -= meta.geometry.logical_block_size
+        print('Mapping super partition [{}] ....'.format(meta.name), end='', flush=True)
+        view = PartitionView(self.in_file_fd, meta.extents)
         print("[done]")
-        return bio
+        return view
 
     def Extract(self, partition, metadata):
-        offset = 0
-        size = 0
-
-        unpack = namedtuple('Unpack', 'name offset size geometry')
+        unpack = namedtuple('Unpack', 'name extents geometry')
 
-        if partition.num_extents != 0:
-            extent = metadata.extents[partition.first_extent_index]
-            offset = extent.target_data * LP_SECTOR_SIZE
+        extents = []
+        offset = 0
+        for index in range(partition.first_extent_index, partition.first_extent_index + partition.num_extents):
+            extent = metadata.extents[index]
             size = extent.num_sectors * LP_SECTOR_SIZE
-
-        return self.ExtractPartition(unpack(partition.name, offset, size, metadata.geometry))
+            if extent.target_type == LP_TARGET_TYPE_LINEAR:
+                if extent.target_source != 0:
+                    raise LpUnpackError('Partition {} has an extent on block device {}, only the super device is supported.'.format(
+                        partition.name, extent.target_source))
+                extents.append((offset, size, extent.target_data * LP_SECTOR_SIZE))
+            elif extent.target_type == LP_TARGET_TYPE_ZERO:
+                extents.append((offset, size, None))
+            else:
+                raise LpUnpackError('Unknown extent target type {}'.format(extent.target_type))
+            offset += size
+
+        return self.ExtractPartition(unpack(partition.name, extents, metadata.geometry))
 
     def unpack(self):
         self.in_file_fd.seek(0)
@@ -283,6 +344,52 @@ class LpUnpack(object):
             return self.Extract(partition, metadata)
         return None
         
+class SuperImage(object):
+    """
+    Parses the super image metadata once and serves every logical partition
+    from it. `partitions` maps each partition name (including A/B suffixes as
+    stored in the metadata) to its LpMetadataPartition entry.
+    """
+    SLOT_SUFFIXES = ['_a', '_b']
+
+    def __init__(self, fin):
+        self.in_file_fd = fin
+        self.lp = LpUnpack(fin, None)
+        self.in_file_fd.seek(0)
+        self.metadata = self.lp.ReadMetadata()
+        self.partitions = {partition.name: partition for partition in self.metadata.partitions}
+
+    def __contains__(self, name):
+        return self.resolve(name) is not None
+
+    def resolve(self, name, slot_suffix=None):
+        """
+        Returns the metadata name of partition `name`. Names without an A/B
+        suffix fall back to `name + slot_suffix`, or to the first slot present
+        if no slot_suffix is given. Returns None if nothing matches.
+        """
+        if name in self.partitions:
+            return name
+        suffixes = [slot_suffix] if slot_suffix else self.SLOT_SUFFIXES
+        for suffix in suffixes:
+            if name + suffix in self.partitions:
+                return name + suffix
+        return None
+
+    def open(self, name, slot_suffix=None):
+        """Returns a lazy PartitionView of partition `name`."""
+        resolved = self.resolve(name, slot_suffix)
+        if resolved is None:
+            raise LpUnpackError('Could not find partition: {}'.format(name))
+        return self.lp.Extract(self.partitions[resolved], self.metadata)
+
+    def views(self):
+        """Generator: yields (name, PartitionView) for every non-empty partition."""
+        for name, partition in self.partitions.items():
+            if partition.num_extents != 0:
+                yield name, self.lp.Extract(partition, self.metadata)
+
+
 if __name__ == '__main__':
     if len(sys.argv) < 2:
         print("Invalid usage")
@@ -290,9 +397,9 @@ if __name__ == '__main__':
     if not Path(sys.argv[1]).exists():
         print("File not found")
     with open(sys.argv[1], "rb") as fin:
-        bio = LpUnpack(fin, "system").unpack()
-    if bio == None:
-        print("Partition name not found")
-        sys.exit(0)
-    with open(sys.argv[2], "wb") as fout:
-        fout.write(bio.getbuffer()) 
\ No newline at end of file
+        view = LpUnpack(fin, "system").unpack()
+        if view == None:
+            print("Partition name not found")
+            sys.exit(0)
+        with open(sys.argv[2], "wb") as fout:
+            shutil.copyfileobj(view, fout) 
\ No newline at end of file
@@ -0,0 +1,256 @@
+import bisect
+import collections
+import io
+import struct
+import tempfile
+from typing import BinaryIO
+
+import lz4.block
+
+LZ4_FRAME_MAGIC = 0x184D2204
+LZ4_SKIPPABLE_MAGIC = 0x184D2A50
+LZ4_SKIPPABLE_MASK = 0xFFFFFFF0
+# Block Maximum Size field of the BD byte
+LZ4_BLOCK_MAX_SIZES = {4: 64 << 10, 5: 256 << 10, 6: 1 << 20, 7: 4 << 20}
+# Linked blocks may reference up to 64 KiB of previously decoded data
+LZ4_WINDOW_SIZE = 64 << 10
+
+# Decoded data kept in memory before spilling to disk (non-seekable input)
+DEFAULT_MAX_MEMORY = 256 << 20
+# Decoded blocks kept in memory for random access (seekable input)
+DEFAULT_CACHE_BLOCKS = 16
+
+
+class LZ4FrameFile(io.RawIOBase):
+    """Read-only, seekable file object over the data of an LZ4 frame stream
+    (one or more concatenated frames, as written by the lz4 tool and
+    lz4.frame), decompressed incrementally as reads reach it.
+
+    Every block is decoded once, in order, and recorded in a block index that
+    maps decompressed to compressed offsets. If `fileobj` is seekable and the
+    blocks are independent (the lz4 default), later reads re-decode only the
+    blocks they touch and keep the last `cache_blocks` of them in memory.
+    Otherwise (pipes, linked blocks) the decoded data goes to a spooled
+    temporary file that moves from memory to `tmp_dir` past `max_memory`.
+
+    Attributes:
+        blocks (list): (out_offset, out_size, in_offset, in_size, stored) of
+            every block decoded so far.
+        spool (SpooledTemporaryFile): decoded data, None in random access mode.
+    """
+
+    def __init__(
+        self,
+        fileobj: BinaryIO,
+        max_memory: int = DEFAULT_MAX_MEMORY,
+        cache_blocks: int = DEFAULT_CACHE_BLOCKS,
+        tmp_dir: str = None,
+    ):
+        self.fileobj = fileobj
+        self.max_memory = max_memory
+        self.cache_blocks = cache_blocks
+        self.tmp_dir = tmp_dir
+        try:
+            self.input_seekable = fileobj.seekable()
+            self.in_pos = fileobj.tell() if self.input_seekable else 0
+        except (AttributeError, OSError):
+            self.input_seekable = False
+            self.in_pos = 0
+
+        self.blocks = []
+        self.block_offsets = []
+        self.indexed_size = 0
+        self.cache = collections.OrderedDict()
+        self.spool = None if self.input_seekable else self._new_spool()
+        # (block_max_size, block_checksum, content_checksum, independent) of the current frame
+        self.frame = None
+        self.window = b""
+        self.eof = False
+        self.cursor = 0
+
+    def _new_spool(self):
+        return tempfile.SpooledTemporaryFile(max_size=self.max_memory, dir=self.tmp_dir)
+
+    def _read_input(self, size: int) -> bytes:
+        if self.input_seekable:
+            self.fileobj.seek(self.in_pos)
+        data = self.fileobj.read(size)
+        # Streams (pipes, compressed tar members) may return short reads
+        while len(data) < size:
+            more = self.fileobj.read(size - len(data))
+            if not more:
+                break
+            data += more
+        self.in_pos += len(data)
+        return data
+
+    def _read_frame_header(self) -> bool:
+        """Reads the next frame header, skipping skippable frames. Returns
+        False at the end of the stream."""
+        while True:
+            buf = self._read_input(4)
+            if len(buf) < 4:
+                self.eof = True
+                return False
+            magic = struct.unpack("<I", buf)[0]
+            if magic & LZ4_SKIPPABLE_MASK == LZ4_SKIPPABLE_MAGIC:
+                size = struct.unpack("<I", self._read_input(4))[0]
+                self._read_input(size)
+                continue
+            if magic != LZ4_FRAME_MAGIC:
+                raise ValueError(f"Not an LZ4 frame (magic 0x{magic:08x} at 0x{self.in_pos - 4:x})")
+            break
+
+        flg, bd = self._read_input(2)
+        if flg >> 6 != 1:
+            raise ValueError(f"Unsupported LZ4 frame version {flg >> 6}")
+        independent = bool(flg & 0x20)
+        block_checksum = bool(flg & 0x10)
+        content_checksum = bool(flg & 0x04)
+        # content size, dictionary id, header checksum
+        self._read_input((8 if flg & 0x08 else 0) + (4 if flg & 0x01 else 0) + 1)
+
+        if not independent and self.spool is None:
+            # Linked blocks can only be decoded in order, keep what they decode to
+            self.spool = self._new_spool()
+            for i in range(len(self.blocks)):
+                self.spool.write(self._block_data(i))
+            self.cache.clear()
+        self.frame = (LZ4_BLOCK_MAX_SIZES[(bd >> 4) & 7], block_checksum, content_checksum, independent)
+        self.window = b""
+        return True
+
+    def _decode_block(self, data: bytes, stored: bool, block_max_size: int, window: bytes = None) -> bytes:
+        if stored:
+            return data
+        return lz4.block.decompress(data, uncompressed_size=block_max_size, dict=window)
+
+    def _index_next_block(self) -> bool:
+        """Decodes the next block of the stream into the index. Returns False
+        at the end of the stream."""
+        while not self.eof:
+            if self.frame is None:
+                self._read_frame_header()
+                continue
+            block_max_size, block_checksum, content_checksum, independent = self.frame
+            buf = self._read_input(4)
+            if len(buf) < 4:
+                raise ValueError("Truncated LZ4 frame")
+            in_size = struct.unpack("<I", buf)[0]
+            if in_size == 0:
+                # EndMark
+                self._read_input(4 if content_checksum else 0)
+                self.frame = None
+                continue
+
+            stored = bool(in_size & 0x80000000)
+            in_size &= 0x7FFFFFFF
+            in_offset = self.in_pos
+            data = self._read_input(in_size)
+            if len(data) < in_size:
+                raise ValueError("Truncated LZ4 block")
+            self._read_input(4 if block_checksum else 0)
+            out = self._decode_block(data, stored, block_max_size, None if independent else self.window)
+            if not independent:
+                self.window = (self.window + out)[-LZ4_WINDOW_SIZE:]
+
+            self.blocks.append((self.indexed_size, len(out), in_offset, in_size, stored))
+            self.block_offsets.append(self.indexed_size)
+            self.indexed_size += len(out)
+            if self.spool is not None:
+                self.spool.seek(0, io.SEEK_END)
+                self.spool.write(out)
+            else:
+                self._cache_block(len(self.blocks) - 1, out)
+            return True
+        return False
+
+    def _index_to(self, offset: int):
+        while self.indexed_size < offset and self._index_next_block():
+            pass
+
+    def _index_all(self):
+        while self._index_next_block():
+            pass
+
+    def _cache_block(self, idx: int, data: bytes):
+        self.cache[idx] = data
+        self.cache.move_to_end(idx)
+        while len(self.cache) > self.cache_blocks:
+            self.cache.popitem(last=False)
+
+    def _block_data(self, idx: int) -> bytes:
+        """Decoded data of indexed block `idx`, re-decoded from the input if
+        it is no longer cached (random access mode only)."""
+        if idx in self.cache:
+            self.cache.move_to_end(idx)
+            return self.cache[idx]
+        _, out_size, in_offset, in_size, stored = self.blocks[idx]
+        self.fileobj.seek(in_offset)
+        data = self.fileobj.read(in_size)
+        out = self._decode_block(data, stored, out_size)
+        self._cache_block(idx, out)
+        return out
+
+    @property
+    def size(self) -> int:
+        """Decompressed size, indexes the whole stream on first use."""
+        self._index_all()
+        return self.indexed_size
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.cursor
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.cursor
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise OSError(22, "Invalid argument")
+        self.cursor = offset
+        return self.cursor
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.cursor
+        self._index_to(self.cursor + size)
+        size = max(0, min(size, self.indexed_size - self.cursor))
+        if size == 0:
+            return b""
+
+        if self.spool is not None:
+            self.spool.seek(self.cursor)
+            data = self.spool.read(size)
+            self.cursor += len(data)
+            return data
+
+        parts = []
+        idx = bisect.bisect_right(self.block_offsets, self.cursor) - 1
+        while size > 0:
+            out_offset, out_size = self.blocks[idx][:2]
+            skip = self.cursor - out_offset
+            n = min(size, out_size - skip)
+            data = self._block_data(idx)
+            parts.append(data[skip : skip + n] if skip or n < out_size else data)
+            self.cursor += n
+            size -= n
+            idx += 1
+        return b"".join(parts)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+    def close(self):
+        if self.spool is not None:
+            self.spool.close()
+        self.cache.clear()
+        super().close()
@@ -19,13 +19,15 @@ class TA:
         return f"TA({self.name},{self.filepath})"
         
 
-def get_tas(report, tee, vendor):
+def get_tas(report, tee, vendor, date=None):
     # path is of type /fw/vendor/device/[region]/version/report.json
+    # date is get_date's, if the caller already has it
     out = []
     #print(report, tee, vendor)
     ta2v = get_ta_version(report, tee, vendor)
     ta2p = get_ta_filepath(report, tee, vendor)
-    date = get_date(report, tee, vendor)
+    if date is None:
+        date = get_date(report, tee, vendor)
     device = report.split("/")[3]
     for ta in ta2v:
         if ta in ta2p:
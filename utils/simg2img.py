@@ -27,6 +27,8 @@
 
 
 import sys
+import io
+import bisect
 import struct
 
 VERBOSE = False
@@ -151,6 +153,194 @@ def simg2img(ifd, ofd):
 
     print("write done") if VERBOSE else None
 
+
+CHUNK_TYPE_RAW = 0xCAC1
+CHUNK_TYPE_FILL = 0xCAC2
+CHUNK_TYPE_DONT_CARE = 0xCAC3
+CHUNK_TYPE_CRC32 = 0xCAC4
+
+
+class SparseImage(io.RawIOBase):
+    """
+    Read-only, seekable view of the raw image stored in an Android sparse image.
+
+    The chunk headers are indexed once on construction; afterwards `read` serves
+    RAW chunks straight from the underlying file and synthesizes FILL and
+    DONT_CARE chunks on the fly, so the unsparsed image is never materialized.
+    """
+
+    def __init__(self, ifd):
+        self.ifd = ifd
+        self.ifd.seek(0)
+        buf = self.ifd.read(28)
+        self.header = ext4_file_header(buf)
+        if self.header.magic != 0xED26FF3A:
+            raise ValueError("Not an Android sparse image (magic 0x%08x)" % self.header.magic)
+
+        # (out_offset, out_size, chunk_type, in_offset or fill pattern)
+        self.chunks = []
+        pos = self.header.file_header_size
+        out_offset = 0
+        for _ in range(self.header.total_chunks):
+            self.ifd.seek(pos)
+            chunk_header = ext4_chunk_header(self.ifd.read(12))
+            data_offset = pos + self.header.chunk_header_size
+            out_size = chunk_header.chunk_size * self.header.block_size
+            if chunk_header.type == CHUNK_TYPE_RAW:
+                if chunk_header.total_size - self.header.chunk_header_size != out_size:
+                    raise ValueError("Image is corrupted, bad RAW chunk at 0x%x" % pos)
+                self.chunks.append((out_offset, out_size, CHUNK_TYPE_RAW, data_offset))
+            elif chunk_header.type == CHUNK_TYPE_FILL:
+                self.ifd.seek(data_offset)
+                pattern = self.ifd.read(4)
+                self.chunks.append((out_offset, out_size, CHUNK_TYPE_FILL, pattern))
+            elif chunk_header.type == CHUNK_TYPE_DONT_CARE:
+                self.chunks.append((out_offset, out_size, CHUNK_TYPE_DONT_CARE, None))
+            elif chunk_header.type != CHUNK_TYPE_CRC32:
+                raise ValueError("Unknown chunk type 0x%04x at 0x%x" % (chunk_header.type, pos))
+            out_offset += out_size
+            pos += chunk_header.total_size
+        self.chunk_offsets = [chunk[0] for chunk in self.chunks]
+        self.size = out_offset
+        self.cursor = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.cursor
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.cursor
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise OSError(22, "Invalid argument")
+        self.cursor = offset
+        return self.cursor
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.cursor
+        size = max(0, min(size, self.size - self.cursor))
+        if size == 0:
+            return b""
+
+        parts = []
+        idx = bisect.bisect_right(self.chunk_offsets, self.cursor) - 1
+        while size > 0:
+            out_offset, out_size, chunk_type, data = self.chunks[idx]
+            skip = self.cursor - out_offset
+            n = min(size, out_size - skip)
+            if chunk_type == CHUNK_TYPE_RAW:
+                self.ifd.seek(data + skip)
+                parts.append(self.ifd.read(n))
+            elif chunk_type == CHUNK_TYPE_FILL and data != b"\x00\x00\x00\x00":
+                rot = skip % 4
+                pattern = data[rot:] + data[:rot]
+                parts.append((pattern * (n // 4 + 1))[:n])
+            else:
+                parts.append(bytes(n))
+            self.cursor += n
+            size -= n
+            idx += 1
+        return b"".join(parts)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class SparseImageSet(io.RawIOBase):
+    """
+    Read-only, seekable view of one raw image split across several Android
+    sparse images (super.0.img, super.1.img, ...). Each part only carries RAW
+    and FILL chunks for its own range and DONT_CARE elsewhere, so the parts are
+    overlaid the way `simg2img part0 part1 ... out.raw` writes them; ranges no
+    part covers read as zeros.
+    """
+
+    def __init__(self, images):
+        self.images = images
+        self.size = max(image.size for image in images)
+        # (out_offset, out_size, image) of every chunk that carries data
+        self.extents = sorted(
+            ((out_offset, out_size, image)
+             for image in images
+             for out_offset, out_size, chunk_type, _ in image.chunks
+             if chunk_type != CHUNK_TYPE_DONT_CARE),
+            key=lambda extent: extent[0])
+        self.extent_offsets = [extent[0] for extent in self.extents]
+        self.cursor = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.cursor
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.cursor
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise OSError(22, "Invalid argument")
+        self.cursor = offset
+        return self.cursor
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.cursor
+        size = max(0, min(size, self.size - self.cursor))
+
+        parts = []
+        while size > 0:
+            idx = bisect.bisect_right(self.extent_offsets, self.cursor) - 1
+            if idx >= 0 and self.cursor < self.extents[idx][0] + self.extents[idx][1]:
+                out_offset, out_size, image = self.extents[idx]
+                n = min(size, out_offset + out_size - self.cursor)
+                image.seek(self.cursor)
+                parts.append(image.read(n))
+            else:
+                next_offset = self.extent_offsets[idx + 1] if idx + 1 < len(self.extents) else self.size
+                n = min(size, next_offset - self.cursor)
+                parts.append(bytes(n))
+            self.cursor += n
+            size -= n
+        return b"".join(parts)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+def open_sparse_images(ifds):
+    """Returns a raw view of the image stored in `ifds`: the file itself if it
+    is a single unsparsed image, a SparseImage or a SparseImageSet otherwise."""
+    if len(ifds) == 1:
+        return SparseImage(ifds[0]) if is_sparse(ifds[0]) else ifds[0]
+    return SparseImageSet([SparseImage(ifd) for ifd in ifds])
+
+
+def is_sparse(ifd) -> bool:
+    """Checks the sparse magic at the start of `ifd`, restoring its position."""
+    pos = ifd.tell()
+    ifd.seek(0)
+    magic = ifd.read(4)
+    ifd.seek(pos)
+    return magic == b"\x3A\xFF\x26\xED"
+
+
 if __name__ == "__main__":
     if len(sys.argv) > 2:
         filename_in = sys.argv[1]  
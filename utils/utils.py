@@ -1,11 +1,15 @@
 import subprocess
 import logging
 import io
+import os
+import json
 import struct
 from typing import List
 
 TZAR_MAGIC = b"\x7f\xa5\x54\x41"
 SPARSE_HEADER_MAGIC = b"\xED\x26\xFF\x3A"
+# Maps every file in a tas/ directory to its path inside the firmware image
+TA_MANIFEST = "origpaths.json"
 
 logging.basicConfig()
 log = logging.getLogger(__name__)
@@ -23,6 +27,21 @@ def find_files(where, what):
     return paths
 
 
+def update_ta_manifest(tas_dir: str, ta_paths: List[str]) -> None:
+    """Records the original image paths of TAs dumped into `tas_dir` in its
+    TA_MANIFEST, keyed by file name and merged with what earlier images of the
+    same firmware recorded."""
+    manifest_path = os.path.join(tas_dir, TA_MANIFEST)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as mf:
+            manifest = json.load(mf)
+    for ta_path in ta_paths:
+        manifest[os.path.basename(ta_path)] = os.path.normpath(ta_path)
+    with open(manifest_path, "w") as mf:
+        json.dump(manifest, mf, indent=2, sort_keys=True)
+
+
 def get_subprocess(cmd):
     try:
         p = subprocess.Popen(
@@ -0,0 +1,111 @@
+import contextlib
+import fcntl
+import logging
+import os
+import shutil
+import tempfile
+from typing import Iterator, Optional, Tuple
+
+from data.config import scratch_dir
+
+logging.basicConfig()
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+SHM_DIR = "/dev/shm"
+# Workspaces are named <prefix><pid>-<footprint>-<random>, see `job_workspace`
+WORKSPACE_PREFIX = "spill-"
+# Serializes placing workspaces on SHM_DIR across processes
+SHM_LOCK = ".spill-workspaces.lock"
+# tmpfs space always left to the rest of the system
+SHM_RESERVE = 1 << 30
+
+
+def _usage(path: str) -> int:
+    usage = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            try:
+                usage += os.lstat(os.path.join(dirpath, filename)).st_blocks * 512
+            except FileNotFoundError:
+                pass
+    return usage
+
+
+def _parse_name(name: str) -> Optional[Tuple[int, int]]:
+    """(pid, footprint) of a workspace directory name, None for other files."""
+    if not name.startswith(WORKSPACE_PREFIX):
+        return None
+    fields = name[len(WORKSPACE_PREFIX) :].split("-")
+    if len(fields) != 3 or not fields[0].isdigit() or not fields[1].isdigit():
+        return None
+    return int(fields[0]), int(fields[1])
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def outstanding_footprint(base: str) -> int:
+    """Bytes the live workspaces in `base` announced but haven't written yet.
+    Workspaces of dead processes (killed jobs) are removed on the way."""
+    outstanding = 0
+    for name in os.listdir(base):
+        parsed = _parse_name(name)
+        path = os.path.join(base, name)
+        if parsed is None or not os.path.isdir(path):
+            continue
+        pid, footprint = parsed
+        if not _pid_alive(pid):
+            log.info(f"Removing workspace {path} of dead process {pid}")
+            shutil.rmtree(path, ignore_errors=True)
+            continue
+        outstanding += max(0, footprint - _usage(path))
+    return outstanding
+
+
+@contextlib.contextmanager
+def job_workspace(footprint: int = 0, base: str = None) -> Iterator[str]:
+    """Private directory for the temporary files of one job, removed with
+    everything in it when the block exits, however it exits.
+
+    The directory goes to tmpfs (SHM_DIR) if the `footprint` the job expects
+    to write fits in what is free there, once the other live workspaces got
+    the space they announced and SHM_RESERVE is left. Otherwise it goes to
+    `base`, the `scratch_dir` of data/config.py by default (the system
+    temporary directory if None). The footprint and pid are part of the
+    directory name, so concurrent jobs in any process see each other's
+    reservations, and workspaces of killed processes are cleaned up by the
+    next job.
+
+    Args:
+        footprint (int): bytes the job expects to write, 0 if unknown.
+        base (str): scratch directory used when tmpfs is full or absent.
+
+    Yields:
+        str: path of the workspace.
+    """
+    base = base or scratch_dir or tempfile.gettempdir()
+    os.makedirs(base, exist_ok=True)
+    prefix = f"{WORKSPACE_PREFIX}{os.getpid()}-{footprint}-"
+    path = None
+    if os.path.isdir(SHM_DIR) and os.access(SHM_DIR, os.W_OK):
+        with open(os.path.join(SHM_DIR, SHM_LOCK), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            free = shutil.disk_usage(SHM_DIR).free - outstanding_footprint(SHM_DIR) - SHM_RESERVE
+            if footprint <= free:
+                path = tempfile.mkdtemp(prefix=prefix, dir=SHM_DIR)
+    if path is None:
+        outstanding_footprint(base)
+        path = tempfile.mkdtemp(prefix=prefix, dir=base)
+    log.debug(f"Workspace {path} for {footprint} bytes")
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
@@ -1,30 +1,68 @@
 #!/usr/bin/env python
 import sys
 import argparse
-import tempfile
 import os
-import shutil
 import zipfile
 import tarfile
 import logging
 import io
 import subprocess
-from utils import dump_ext4, utils, dump_erofs
-
-from utils.simg2img import simg2img
-from utils import lpunpack
+from utils import extract_cache, image_cache, jobs, ledger, utils
+from utils.filesystem import FsType, open_filesystem
 
 logging.basicConfig()
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
-SPARSE_HEADER_MAGIC = b"\xED\x26\xFF\x3A"
-TMP_DIR = tempfile.mkdtemp()
+EXTRACTOR = "xiaomi/mediatek"
+# Bump whenever a change to this script changes its output, so cached extractions are redone
+EXTRACTOR_VERSION = 1
 TA_PARTITIONS = ["system", "vendor", "vendor_a", "super"]
+# Where the .ta files live inside the images, the rest of the image is only walked if none of these has any
+TA_SEARCH_DIRS = ["thh/ta", "vendor/thh/ta", "system/vendor/thh/ta"]
 VERBOSE = True
 
 
-def extract(firmware_path, out_dir, tas=False):
+def decode_images(firmware_path):
+    """Returns the vendor images of a .tgz firmware, the super image replaced
+    by its vendor partitions, None if the super image is invalid."""
+    extracted_images = []
+
+    # Extract images from zipfile
+    with tarfile.open(firmware_path) as tgz_ref:
+        for f in tgz_ref.getnames():
+            if "super.img" in f.lower():
+                log.info(f"Adding {f} to analyze queue")
+                bio = io.BytesIO(tgz_ref.extractfile(f).read())
+                extracted_images.append(("super.img",bio))
+            if "vendor.img" in f.lower():
+                log.info(f"Adding {f} to analyze queue")
+                bio = io.BytesIO(tgz_ref.extractfile(f).read())
+                extracted_images.append(("vendor.img",bio))
+
+    # Unpack super images
+    for e in extracted_images:
+        image_filename, image_file = e
+        if image_filename == "super.img":
+            super_fs = open_filesystem(image_file)
+            if super_fs.fstype != FsType.SUPER:
+                log.error(f"super.img isn't a super image: {super_fs}")
+                return None
+
+            super_image = super_fs.open_super()
+            vendor_partitions = ["vendor", "vendor_a"]
+            for vendor_part in vendor_partitions:
+                if vendor_part in super_image.partitions:
+                    extracted_images.append((f"{vendor_part}.img", super_image.open(vendor_part)))
+                else:
+                    log.info(f"vendor partition {vendor_part} not found!")
+
+            extracted_images.remove(e)
+            break
+    return extracted_images
+
+
+def extract(firmware_path, out_dir, tas=False, force=False, full_digest=False):
     """
     Philipp: Firmware is the .tgz file downloaded from -> out_dir/fw_name/tas/..
     """
@@ -33,14 +71,6 @@ def extract(firmware_path, out_dir, tas=False):
         log.warning("Output dir {} does not exist. Creating...".format(out_dir))
         os.mkdir(out_dir)
 
-    if not os.path.exists(TMP_DIR):
-        os.mkdir(TMP_DIR)
-
-    # Create temporary dir for files
-    tmp_dir = tempfile.mkdtemp(dir=TMP_DIR)
-
-    extracted_images = []
-
     # If firmware is a tgz
     fw_tgz_name = os.path.basename(os.path.normpath(firmware_path))
     if os.path.isfile(firmware_path):
@@ -52,17 +82,23 @@ def extract(firmware_path, out_dir, tas=False):
         fw_name = firmware_path.split("/")[-2]
         fw_out_dir = os.path.join(out_dir, fw_name)
 
-        # Extract images from zipfile
-        with tarfile.open(firmware_path) as tgz_ref:
-            for f in tgz_ref.getnames():
-                if "super.img" in f.lower():
-                    log.info(f"Adding {f} to analyze queue")
-                    bio = io.BytesIO(tgz_ref.extractfile(f).read())
-                    extracted_images.append(("super.img",bio))
-                if "vendor.img" in f.lower():
-                    log.info(f"Adding {f} to analyze queue")
-                    bio = io.BytesIO(tgz_ref.extractfile(f).read())
-                    extracted_images.append(("vendor.img",bio))
+        options = {"tas": tas}
+        if not force and extract_cache.is_cached(
+                fw_out_dir, firmware_path, EXTRACTOR, EXTRACTOR_VERSION, options, full_digest):
+            log.info(f"{fw_out_dir} is up to date with {firmware_path}, skipping it")
+            return fw_out_dir
+        if force or extract_cache.load_manifest(fw_out_dir) is not None:
+            # The outputs are those of another, complete run: redo every stage
+            ledger.reset(firmware_path)
+
+        with ledger.track(firmware_path, EXTRACTOR, "unpack", fw_out_dir) as stage:
+            # Decompressed images and super partitions are kept across runs if the image cache is enabled
+            extracted_images = image_cache.cached_images(
+                firmware_path, f"{EXTRACTOR}:gunzip,super(vendor,vendor_a)", lambda: decode_images(firmware_path))
+            if extracted_images is None:
+                stage.fail(f"super.img of {firmware_path} isn't a super image")
+                return None
+            stage.bytes = sum(ledger.stream_size(fobj) for _, fobj in extracted_images if fobj is not None)
 
     else:
         assert False, "This should never happen"
@@ -73,125 +109,76 @@ def extract(firmware_path, out_dir, tas=False):
     else:
         log.warn("Output dir {} already exist.".format(fw_out_dir))
 
-    # Unpack super images
-    for e in extracted_images:
-        image_filename, image_file = e
-        if image_filename == "super.img":
-            # If image is sparse image, unsparse
-            if image_file.read(4) == SPARSE_HEADER_MAGIC[::-1]:
-                extimg = io.BytesIO()
-                simg2img(image_file, extimg)
-                image_file = extimg
-            else:
-                log.error("super.img isn't an Android SPARC image?!?")
-                return None
-            image_file.seek(0)
+    # An earlier, failed run that got past fs-walk already wrote the TAs to fw_out_dir
+    if tas and not ledger.completed(firmware_path, ["fs-walk"], fw_out_dir):
+        with ledger.track(firmware_path, EXTRACTOR, "fs-walk", fw_out_dir) as stage:
+            n_tas = 0
+            for image_filename, image_file in extracted_images:
+                if image_file is None:
+                    log.debug(f"Skipping NULL file {image_filename}")
+                    continue
 
-            vendor_partitions = ["vendor", "vendor_a"]
-            for vendor_part in vendor_partitions:
-                try:
-                    extracted_images.append((f"{vendor_part}.img", lpunpack.LpUnpack(image_file, vendor_part).unpack() ))
-                except lpunpack.LpUnpackError:
-                    log.info(f"vendor partition {vendor_part} not found!")
+                image_file.seek(0)
 
-            extracted_images.remove(e)
-            break
+                if (not image_filename.endswith(".img")) or image_filename.startswith("boot.img"):
+                    log.debug(f"Skipping non-image file {image_filename}")
+                    continue
+
+                if not any([ (x in image_filename) for x in TA_PARTITIONS ]):
+                    log.debug(f"Skipping non-useful image {image_filename}")
+                    continue
 
-    if tas:
-        for image_filename, image_file in extracted_images:
-            if image_file is None:
-                log.debug(f"Skipping NULL file {image_filename}")
-                continue
-
-            image_file.seek(0)
-            simg = image_file
-
-            if (not image_filename.endswith(".img")) or image_filename.startswith("boot.img"):
-                log.debug(f"Skipping non-image file {image_filename}")
-                continue
-
-            if not any([ (x in image_filename) for x in TA_PARTITIONS ]):
-                log.debug(f"Skipping non-useful image {image_filename}")
-                continue
-
-            # If image is sparse image, unsparse
-            if simg.read(4) == SPARSE_HEADER_MAGIC[::-1]:
-                log.debug(f"Another sparse image file: {image_filename}!?!?")
-                extimg = io.BytesIO()
-                simg2img(simg, extimg)
-                simg = extimg
-            simg.seek(0)
-
-            tmpdir = tempfile.mkdtemp()  
-
-            mounted = False
-            ext4_fail = False
-            erofs_fail = False
-            # try ext4 extraction, if it fails it may be an erofs 
-            try:
-                log.debug(f"dumping ext4 files for: {image_filename}")
-                dump_ext4.dump_folder(simg, "", tmpdir, file_regex = [ ".*\.ta"])
-            except Exception as e:
-                log.error(f"failed ext4 for {image_filename}, {e}")
-                ext4_fail = True
-            if ext4_fail:
-                try:
-                    simg.seek(0)
-                    log.debug(f"dumping erofs files for: {image_filename}")
-                    dump_erofs.dump_folder(simg, "", tmpdir, file_regex = [ ".*\.ta"])
-                except Exception as e: 
-                    erofs_fail = True
-                    log.error(f"failed erofs for {image_filename}, {e}")
-                    
-            if erofs_fail:
-                # ok let's just mount it 
-                mounted = True
-                tmpfile = tempfile.mkstemp()[1]
-                simg.seek(0)
-                open(tmpfile, "wb").write(simg.getbuffer())
-                os.system(f"rm -rf {tmpdir}/*")
-                p = subprocess.Popen([f"sudo mount -t auto -o loop {tmpfile} {tmpdir}"], shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                p.wait()
-                out = p.stdout.read()
-                err = p.stderr.read()
-
-            ta_paths = utils.find_files(tmpdir, "*.ta")
-
-            if ta_paths:
                 tas_dstdir = os.path.join(fw_out_dir, "tas")
-                if not os.path.exists(tas_dstdir):
-                    os.mkdir(tas_dstdir)
-                for ta_path in ta_paths:
-                    log.debug(f"extracting {os.path.basename(ta_path)} to {tas_dstdir}")
-                    if mounted:
-                        # read-only filesystem
-                        data = open(ta_path, "rb").read()
-                        open(os.path.join(tas_dstdir, os.path.basename(ta_path)), "wb").write(data)
-                    else:
-                        shutil.copy(ta_path, tas_dstdir)
-                    pathfile = os.path.join( tas_dstdir, os.path.basename(ta_path) + "_origpath.txt" )
-                    with open(pathfile, "w") as pf:
-                        pf.write( os.path.normpath( ta_path.lstrip(tmpdir) ) )
-                        pf.write("\n")
-            else:
-                log.error("Could not find TAs in {} ({})".format(image_filename, tmpdir))
-            if mounted:
-                p = subprocess.Popen([f"sudo umount {tmpdir}"], shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                p.wait()
-            shutil.rmtree(tmpdir)
-            if mounted:
-                os.remove(tmpfile)
-
-
-    # delete temporary dir
-    shutil.rmtree(TMP_DIR)
+                ta_paths = []
+
+                # Pick the reader from the superblock magic (unsparsing if needed) instead of trying each in turn
+                img_fs = open_filesystem(image_file)
+                if img_fs.fstype not in (FsType.EXT4, FsType.EROFS):
+                    log.error(f"Skipping {image_filename}, unsupported image {img_fs}")
+                    continue
+                try:
+                    log.debug(f"dumping {img_fs.fstype.name} files for: {image_filename}")
+                    ta_paths = img_fs.dump_files(tas_dstdir, file_regex = [ ".*\.ta"], search_dirs = TA_SEARCH_DIRS, flat = True)
+                except Exception as e:
+                    log.error(f"failed {img_fs.fstype.name} for {image_filename}, {e}")
+                    # Go on with the other images, but don't let the walk pass for complete
+                    stage.fail(f"failed {img_fs.fstype.name} for {image_filename}: {e!r}")
+
+                if ta_paths:
+                    utils.update_ta_manifest(tas_dstdir, ta_paths)
+                    n_tas += len(ta_paths)
+                else:
+                    log.error("Could not find TAs in {}".format(image_filename))
+            if n_tas == 0:
+                stage.fail(f"No TAs found in {firmware_path}")
+            stage.bytes = ledger.tree_size(os.path.join(fw_out_dir, "tas"))
+        if stage.error:
+            # Missing or incomplete TAs: neither the extraction cache nor the ledger may skip them next time
+            return None
+
+    extract_cache.record_extraction(fw_out_dir, firmware_path, EXTRACTOR, EXTRACTOR_VERSION, options, full_digest)
     return fw_out_dir
 
-def multi_extract(fw_dir, our_dir, tas=False):
+def estimate_memory(firmware_path):
+    """Peak memory of `extract`, for `multi_extract` with several jobs: super.img and vendor.img are read
+    into memory, which is most of the uncompressed .tgz."""
+    return jobs.BASE_JOB_MEMORY + jobs.COMPRESSED_EXPANSION * os.path.getsize(firmware_path)
+
+
+def multi_extract(fw_dir, our_dir, tas=False, force=False, full_digest=False, n_jobs=1, memory_budget=None,
+                  summary=None):
     fw_paths = [os.path.join(fw_dir, fw_name) for fw_name in os.listdir(fw_dir) if fw_name.endswith(".tgz")]
 
-    for fw_path in fw_paths:
-        extract(fw_path, our_dir, tas)
+    if n_jobs <= 1:
+        for fw_path in fw_paths:
+            extract(fw_path, our_dir, tas, force, full_digest)
+        return
+
+    if not os.path.exists(our_dir):
+        os.makedirs(our_dir)
+    jobs.run_jobs(extract, [(fw_path, our_dir, tas, force, full_digest) for fw_path in fw_paths], estimate_memory,
+                  n_jobs, None if memory_budget is None else int(memory_budget * (1 << 30)),
+                  summary or os.path.join(our_dir, "extract_summary.json"))
 
 
 def setup_args():
@@ -207,6 +194,18 @@ def setup_args():
                                       'contained in firmware_dir.')
     parser.add_argument("-t", "--tas", action="store_true", help="Get trusted applications from image.")
     parser.add_argument("-o", "--out", required=True, action="store", help="Directory to store outputs.")
+    parser.add_argument("--force", action="store_true",
+                        help="Extract again even if the outputs are up to date with the firmware.")
+    parser.add_argument("--full-digest", action="store_true",
+                        help="Also compare the sha256 of the whole firmware to decide if the outputs are up to date.")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="With --multi, extract this many firmware images in parallel.")
+    parser.add_argument("--memory-budget", type=float,
+                        help="With --jobs, GiB of memory the parallel extractions may use together "
+                             "(default: 80%% of the available memory).")
+    parser.add_argument("--summary", action="store",
+                        help="With --jobs, JSON file tracking the progress, timings and failures "
+                             "(default: extract_summary.json in the output directory).")
     return parser
 
 
@@ -216,9 +215,10 @@ def main():
     args = arg_parser.parse_args()
 
     if args.firmware:
-        extract(args.firmware, args.out, args.tas)
+        extract(args.firmware, args.out, args.tas, args.force, args.full_digest)
     elif args.firmware_dir:
-        multi_extract(args.firmware_dir, args.out, args.tas)
+        multi_extract(args.firmware_dir, args.out, args.tas, args.force, args.full_digest, args.jobs,
+                      args.memory_budget, args.summary)
     else:
         arg_parser.print_help()
 